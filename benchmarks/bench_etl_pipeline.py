@@ -0,0 +1,436 @@
+"""Offline throughput benchmark of the full ETL path, from fetching a
+webpage to publishing the price aggregates to Redis
+
+Run from the repository root, after pip install -r benchmarks/requirements.txt:
+python benchmarks/bench_etl_pipeline.py --documents 100000
+python benchmarks/bench_etl_pipeline.py --documents 1000000 --json-report bench_etl.json
+python benchmarks/bench_etl_pipeline.py --pages-dir benchmarks/recorded_pages
+
+Nothing is sent to the Coles website or to the real databases unless asked for:
+
+1. Pages are served by a local stub web server (see stub_http_server),
+    either synthetic pages or pages recorded with record_pages.py
+2. MongoDB is mongomock unless --mongodb-uri is given
+3. to_sql writes to an in memory SQLite database unless --postgres-uri is
+    given. COPY is PostgreSQL only, so it is timed only with --postgres-uri
+4. Redis is fakeredis unless --redis-url is given
+
+Stages timed (per page for the first three, per batch of products after):
+
+1. fetch - extract_single_webpage_text() against the stub server
+2. regex_extraction - extract_products_with_regex(), the original parsing path
+3. product_extractor - the single pass product_extractor that replaced it
+4. mongodb_bulk_write - BulkProductWriter upserts
+5. json_normalize - the pd.json_normalize path mongodb_to_postgres used
+6. product_flattener - the ProductFlattener that replaced it
+7. to_sql - the original DataFrame.to_sql(method="multi") load
+8. copy - copy_dataframe_to_postgres(), the COPY load that replaced it
+9. redis_publish - postgres_to_redis.publish_price_aggregates()
+
+For each stage the report has the documents per second, the p50 and p95
+latency of a single call and how much the peak RSS of the process grew
+while the stage ran. Benchmark tables, collections and keys are separate
+from the pipeline's own and are dropped at the end.
+"""
+# Standard Library Imports
+import argparse
+from contextlib import contextmanager
+import json
+import math
+import os
+import re
+import resource
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "dags"))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+# 3rd Party Imports
+from bson import ObjectId
+import numpy as np
+import pandas as pd
+import sqlalchemy
+
+# Custom modules
+from dag_scripts import mongodb_to_postgres, postgres_to_redis, product_extractor
+from dag_scripts import redis_publisher, website_to_mongodb
+from dag_scripts.mongodb_bulk_writer import BulkProductWriter
+from dag_scripts.product_flattener import ProductFlattener
+from dag_scripts.tests import test_mongodb_schema_change
+from bench_product_flattener import flatten_with_json_normalize
+from stub_http_server import RecordedPages, StubWebsite, SyntheticPages
+
+# Globals
+STAGE_NAMES = [
+    "fetch",
+    "regex_extraction",
+    "product_extractor",
+    "mongodb_bulk_write",
+    "json_normalize",
+    "product_flattener",
+    "to_sql",
+    "copy",
+    "redis_publish",
+]
+BENCHMARK_CATEGORY_PATH = "/browse/fruit-vegetables"
+BENCHMARK_COLLECTION_NAME = "supermarket_json_benchmark"
+BENCHMARK_TABLE_NAME = "raw_supermarket_staging_benchmark"
+BENCHMARK_REDIS_NAMESPACE = "supermarket_benchmark"
+DATE_EXTRACTED = "2023-09-12"
+SQLITE_MAX_VARIABLES = 32766 # bound parameters in one statement since SQLite 3.32
+# ru_maxrss is in kilobytes on Linux and bytes on macOS
+RU_MAXRSS_BYTES = 1 if sys.platform == "darwin" else 1024
+# Non-greedy match of one product's JSON. Products on special end in a third }
+PRODUCT_JSON_REGEX = re.compile(
+    r"""
+    \{\"_type\"\:\"PRODUCT\"
+    .*?
+    \}\}\}?
+    """,
+    re.I | re.X,
+)
+
+
+def get_peak_rss_bytes() -> int:
+    """Peak resident set size of this process so far"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RU_MAXRSS_BYTES
+
+
+class StageTimer:
+    """Records the latency, documents processed and peak RSS growth of each stage"""
+
+    def __init__(self):
+        self.latencies_dict = {stage_name: [] for stage_name in STAGE_NAMES}
+        self.documents_dict = {stage_name: 0 for stage_name in STAGE_NAMES}
+        self.rss_growth_dict = {stage_name: 0 for stage_name in STAGE_NAMES}
+
+    @contextmanager
+    def time_stage(self, stage_name: str, documents_count: int):
+        """Time one call of a stage
+
+        Parameters:
+        1. stage_name: one of STAGE_NAMES
+        2. documents_count: number of documents the call processes
+        """
+        peak_rss_before_bytes = get_peak_rss_bytes()
+        start_seconds = time.perf_counter()
+        yield
+        self.latencies_dict[stage_name].append(time.perf_counter() - start_seconds)
+        self.documents_dict[stage_name] += documents_count
+        self.rss_growth_dict[stage_name] += get_peak_rss_bytes() - peak_rss_before_bytes
+
+    def build_report(self) -> dict:
+        """Summarise every stage that ran
+
+        Returns:
+        1. report_dict: {stage name: {calls, documents, seconds, docs_per_sec,
+            p50_ms, p95_ms, peak_rss_growth_mb}} plus the overall peak_rss_mb
+        """
+        stages_dict = {}
+        for stage_name in STAGE_NAMES:
+            latencies_list = self.latencies_dict[stage_name]
+            if not latencies_list:
+                continue
+            total_seconds = sum(latencies_list)
+            stages_dict[stage_name] = {
+                "calls": len(latencies_list),
+                "documents": self.documents_dict[stage_name],
+                "seconds": round(total_seconds, 3),
+                "docs_per_sec": round(self.documents_dict[stage_name] / total_seconds, 1),
+                "p50_ms": round(float(np.percentile(latencies_list, 50)) * 1000, 3),
+                "p95_ms": round(float(np.percentile(latencies_list, 95)) * 1000, 3),
+                "peak_rss_growth_mb": round(self.rss_growth_dict[stage_name] / 2**20, 1),
+            }
+        return {"stages": stages_dict, "peak_rss_mb": round(get_peak_rss_bytes() / 2**20, 1)}
+
+
+def get_mongodb_collection(mongodb_uri):
+    """Benchmark collection on MongoDB, or on mongomock without a uri"""
+    if mongodb_uri:
+        import pymongo
+        mongodb_client = pymongo.MongoClient(mongodb_uri)
+    else:
+        import mongomock
+        mongodb_client = mongomock.MongoClient()
+    return mongodb_client["supermarket_data"][BENCHMARK_COLLECTION_NAME]
+
+
+def get_redis_connection(redis_url):
+    """Redis client decoding responses like db_connection_funcs.get_redis_connection(),
+    or fakeredis without a url"""
+    if redis_url:
+        import redis
+        return redis.Redis.from_url(redis_url, decode_responses=True)
+    import fakeredis
+    return fakeredis.FakeRedis(decode_responses=True)
+
+
+def build_aggregate_dataframes(flattened_json_df: pd.DataFrame) -> tuple:
+    """Stand in for the data mart query results postgres_to_redis publishes,
+    built from a batch of flattened products
+
+    Returns:
+    1. product_prices_df, category_totals_df, current_specials_df
+    """
+    product_prices_df = pd.DataFrame(
+        {
+            "product_name": flattened_json_df["name"],
+            "pricing_date": flattened_json_df["date_extracted"],
+            "price_aud": flattened_json_df["pricing.now"],
+            "product_category": flattened_json_df["merchandiseHeir.category"],
+        }
+    ).dropna()
+    category_totals_df = (
+        product_prices_df.groupby(["product_category", "pricing_date"])["price_aud"]
+        .sum()
+        .rename("total_price_aud")
+        .reset_index()
+    )
+    specials_df = flattened_json_df[flattened_json_df["pricing.promotionType"].notna()]
+    current_specials_df = pd.DataFrame(
+        {
+            "product_name": specials_df["name"],
+            "product_category": specials_df["merchandiseHeir.category"],
+            "special_description": specials_df["pricing.offerDescription"],
+            "special_end_date_text": specials_df["pricing.promotionDescription"],
+            "special_type": specials_df["pricing.promotionType"],
+            "special_subtype": specials_df["pricing.specialType"],
+            "min_purchase_quantity": specials_df["pricing.multiBuyPromotion.minQuantity"],
+            "savings": specials_df["pricing.multiBuyPromotion.reward"],
+            "date_extracted": specials_df["date_extracted"],
+        }
+    )
+    return product_prices_df, category_totals_df, current_specials_df
+
+
+def extract_products_with_regex(webpage_text: str) -> list:
+    """The regex and json.loads parsing path product_extractor replaced.
+    Matches that are not valid JSON are skipped."""
+    products_list = []
+    for json_string in PRODUCT_JSON_REGEX.findall(webpage_text):
+        try:
+            products_list.append(json.loads(json_string))
+        except ValueError:
+            pass
+    return products_list
+
+
+def run_page_stages(stage_timer: StageTimer, webpage_url: str, session) -> list:
+    """Fetch and parse a single page, timing both parsing paths
+
+    Returns:
+    1. products_list: products on the page with date_extracted and an _id
+        added, as they would be read back from MongoDB
+    """
+    with stage_timer.time_stage("fetch", 0):
+        webpage_text = website_to_mongodb.extract_single_webpage_text(webpage_url, session)
+    with stage_timer.time_stage("regex_extraction", 0):
+        regex_products_list = extract_products_with_regex(webpage_text)
+    with stage_timer.time_stage("product_extractor", 0):
+        products_list = list(product_extractor.iter_products_from_webpage_text(webpage_text))
+    # Count the documents once the page is known to have them
+    for stage_name, stage_products_list in (
+        ("fetch", products_list),
+        ("regex_extraction", regex_products_list),
+        ("product_extractor", products_list),
+    ):
+        stage_timer.documents_dict[stage_name] += len(stage_products_list)
+    website_to_mongodb.append_date_extracted_to_json(products_list, DATE_EXTRACTED)
+    return products_list
+
+
+def run_batch_stages(
+    stage_timer: StageTimer,
+    products_list: list,
+    mongodb_collection,
+    sql_engine,
+    redis_connection,
+    batch_number: int,
+):
+    """Load a batch of products through MongoDB, PostgreSQL and Redis"""
+    documents_count = len(products_list)
+    expected_columns_list = test_mongodb_schema_change.get_expected_postgres_columns_list()
+    sql_data_types_dict = mongodb_to_postgres.define_column_data_types_for_sql()
+
+    with stage_timer.time_stage("mongodb_bulk_write", documents_count):
+        with BulkProductWriter(mongodb_collection, batch_size=documents_count) as bulk_writer:
+            bulk_writer.add(products_list)
+    # Keep the stand-in store from holding every batch in memory
+    mongodb_collection.drop()
+
+    documents_list = [dict(product_dict, _id=ObjectId()) for product_dict in products_list]
+    with stage_timer.time_stage("json_normalize", documents_count):
+        json_normalize_df = flatten_with_json_normalize(
+            documents_list, expected_columns_list, sql_data_types_dict
+        )
+    with stage_timer.time_stage("product_flattener", documents_count):
+        flattened_json_df, _ = ProductFlattener(
+            expected_columns_list, sql_data_types_dict
+        ).flatten(documents_list)
+
+    is_postgres = sql_engine.dialect.name == "postgresql"
+    if not is_postgres:
+        # SQLite's DATE only takes date objects, PostgreSQL parses the text
+        sql_data_types_dict = {
+            column_name: sql_data_type
+            for column_name, sql_data_type in sql_data_types_dict.items()
+            if not isinstance(sql_data_type, sqlalchemy.types.DATE)
+        }
+    with stage_timer.time_stage("to_sql", documents_count):
+        json_normalize_df.to_sql(
+            name=BENCHMARK_TABLE_NAME,
+            con=sql_engine,
+            if_exists="replace",
+            index=False,
+            method="multi",
+            chunksize=None if is_postgres else SQLITE_MAX_VARIABLES // len(expected_columns_list),
+            dtype=sql_data_types_dict,
+        )
+    if is_postgres:
+        postgres_connection = sql_engine.raw_connection()
+        try:
+            with stage_timer.time_stage("copy", documents_count):
+                with postgres_connection.cursor() as postgres_cursor:
+                    mongodb_to_postgres.copy_dataframe_to_postgres(
+                        postgres_cursor,
+                        flattened_json_df,
+                        expected_columns_list,
+                        schema_name="public",
+                        table_name=BENCHMARK_TABLE_NAME,
+                    )
+                postgres_connection.commit()
+        finally:
+            postgres_connection.close()
+
+    product_prices_df, category_totals_df, current_specials_df = build_aggregate_dataframes(
+        flattened_json_df
+    )
+    with stage_timer.time_stage("redis_publish", documents_count):
+        aggregates_version = postgres_to_redis.publish_price_aggregates(
+            redis_connection,
+            product_prices_df,
+            category_totals_df,
+            current_specials_df,
+            namespace=BENCHMARK_REDIS_NAMESPACE,
+            version=f"benchmark{batch_number}",
+        )
+    # Remove the batch's keys now rather than after the old version TTL
+    redis_publisher.expire_version(
+        redis_connection, BENCHMARK_REDIS_NAMESPACE, aggregates_version, ttl_seconds=0
+    )
+
+
+def print_report(report_dict: dict):
+    """Print the report as a table"""
+    print(
+        f"{'stage':<20}{'calls':>8}{'documents':>12}{'seconds':>10}"
+        f"{'docs/sec':>14}{'p50 ms':>10}{'p95 ms':>10}{'rss +MB':>9}"
+    )
+    for stage_name, stage_dict in report_dict["stages"].items():
+        print(
+            f"{stage_name:<20}{stage_dict['calls']:>8}{stage_dict['documents']:>12}"
+            f"{stage_dict['seconds']:>10.3f}{stage_dict['docs_per_sec']:>14,.0f}"
+            f"{stage_dict['p50_ms']:>10.2f}{stage_dict['p95_ms']:>10.2f}"
+            f"{stage_dict['peak_rss_growth_mb']:>9.1f}"
+        )
+    print(f"peak RSS: {report_dict['peak_rss_mb']} MB")
+
+
+def main():
+    """main"""
+    argument_parser = argparse.ArgumentParser(description=__doc__)
+    argument_parser.add_argument("--documents", type=int, default=100_000)
+    argument_parser.add_argument("--products-per-page", type=int, default=48)
+    argument_parser.add_argument("--batch-size", type=int, default=10_000)
+    argument_parser.add_argument("--seed", type=int, default=0)
+    argument_parser.add_argument("--pages-dir", help="replay pages saved by record_pages.py")
+    argument_parser.add_argument("--mongodb-uri")
+    argument_parser.add_argument("--postgres-uri")
+    argument_parser.add_argument("--redis-url")
+    argument_parser.add_argument("--json-report", help="also write the report to this file")
+    arguments = argument_parser.parse_args()
+
+    if arguments.pages_dir:
+        page_source = RecordedPages(arguments.pages_dir)
+    else:
+        page_source = SyntheticPages(
+            arguments.documents, arguments.products_per_page, arguments.seed
+        )
+    mongodb_collection = get_mongodb_collection(arguments.mongodb_uri)
+    sql_engine = sqlalchemy.create_engine(arguments.postgres_uri or "sqlite://")
+    redis_connection = get_redis_connection(arguments.redis_url)
+    stage_timer = StageTimer()
+
+    with StubWebsite(page_source) as stub_website:
+        session = website_to_mongodb.create_scraping_session()
+        webpages_list = website_to_mongodb.create_paginated_webpages_list(
+            base_url=stub_website.base_url,
+            additional_url=BENCHMARK_CATEGORY_PATH,
+            max_page=math.ceil(arguments.documents / arguments.products_per_page) + 1,
+        )
+        pending_products_list = []
+        documents_int = 0
+        batch_number = 0
+        for webpage_url in webpages_list:
+            products_list = run_page_stages(stage_timer, webpage_url, session)
+            if not products_list:
+                break
+            products_list = products_list[: arguments.documents - documents_int]
+            documents_int += len(products_list)
+            pending_products_list.extend(products_list)
+            if len(pending_products_list) >= arguments.batch_size or (
+                documents_int >= arguments.documents
+            ):
+                batch_number += 1
+                run_batch_stages(
+                    stage_timer,
+                    pending_products_list,
+                    mongodb_collection,
+                    sql_engine,
+                    redis_connection,
+                    batch_number,
+                )
+                pending_products_list = []
+            if documents_int >= arguments.documents:
+                break
+        if pending_products_list:
+            batch_number += 1
+            run_batch_stages(
+                stage_timer,
+                pending_products_list,
+                mongodb_collection,
+                sql_engine,
+                redis_connection,
+                batch_number,
+            )
+        session.close()
+
+    with sql_engine.begin() as sql_connection:
+        sql_connection.execute(sqlalchemy.text(f"DROP TABLE IF EXISTS {BENCHMARK_TABLE_NAME}"))
+    sql_engine.dispose()
+    redis_connection.delete(redis_publisher.get_version_pointer_key(BENCHMARK_REDIS_NAMESPACE))
+
+    report_dict = build_report_header(arguments, documents_int)
+    report_dict.update(stage_timer.build_report())
+    print_report(report_dict)
+    if arguments.json_report:
+        with open(arguments.json_report, "w", encoding="utf-8") as report_file:
+            json.dump(report_dict, report_file, indent=4)
+
+
+def build_report_header(arguments: argparse.Namespace, documents_int: int) -> dict:
+    """Settings the benchmark ran with, so reports can be compared"""
+    return {
+        "documents": documents_int,
+        "products_per_page": arguments.products_per_page,
+        "batch_size": arguments.batch_size,
+        "pages": "recorded" if arguments.pages_dir else "synthetic",
+        "mongodb": "mongodb" if arguments.mongodb_uri else "mongomock",
+        "sql": "postgresql" if arguments.postgres_uri else "sqlite",
+        "redis": "redis" if arguments.redis_url else "fakeredis",
+    }
+
+
+if __name__ == "__main__":
+    main()
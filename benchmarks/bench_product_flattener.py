@@ -0,0 +1,85 @@
+"""Benchmark of the schema aware ProductFlattener against the
+pd.json_normalize path it replaced in mongodb_to_postgres
+
+Run from the repository root:
+python benchmarks/bench_product_flattener.py --documents 100000
+
+Both paths start from the same list of synthetic documents and
+finish with a dataframe ready to be written as CSV for COPY.
+"""
+# Standard Library Imports
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "dags"))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+# 3rd Party Imports
+import pandas as pd
+
+# Custom modules
+from dag_scripts import mongodb_to_postgres
+from dag_scripts.product_flattener import ProductFlattener
+from dag_scripts.tests import test_mongodb_schema_change
+from synthetic_products import generate_product_documents
+
+
+def flatten_with_json_normalize(documents_list, expected_columns_list, sql_data_types_dict):
+    """The json_normalize, add specials, astype and format path"""
+    flattened_json_df = pd.json_normalize(documents_list)
+    flattened_json_df_w_specials = mongodb_to_postgres.add_specials_columns_if_not_present(
+        flattened_json_df
+    )
+    cleaned_data_types_df = mongodb_to_postgres.change_data_types_for_problem_columns(
+        flattened_json_df_w_specials
+    )
+    return mongodb_to_postgres.format_dataframe_for_copy(
+        cleaned_data_types_df, expected_columns_list, sql_data_types_dict
+    )
+
+
+def time_function(function, *args, repeats: int = 3) -> float:
+    """Best wall time in seconds out of a number of repeats"""
+    best_seconds = float("inf")
+    for _ in range(repeats):
+        start_seconds = time.perf_counter()
+        function(*args)
+        best_seconds = min(best_seconds, time.perf_counter() - start_seconds)
+    return best_seconds
+
+
+def main():
+    """main"""
+    argument_parser = argparse.ArgumentParser(description=__doc__)
+    argument_parser.add_argument("--documents", type=int, default=100_000)
+    argument_parser.add_argument("--repeats", type=int, default=3)
+    arguments = argument_parser.parse_args()
+
+    documents_list = list(generate_product_documents(arguments.documents))
+    expected_columns_list = test_mongodb_schema_change.get_expected_postgres_columns_list()
+    sql_data_types_dict = mongodb_to_postgres.define_column_data_types_for_sql()
+    product_flattener = ProductFlattener(expected_columns_list, sql_data_types_dict)
+
+    json_normalize_seconds = time_function(
+        flatten_with_json_normalize,
+        documents_list,
+        expected_columns_list,
+        sql_data_types_dict,
+        repeats=arguments.repeats,
+    )
+    flattener_seconds = time_function(
+        product_flattener.flatten, documents_list, repeats=arguments.repeats
+    )
+
+    print(f"documents: {arguments.documents}")
+    print(f"json_normalize path: {json_normalize_seconds:.3f} s "
+          f"({arguments.documents / json_normalize_seconds:,.0f} docs/s)")
+    print(f"ProductFlattener:    {flattener_seconds:.3f} s "
+          f"({arguments.documents / flattener_seconds:,.0f} docs/s)")
+    print(f"speed up: {json_normalize_seconds / flattener_seconds:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
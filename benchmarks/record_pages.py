@@ -0,0 +1,55 @@
+"""Saves pages from the Coles website so the ETL benchmark
+can replay them offline with RecordedPages
+
+Run from the repository root (this does send requests to the website):
+python benchmarks/record_pages.py --max-pages 5
+
+Pages are saved as <pages_dir>/<category>/page_<page number>.html for each
+category in the crawl manifest. Recording stops at the first page of a
+category without products. Pages are waited between like the crawl does.
+"""
+# Standard Library Imports
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "dags"))
+
+# Custom modules
+from dag_scripts import crawl_manifest, product_extractor, website_to_mongodb
+
+# Globals
+DEFAULT_PAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "recorded_pages")
+
+
+def main():
+    """main"""
+    argument_parser = argparse.ArgumentParser(description=__doc__)
+    argument_parser.add_argument("--pages-dir", default=DEFAULT_PAGES_DIR)
+    argument_parser.add_argument("--max-pages", type=int, default=5)
+    argument_parser.add_argument(
+        "--delay", type=float, default=website_to_mongodb.MIN_PAGE_REQUEST_DELAY
+    )
+    arguments = argument_parser.parse_args()
+
+    session = website_to_mongodb.create_scraping_session()
+    for category_crawl in crawl_manifest.plan_crawl(crawl_manifest.load_crawl_manifest()):
+        category_str = category_crawl.path.rstrip("/").rsplit("/", 1)[-1]
+        category_dir = os.path.join(arguments.pages_dir, category_str)
+        os.makedirs(category_dir, exist_ok=True)
+        webpages_list = website_to_mongodb.create_category_webpages_list(category_crawl)
+        for page_number, webpage_url in enumerate(webpages_list[: arguments.max_pages], 1):
+            webpage_text = website_to_mongodb.extract_single_webpage_text(webpage_url, session)
+            if not any(True for _ in product_extractor.iter_products_from_webpage_text(webpage_text)):
+                break
+            with open(
+                os.path.join(category_dir, f"page_{page_number}.html"), "w", encoding="utf-8"
+            ) as page_file:
+                page_file.write(webpage_text)
+            print(f"saved {webpage_url}")
+            time.sleep(arguments.delay)
+
+
+if __name__ == "__main__":
+    main()
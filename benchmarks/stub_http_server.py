@@ -0,0 +1,140 @@
+"""Local stand-in for the Coles website used by the ETL benchmark
+
+Serves pages over HTTP on 127.0.0.1 so the crawl code
+(create_scraping_session, extract_single_webpage_text) can be timed
+without sending a single request to the real website. The server runs in
+a forked child process so rendering pages does not add to the memory or
+hold the GIL of the process being measured.
+
+Pages come from a page source, a callable taking the request path and
+the page number and returning the html:
+
+1. SyntheticPages - pages rendered from synthetic products
+    (see synthetic_products.generate_product_page)
+2. RecordedPages - pages saved from the website by record_pages.py
+
+Example:
+with StubWebsite(SyntheticPages(10_000)) as stub_website:
+    session.get(stub_website.base_url + "/browse/fruit-vegetables?page=1")
+"""
+# Standard Library Imports
+import glob
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import multiprocessing
+import os
+from typing import Callable
+from urllib.parse import parse_qs, urlsplit
+
+# Custom modules
+from synthetic_products import generate_product_page
+
+# Globals
+STUB_HOST = "127.0.0.1"
+
+
+class SyntheticPages:
+    """Page source rendering every category from the same synthetic products
+
+    Parameters:
+    1. document_count: number of products in each category
+    2. products_per_page: number of products on a full page
+    3. seed: random seed so runs are repeatable
+    """
+
+    def __init__(self, document_count: int, products_per_page: int = 48, seed: int = 0):
+        self.document_count = document_count
+        self.products_per_page = products_per_page
+        self.seed = seed
+
+    def __call__(self, path: str, page_number: int) -> str:
+        return generate_product_page(
+            page_number, self.products_per_page, self.document_count, self.seed
+        )
+
+
+class RecordedPages:
+    """Page source replaying pages saved by record_pages.py
+    as <pages_dir>/<category>/page_<page number>.html
+
+    The recorded pages of every category are served in turn no matter which
+    category is asked for, starting again from the first once they run out,
+    so any number of documents can be replayed from a few recorded pages.
+
+    Parameters:
+    1. pages_dir: folder of recorded pages
+    """
+
+    def __init__(self, pages_dir: str):
+        self.page_paths_list = sorted(
+            glob.glob(os.path.join(pages_dir, "*", "page_*.html")),
+            key=lambda page_path: (
+                os.path.dirname(page_path),
+                int(os.path.basename(page_path)[len("page_"):-len(".html")]),
+            ),
+        )
+        if not self.page_paths_list:
+            raise FileNotFoundError(f"No recorded pages in {pages_dir}. Run record_pages.py first.")
+
+    def __call__(self, path: str, page_number: int) -> str:
+        page_path = self.page_paths_list[(page_number - 1) % len(self.page_paths_list)]
+        with open(page_path, encoding="utf-8") as page_file:
+            return page_file.read()
+
+
+class StubWebsite:
+    """HTTP server in a child process serving pages from a page source.
+    Use as a context manager - the server is stopped on exit.
+
+    Parameters:
+    1. page_source: callable taking (path, page number) and returning html
+    2. port: port to listen on. 0 picks a free port
+    """
+
+    def __init__(self, page_source: Callable[[str, int], str], port: int = 0):
+        self.page_source = page_source
+        # Bind before forking so the port is known to the parent
+        self.http_server = ThreadingHTTPServer((STUB_HOST, port), self._build_handler())
+        self.http_server.daemon_threads = True
+        self.server_process = multiprocessing.get_context("fork").Process(
+            target=self.http_server.serve_forever, daemon=True
+        )
+
+    @property
+    def base_url(self) -> str:
+        """Base url to crawl, such as http://127.0.0.1:45678"""
+        return f"http://{STUB_HOST}:{self.http_server.server_address[1]}"
+
+    def __enter__(self):
+        self.server_process.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.server_process.terminate()
+        self.server_process.join()
+        self.http_server.server_close()
+
+    def _build_handler(self):
+        stub_website = self
+
+        class StubPageHandler(BaseHTTPRequestHandler):
+            """Answers every GET with the page for its path and ?page= number"""
+
+            protocol_version = "HTTP/1.1" # keep-alive, as the website does
+            # Otherwise the body waits on the delayed ACK of the headers (~40 ms)
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                url_parts = urlsplit(self.path)
+                page_number = int(parse_qs(url_parts.query).get("page", ["1"])[0])
+                page_bytes = stub_website.page_source(url_parts.path, page_number).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(page_bytes)))
+                self.end_headers()
+                self.wfile.write(page_bytes)
+
+            def log_message(self, format, *args):
+                # Logging every request would be timed as part of the fetch stage
+                pass
+
+        return StubPageHandler
@@ -0,0 +1,157 @@
+"""Generates synthetic product documents shaped like the
+Coles product JSON stored in MongoDB
+
+Used by the benchmarks so they can run without scraping the website.
+Every key in the column contract is produced and roughly half the
+products are on special so the specials columns are filled in.
+
+Documents are yielded one at a time so millions can be generated
+without holding them all in memory. Pages of products can also be rendered
+as html, shaped like the Coles website, for the stub web server used by
+the ETL benchmark.
+"""
+# Standard Library Imports
+import json
+import random
+from typing import Iterator
+
+# 3rd Party Imports
+from bson import ObjectId
+
+CATEGORIES = ["Apples & Pears", "Citrus", "Berries", "Salad", "Hard Veg", "Soft Veg", "Herbs"]
+
+
+def generate_product_documents(
+    document_count: int, date_extracted: str = "2023-09-12", seed: int = 0
+) -> Iterator[dict]:
+    """Yield synthetic product documents
+
+    Parameters:
+    1. document_count: number of documents to generate
+    2. date_extracted: value for the date_extracted key
+    3. seed: random seed so runs are repeatable
+
+    Returns:
+    1. Generator of product documents
+    """
+    random_generator = random.Random(seed)
+    for product_id in range(document_count):
+        document = make_product_document(product_id, random_generator)
+        document["_id"] = ObjectId()
+        document["date_extracted"] = date_extracted
+        yield document
+
+
+def generate_product_page(
+    page_number: int, products_per_page: int, document_count: int, seed: int = 0
+) -> str:
+    """Render one page of a synthetic category as the Coles website would.
+    Pages past document_count have no products, which ends the crawl.
+
+    Each page has its own random generator so any page can be rendered
+    on its own, in any order, and is the same every time.
+
+    Parameters:
+    1. page_number: page to render, starting from 1
+    2. products_per_page: number of products on a full page
+    3. document_count: total number of products in the category
+    4. seed: random seed so runs are repeatable
+
+    Returns:
+    1. webpage_text: html of the page
+    """
+    random_generator = random.Random(seed * 1_000_003 + page_number)
+    first_product_id = (page_number - 1) * products_per_page
+    products_list = [
+        make_product_document(product_id, random_generator)
+        for product_id in range(
+            first_product_id, min(first_product_id + products_per_page, document_count)
+        )
+    ]
+    return render_product_page(products_list)
+
+
+def render_product_page(products_list: list) -> str:
+    """Embed products in a page the way the Coles website does,
+    inside the Next.js __NEXT_DATA__ JSON payload. The JSON is compact
+    (no spaces) like the website's, which the extraction regex relies on."""
+    next_data_dict = {
+        "props": {"pageProps": {"searchResults": {"results": products_list}}},
+        "page": "/browse/[slug]",
+    }
+    return (
+        "<!DOCTYPE html><html><head><title>Coles</title></head><body>"
+        '<div id="__next"></div>'
+        f'<script id="__NEXT_DATA__" type="application/json">{json.dumps(next_data_dict, separators=(",", ":"))}</script>'
+        "</body></html>"
+    )
+
+
+def make_product_document(product_id: int, random_generator: random.Random) -> dict:
+    """Make a single product as it appears on the website,
+    before MongoDB adds _id and the crawl adds date_extracted"""
+    price = round(random_generator.uniform(0.5, 20), 2)
+    document = {
+        "_type": "PRODUCT",
+        "id": product_id,
+        "adId": None,
+        "adSource": None,
+        "featured": random_generator.random() < 0.05,
+        "name": f"Product {product_id}",
+        "brand": "Coles",
+        "description": f"COLES PRODUCT {product_id} 1KG",
+        "size": "1kg",
+        "availability": True,
+        "availabilityType": "SHIPPING",
+        "imageUris": [{"altText": "", "type": "default", "uri": f"/{product_id}.jpg"}],
+        "locations": [{"aisle": str(random_generator.randint(1, 30)), "order": "1"}],
+        "onlineHeirs": [{"aisle": "Fruit", "category": "Fresh", "subCategory": "Apples"}],
+        "restrictions": {
+            "retailLimit": 20,
+            "promotionalLimit": 20,
+            "liquorAgeRestrictionFlag": False,
+            "tobaccoAgeRestrictionFlag": False,
+            "restrictedByOrganisation": False,
+            "delivery": [],
+        },
+        "merchandiseHeir": {
+            "tradeProfitCentre": "FRESH PROD",
+            "categoryGroup": "FRUIT",
+            "category": random_generator.choice(CATEGORIES),
+            "subCategory": "APPLES",
+            "className": "PINK LADY",
+        },
+        "pricing": {
+            "now": price,
+            "was": 0,
+            "unit": {
+                "quantity": 1,
+                "ofMeasureQuantity": 1,
+                "ofMeasureUnits": "kg",
+                "price": price,
+                "ofMeasureType": "kg",
+                "isWeighted": False,
+            },
+            "comparable": f"${price} per 1kg",
+            "onlineSpecial": False,
+        },
+    }
+    if random_generator.random() < 0.5:
+        document["internalDescription"] = "SPECIAL"
+        # pricing stays the last key as it is on the website
+        document["pricing"] = document.pop("pricing")
+        document["pricing"].update(
+            {
+                "promotionType": "SPECIAL",
+                "specialType": "MULTI_SAVE",
+                "offerDescription": "2 for $5",
+                "promotionDescription": "Until Tuesday",
+                "multiBuyPromotion": {
+                    "type": "MULTI_SAVE",
+                    "id": random_generator.randint(1, 500),
+                    "minQuantity": 2,
+                    "reward": 1.5,
+                },
+            }
+        )
+    return document
@@ -1,18 +1,52 @@
-"""Module to clear the mongodb staging collection
+"""Module to clear the mongodb staging area
 before grabbing the new week of data.
+
+Each crawl writes into its own run collection (see the staging_collections
+module), so clearing staging drops the run collections left behind by
+earlier runs. Dropping a collection is a single quick operation no matter
+how many documents it holds. The promoted supermarket_json collection is
+kept - it is replaced when this week's crawl is promoted, so a failed run
+leaves the last good staging data in place.
+
+If today's crawl was interrupted part way through (see the
+crawl_checkpoints module) today's run collection is kept so the crawl
+can resume from its last completed page instead of starting again.
 """
+# Standard Library Imports
+from datetime import date
+import logging
+from typing import Optional
+
 # Custom modules
-from dag_scripts.db_connections import db_connection_funcs
+from dag_scripts import crawl_checkpoints
+from dag_scripts import pipeline_metrics
+from dag_scripts import staging_collections
+from dag_scripts.db_connections import connection_manager, db_connection_funcs
 
 
-def main():
-    """main"""
-    mongodb_client = db_connection_funcs.get_mongodb_client()
+@pipeline_metrics.instrumented_task("clear_mongodb_staging")
+def main(run_date: Optional[str] = None):
+    """main
+
+    Parameters:
+    1. run_date: optional date of the run (YYYY-MM-DD) from
+        website_to_mongodb.plan_run(). Defaults to today
+    """
+    today_str = run_date or str(date.today())
+    mongodb_client = connection_manager.get_mongodb_client()
     mongo_database = db_connection_funcs.get_mongodb_database(mongodb_client)
-    mongodb_collection = db_connection_funcs.get_mongodb_collection(mongo_database)
-    # Clean the mongodb staging area from last run
-    mongodb_collection.delete_many({})
-    mongodb_client.close()
+    checkpoint_collection = crawl_checkpoints.get_checkpoint_collection(mongo_database)
+
+    if crawl_checkpoints.check_run_in_progress(checkpoint_collection, today_str):
+        logging.info(
+            "Crawl for %s is in progress. Keeping staging data so it can resume.",
+            today_str,
+        )
+        staging_collections.drop_stale_run_collections(mongo_database, keep_run_date=today_str)
+    else:
+        # Clean the mongodb staging area from last run
+        staging_collections.drop_stale_run_collections(mongo_database)
+        crawl_checkpoints.clear_checkpoints(checkpoint_collection)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,125 @@
+"""Checkpoints that record how far the website crawl got
+so an interrupted crawl can be resumed instead of starting from page 1
+
+Checkpoints are stored in MongoDB next to the staging collection, with one
+document per run date and category:
+
+{
+    "_id": "2023-09-12:fruit-vegetables",
+    "run_date": "2023-09-12",
+    "category": "fruit-vegetables",
+    "last_completed_page": 25,
+    "finished": false
+}
+
+A page is only checkpointed after its products are loaded into MongoDB.
+clear_mongodb_staging uses the checkpoints to keep the staging data
+when today's crawl was interrupted part way through.
+"""
+# Standard Library Imports
+from typing import Optional
+
+# Globals
+CHECKPOINT_COLLECTION_NAME = "crawl_checkpoints"
+
+
+def get_checkpoint_collection(
+    mongodb_database, coll_name: str = CHECKPOINT_COLLECTION_NAME
+):
+    """Connect to the checkpoints collection in the MongoDB database
+
+    Parameters:
+    1. mongodb_database: MongoDB database from db_connection_funcs.get_mongodb_database()
+    2. coll_name: collection name for the checkpoints
+
+    Returns:
+    1. collection: connection to the checkpoints collection
+    """
+    return mongodb_database[coll_name]
+
+
+def get_checkpoint_id(run_date: str, category_name: str) -> str:
+    """Build the checkpoint document id for a run date and category"""
+    return f"{run_date}:{category_name}"
+
+
+def get_checkpoint(checkpoint_collection, run_date: str, category_name: str) -> Optional[dict]:
+    """Get the checkpoint for a run date and category
+
+    Returns:
+    1. checkpoint: checkpoint document or None if the category has not been started
+    """
+    return checkpoint_collection.find_one(
+        {"_id": get_checkpoint_id(run_date, category_name)}
+    )
+
+
+def get_resume_page(checkpoint: Optional[dict]) -> int:
+    """Get the page number the crawl for a category should start from
+
+    Parameters:
+    1. checkpoint: checkpoint document from get_checkpoint() or None
+
+    Returns:
+    1. page number to start from - page 1 when there is no checkpoint
+    """
+    if checkpoint is None:
+        return 1
+    return checkpoint["last_completed_page"] + 1
+
+
+def mark_page_completed(
+    checkpoint_collection, run_date: str, category_name: str, page_number: int
+):
+    """Record that a page's products were loaded into MongoDB
+
+    $max is used so pages finishing out of order can not move the
+    checkpoint backwards.
+    """
+    checkpoint_collection.update_one(
+        {"_id": get_checkpoint_id(run_date, category_name)},
+        {
+            "$max": {"last_completed_page": page_number},
+            "$setOnInsert": {
+                "run_date": run_date,
+                "category": category_name,
+                "finished": False,
+            },
+        },
+        upsert=True,
+    )
+
+
+def mark_category_finished(checkpoint_collection, run_date: str, category_name: str):
+    """Record that every page for a category was crawled"""
+    checkpoint_collection.update_one(
+        {"_id": get_checkpoint_id(run_date, category_name)},
+        {
+            "$set": {"finished": True},
+            "$setOnInsert": {
+                "run_date": run_date,
+                "category": category_name,
+                "last_completed_page": 0,
+            },
+        },
+        upsert=True,
+    )
+
+
+def check_run_in_progress(checkpoint_collection, run_date: str) -> bool:
+    """Check if the crawl for a run date was started but not finished
+
+    Returns:
+    1. True if at least one category for the run date is unfinished, False if not
+    """
+    unfinished_checkpoint = checkpoint_collection.find_one(
+        {"run_date": run_date, "finished": False}
+    )
+    return unfinished_checkpoint is not None
+
+
+def clear_checkpoints(checkpoint_collection):
+    """Remove every checkpoint. Called when the staging data is cleared
+    as the checkpoints no longer describe what is in staging.
+    """
+    checkpoint_collection.delete_many({})
@@ -0,0 +1,98 @@
+"""Loads the category manifest that defines which parts of the
+Coles website are crawled and plans the crawl order.
+
+The manifest lives in config/crawl_manifest.json so new categories can be
+added (or switched off) without changing any code. Each category has:
+
+1. name: short name for the category, used in logs and checkpoints
+2. path: url path for the category - such as /browse/fruit-vegetables
+3. max_page: page ceiling for the category. Pagination stops earlier
+    if a page has no products
+4. priority: categories with a lower number are crawled first
+5. enabled: optional, defaults to true. Set to false to skip a category
+"""
+# Standard Library Imports
+import json
+import os
+from typing import List, NamedTuple
+
+# Globals
+DEFAULT_MANIFEST_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+    "config",
+    "crawl_manifest.json",
+)
+REQUIRED_CATEGORY_KEYS = {"name", "path", "max_page", "priority"}
+
+
+class CategoryCrawl(NamedTuple):
+    """A single category to crawl as planned from the manifest"""
+
+    name: str
+    path: str
+    max_page: int
+    priority: int
+    base_url: str = "https://www.coles.com.au"
+    pagination_str: str = "?page="
+
+
+def load_crawl_manifest(manifest_path: str = DEFAULT_MANIFEST_PATH) -> dict:
+    """Read and validate the crawl manifest
+
+    Parameters:
+    1. manifest_path: path to the JSON manifest file
+
+    Returns:
+    1. manifest_dict: the manifest as a dictionary
+    """
+    with open(manifest_path, encoding="utf-8") as manifest_file:
+        manifest_dict = json.load(manifest_file)
+
+    if not manifest_dict.get("categories"):
+        raise ValueError(f"No categories defined in crawl manifest {manifest_path}")
+
+    for category_dict in manifest_dict["categories"]:
+        missing_keys_set = REQUIRED_CATEGORY_KEYS.difference(category_dict)
+        if missing_keys_set:
+            raise ValueError(
+                f"Category {category_dict} in crawl manifest is missing {sorted(missing_keys_set)}"
+            )
+        if int(category_dict["max_page"]) < 1:
+            raise ValueError(f"max_page must be at least 1 for category {category_dict['name']}")
+    return manifest_dict
+
+
+def plan_crawl(manifest_dict: dict) -> List[CategoryCrawl]:
+    """Turn the manifest into an ordered list of categories to crawl
+
+    Disabled categories are dropped and the rest are sorted by priority
+    (then name so the order is stable between runs).
+
+    Parameters:
+    1. manifest_dict: manifest from load_crawl_manifest()
+
+    Returns:
+    1. crawl_plan_list: list of CategoryCrawl tuples in crawl order
+    """
+    base_url = manifest_dict.get("base_url", CategoryCrawl._field_defaults["base_url"])
+    pagination_str = manifest_dict.get(
+        "pagination_str", CategoryCrawl._field_defaults["pagination_str"]
+    )
+    enabled_categories_list = [
+        category_dict
+        for category_dict in manifest_dict["categories"]
+        if category_dict.get("enabled", True)
+    ]
+    crawl_plan_list = [
+        CategoryCrawl(
+            name=category_dict["name"],
+            path=category_dict["path"],
+            max_page=int(category_dict["max_page"]),
+            priority=int(category_dict["priority"]),
+            base_url=base_url,
+            pagination_str=pagination_str,
+        )
+        for category_dict in enabled_categories_list
+    ]
+    crawl_plan_list.sort(key=lambda category_crawl: (category_crawl.priority, category_crawl.name))
+    return crawl_plan_list
@@ -0,0 +1,236 @@
+"""Process-wide pooled connections to MongoDB, PostgreSQL and Redis
+
+Creating a client for every task (or every test) spends most of a short
+task connecting and authenticating. The connection manager instead creates
+each client the first time it is needed and then shares it, along with its
+connection pool, for the rest of the process:
+
+1. MongoDB - one pymongo.MongoClient, which pools its own connections and
+    checks the server with its heartbeat
+2. PostgreSQL - one sqlalchemy engine with a QueuePool. Connections are
+    pinged before they are handed out and recycled every
+    POSTGRES_POOL_RECYCLE_SECONDS so a dropped connection is replaced
+    rather than failing a query
+3. Redis - one redis.Redis client on a shared ConnectionPool, health checked
+    after HEALTH_CHECK_INTERVAL_SECONDS of idle time
+
+Clients are keyed by their connection settings, so asking for a different
+host or database gives a different client.
+
+Connections can not be shared with a forked child process (such as the
+mongodb_to_postgres export processes). The manager notices when it is used
+from a new process ID and creates new clients there.
+
+Pooled clients are not closed by the code using them. Use the context
+managers, which hand back Postgres connections to the pool on exit:
+
+with connection_manager.mongodb_collection() as mongodb_collection:
+    mongodb_collection.count_documents({})
+with connection_manager.postgresql_connection() as postgres_connection:
+    postgres_connection.execute(text("SELECT 1"))
+with connection_manager.redis_connection() as redis_conn:
+    redis_conn.get("current_weekly_price_all_items")
+"""
+# Standard Library Imports
+from contextlib import contextmanager
+import logging
+import os
+import threading
+
+# 3rd Party Imports
+from sqlalchemy import text
+from sqlalchemy.pool import QueuePool
+
+# Custom modules
+from dag_scripts.db_connections import db_connection_funcs
+
+# Globals
+MONGODB_MAX_POOL_SIZE = 20
+MONGODB_MIN_POOL_SIZE = 0
+MONGODB_MAX_IDLE_TIME_MS = 5 * 60 * 1000
+MONGODB_CONNECT_TIMEOUT_MS = 5000
+MONGODB_SERVER_SELECTION_TIMEOUT_MS = 10000
+POSTGRES_POOL_SIZE = 5
+POSTGRES_MAX_OVERFLOW = 10
+POSTGRES_POOL_TIMEOUT_SECONDS = 30
+POSTGRES_POOL_RECYCLE_SECONDS = 30 * 60
+REDIS_MAX_CONNECTIONS = 20
+REDIS_SOCKET_TIMEOUT_SECONDS = 5
+HEALTH_CHECK_INTERVAL_SECONDS = 30
+
+
+class ConnectionManager:
+    """Lazily creates and shares pooled database clients within a process"""
+
+    def __init__(self):
+        self.clients_dict = {}
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+
+    def get_mongodb_client(self, **connection_kwargs):
+        """Get the pooled MongoDB client. Do not close it.
+
+        Parameters:
+        1. connection_kwargs: host, port, user and pw as in
+            db_connection_funcs.get_mongodb_client()
+        """
+        return self._get_client(
+            "mongodb",
+            connection_kwargs,
+            lambda: db_connection_funcs.get_mongodb_client(
+                **connection_kwargs,
+                maxPoolSize=MONGODB_MAX_POOL_SIZE,
+                minPoolSize=MONGODB_MIN_POOL_SIZE,
+                maxIdleTimeMS=MONGODB_MAX_IDLE_TIME_MS,
+                connectTimeoutMS=MONGODB_CONNECT_TIMEOUT_MS,
+                serverSelectionTimeoutMS=MONGODB_SERVER_SELECTION_TIMEOUT_MS,
+            ),
+        )
+
+    def get_postgresql_engine(self, **connection_kwargs):
+        """Get the pooled PostgreSQL engine. Do not dispose of it.
+
+        Parameters:
+        1. connection_kwargs: host, database, user, password and port as in
+            db_connection_funcs.create_postgresql_engine()
+        """
+        return self._get_client(
+            "postgresql",
+            connection_kwargs,
+            lambda: db_connection_funcs.create_postgresql_engine(
+                **connection_kwargs,
+                poolclass=QueuePool,
+                pool_size=POSTGRES_POOL_SIZE,
+                max_overflow=POSTGRES_MAX_OVERFLOW,
+                pool_timeout=POSTGRES_POOL_TIMEOUT_SECONDS,
+                pool_recycle=POSTGRES_POOL_RECYCLE_SECONDS,
+                pool_pre_ping=True,
+            ),
+        )
+
+    def get_redis_connection(self, **connection_kwargs):
+        """Get the Redis client on the shared connection pool. Do not close it.
+
+        Parameters:
+        1. connection_kwargs: host, port and decode_responses as in
+            db_connection_funcs.get_redis_connection()
+        """
+        return self._get_client(
+            "redis",
+            connection_kwargs,
+            lambda: db_connection_funcs.get_redis_connection(
+                **connection_kwargs,
+                max_connections=REDIS_MAX_CONNECTIONS,
+                socket_timeout=REDIS_SOCKET_TIMEOUT_SECONDS,
+                socket_connect_timeout=REDIS_SOCKET_TIMEOUT_SECONDS,
+                health_check_interval=HEALTH_CHECK_INTERVAL_SECONDS,
+                retry_on_timeout=True,
+            ),
+        )
+
+    @contextmanager
+    def mongodb_collection(
+        self,
+        coll_name: str = "supermarket_json",
+        db_name: str = "supermarket_data",
+        **connection_kwargs,
+    ):
+        """Context manager giving a collection on the pooled MongoDB client"""
+        mongodb_database = db_connection_funcs.get_mongodb_database(
+            self.get_mongodb_client(**connection_kwargs), db_name
+        )
+        yield db_connection_funcs.get_mongodb_collection(mongodb_database, coll_name)
+
+    @contextmanager
+    def postgresql_connection(self, **connection_kwargs):
+        """Context manager giving a sqlalchemy connection from the pool.
+        The connection is returned to the pool on exit."""
+        with self.get_postgresql_engine(**connection_kwargs).connect() as postgres_connection:
+            yield postgres_connection
+
+    @contextmanager
+    def postgresql_raw_connection(self, **connection_kwargs):
+        """Context manager giving a psycopg2 connection from the pool,
+        for cursors and COPY. The connection is returned to the pool on exit."""
+        postgres_connection = self.get_postgresql_engine(**connection_kwargs).raw_connection()
+        try:
+            yield postgres_connection
+        finally:
+            postgres_connection.close()
+
+    @contextmanager
+    def redis_connection(self, **connection_kwargs):
+        """Context manager giving the Redis client on the shared connection pool"""
+        yield self.get_redis_connection(**connection_kwargs)
+
+    def check_health(self) -> dict:
+        """Ping every client created so far
+
+        Returns:
+        1. {client kind: True if every client of that kind answered}
+        """
+        with self.lock:
+            self._reset_after_fork()
+            clients_list = list(self.clients_dict.items())
+        health_dict = {}
+        for (client_kind, _), client in clients_list:
+            try:
+                if client_kind == "mongodb":
+                    client.admin.command("ping")
+                elif client_kind == "postgresql":
+                    with client.connect() as postgres_connection:
+                        postgres_connection.execute(text("SELECT 1"))
+                else:
+                    client.ping()
+                healthy = True
+            except Exception as error:
+                logging.warning("%s health check failed: %s", client_kind, error)
+                healthy = False
+            health_dict[client_kind] = health_dict.get(client_kind, True) and healthy
+        return health_dict
+
+    def close_all(self):
+        """Close every client. They are created again when next asked for."""
+        with self.lock:
+            clients_dict = self.clients_dict
+            self.clients_dict = {}
+        for (client_kind, _), client in clients_dict.items():
+            if client_kind == "postgresql":
+                client.dispose()
+            else:
+                client.close()
+
+    def _get_client(self, client_kind: str, connection_kwargs: dict, create_client):
+        """Get a client, creating it the first time its settings are asked for"""
+        client_key = (client_kind, tuple(sorted(connection_kwargs.items())))
+        with self.lock:
+            self._reset_after_fork()
+            if client_key not in self.clients_dict:
+                self.clients_dict[client_key] = create_client()
+            return self.clients_dict[client_key]
+
+    def _reset_after_fork(self):
+        """Forget the parent process's clients in a forked child.
+        The lock must already be held."""
+        if os.getpid() == self.pid:
+            return
+        for (client_kind, _), client in self.clients_dict.items():
+            if client_kind == "postgresql":
+                # Leave the parent's sockets open - closing them here would
+                # close them for the parent as well
+                client.dispose(close=False)
+        self.clients_dict = {}
+        self.pid = os.getpid()
+
+
+CONNECTION_MANAGER = ConnectionManager()
+
+get_mongodb_client = CONNECTION_MANAGER.get_mongodb_client
+get_postgresql_engine = CONNECTION_MANAGER.get_postgresql_engine
+get_redis_connection = CONNECTION_MANAGER.get_redis_connection
+mongodb_collection = CONNECTION_MANAGER.mongodb_collection
+postgresql_connection = CONNECTION_MANAGER.postgresql_connection
+postgresql_raw_connection = CONNECTION_MANAGER.postgresql_raw_connection
+redis_connection = CONNECTION_MANAGER.redis_connection
+check_health = CONNECTION_MANAGER.check_health
+close_all = CONNECTION_MANAGER.close_all
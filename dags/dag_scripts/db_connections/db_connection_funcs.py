@@ -18,7 +18,7 @@ from sqlalchemy import create_engine
 
 
 def get_mongodb_client(
-    host: str = "mongodb", port: str = "27017",user="root",pw="root"
+    host: str = "mongodb", port: str = "27017",user="root",pw="root", **client_kwargs
 ):
     """Connct to a mongo db database using the pymongo library
 
@@ -30,12 +30,15 @@ def get_mongodb_client(
     Parameters:
     1. host: host name in mongodb
     2. port: port for MongoDB to connect to
+    3. user: MongoDB username
+    4. pw: MongoDB password
+    5. client_kwargs: extra pymongo.MongoClient options such as maxPoolSize
 
     Returns:
     1. client: connection to a specific MongoDB collection
     """
-    connection_string = (f"mongodb://{user}:{pw}@{host}:{port}/",)
-    client = pymongo.MongoClient(connection_string)
+    connection_string = f"mongodb://{user}:{pw}@{host}:{port}/"
+    client = pymongo.MongoClient(connection_string, **client_kwargs)
 
     return client
 
@@ -93,6 +96,7 @@ def create_postgresql_engine(
     user="postgres",
     password="postgres",
     port="5432",
+    **engine_kwargs,
 ):
     """Creates a connection to the target PostgreSQL database
 
@@ -101,29 +105,35 @@ def create_postgresql_engine(
     2. database: Database within PostgreSQL to connect to
     3. user: Database username
     4. password: Database password
+    5. port: PostgreSQL port
+    6. engine_kwargs: extra sqlalchemy create_engine options such as pool_size
 
     Returns:
     1. engine: sqlalchemy engine to use to connect to PostgreSQL
     """
 
     engine = create_engine(
-        f"postgresql+psycopg2://{user}:{password}@{host}:{port}/{database}"
+        f"postgresql+psycopg2://{user}:{password}@{host}:{port}/{database}",
+        **engine_kwargs,
     )
     return engine
 
 
-def get_redis_connection(host="redis_project_data", port=6379, decode_responses=True):
+def get_redis_connection(
+    host="redis_project_data", port=6379, decode_responses=True, **redis_kwargs
+):
     """Connect to the redis database
 
     Input Parameters:
     1. Host
     2. Port
     3. Decode responses
+    4. Extra redis.Redis options such as max_connections
 
     Returns
     1. Connection to the redis database
     """
     redis_connection = redis.Redis(
-        host=host, port=port, decode_responses=decode_responses
+        host=host, port=port, decode_responses=decode_responses, **redis_kwargs
     )
     return redis_connection
@@ -0,0 +1,481 @@
+"""Read-through cache client for the price data published to Redis
+
+Consumers such as dashboards use this client rather than building their own
+Redis and PostgreSQL access. Each lookup is served from the first layer
+that has it:
+
+1. An in-process LRU cache
+2. The Redis aggregates published by postgres_to_redis, read through the
+    current version pointer
+3. The mart_pricing_over_time table in PostgreSQL. Results are written back
+    to Redis and the LRU so the next lookup does not reach PostgreSQL
+
+Lookups take a list of names so a dashboard showing many products makes one
+Redis round trip and one PostgreSQL query rather than one per product.
+Concurrent lookups of the same name are single-flighted: only one thread
+queries PostgreSQL and the others wait for its result, so a burst of
+requests for an uncached product cannot stampede the database.
+
+The current specials are a single hash of {product name: JSON details},
+read through the same three layers by get_current_specials().
+
+Hits and misses for each layer are counted and returned by get_stats().
+
+The queries and Redis keys of the aggregates are defined once here and
+shared with postgres_to_redis, which publishes them.
+
+Example:
+price_cache_client = PriceCacheClient()
+price_cache_client.get_product_price("Apple", "2023-09-12")
+price_cache_client.get_product_price_histories(["Apple", "Banana"])
+price_cache_client.get_current_specials()
+"""
+# Standard Library Imports
+from collections import Counter, OrderedDict
+import json
+import threading
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+# 3rd Party Imports
+import pandas as pd
+from sqlalchemy import bindparam, text
+
+# Custom modules
+from dag_scripts.db_connections import connection_manager
+from dag_scripts.redis_publisher import (
+    REDIS_NAMESPACE,
+    build_versioned_key,
+    get_current_version,
+)
+
+# Globals
+LRU_MAX_ENTRIES = 10000
+VERSION_REFRESH_SECONDS = 30
+FILLED_KEY_TTL_SECONDS = 24 * 60 * 60
+
+
+class CachedAggregate(NamedTuple):
+    """How one kind of aggregate is stored in Redis and loaded from PostgreSQL
+
+    1. kind: name used in LRU keys and stats
+    2. redis_key_parts: builds the key parts (after namespace and version)
+        of the hash holding {pricing date: value} for a name
+    3. name_column: mart column the aggregate is looked up by
+    4. sql_template: query returning (name, pricing date, value) rows
+        for the names matching {names_filter} (see build_sql_query())
+    """
+
+    kind: str
+    redis_key_parts: Callable[[str], tuple]
+    name_column: str
+    sql_template: str
+
+    def build_sql_query(self, names_list_bound: bool = True):
+        """Build the aggregate's query as a sqlalchemy text clause
+
+        Parameters:
+        1. names_list_bound: True for the rows of the names bound to :names_list,
+            False for the rows of every name (as published by postgres_to_redis)
+        """
+        if not names_list_bound:
+            return text(self.sql_template.format(names_filter=f"{self.name_column} IS NOT NULL"))
+        return text(
+            self.sql_template.format(names_filter=f"{self.name_column} IN :names_list")
+        ).bindparams(bindparam("names_list", expanding=True))
+
+
+# If two products share a name the lower price is used
+PRODUCT_PRICES = CachedAggregate(
+    "product_prices",
+    lambda product_name: ("product", product_name, "prices"),
+    "product_name",
+    """SELECT
+    product_name,
+    pricing_date,
+    MIN(price_aud) AS price_aud
+    FROM
+    mart_pricing_over_time
+    WHERE
+    {names_filter}
+    AND pricing_date IS NOT NULL
+    AND price_aud IS NOT NULL
+    GROUP BY
+    product_name,
+    pricing_date""",
+)
+
+CATEGORY_TOTALS = CachedAggregate(
+    "category_totals",
+    lambda product_category: ("category", product_category, "weekly_totals"),
+    "product_category",
+    """SELECT
+    product_category,
+    pricing_date,
+    SUM(price_aud) AS total_price_aud
+    FROM
+    mart_pricing_over_time
+    WHERE
+    {names_filter}
+    AND pricing_date IS NOT NULL
+    GROUP BY
+    product_category,
+    pricing_date""",
+)
+
+CURRENT_SPECIALS_KEY_PARTS = ("specials", "current")
+CURRENT_SPECIALS_SQL_QUERY = text(
+    """SELECT
+    product_name,
+    product_category,
+    special_description,
+    special_end_date_text,
+    special_type,
+    special_subtype,
+    min_purchase_quantity,
+    savings,
+    date_extracted
+    FROM
+    mart_specials_over_time
+    WHERE
+    product_name IS NOT NULL
+    AND date_extracted =
+    (SELECT
+        (MAX(date_extracted))
+    FROM
+    mart_specials_over_time)"""
+)
+
+
+def build_current_specials(current_specials_df: pd.DataFrame) -> Dict[str, dict]:
+    """Get {product name: special details} from the result of
+    CURRENT_SPECIALS_SQL_QUERY. Missing values are None."""
+    specials_records_list = current_specials_df.astype(object).where(
+        current_specials_df.notna(), None
+    ).to_dict("records")
+    return {
+        special_record["product_name"]: special_record for special_record in specials_records_list
+    }
+
+
+def encode_special_details(special_details_dict: dict) -> str:
+    """Special details as stored in the CURRENT_SPECIALS_KEY_PARTS hash.
+    Dates are written as strings."""
+    return json.dumps(special_details_dict, default=str)
+
+
+class LRUCache:
+    """Thread safe least recently used cache
+
+    Parameters:
+    1. max_entries: number of entries kept before the least recently used is dropped
+    """
+
+    def __init__(self, max_entries: int = LRU_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries_dict = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries_dict)
+
+    def get(self, key):
+        """Get a cached value, or None if the key is not cached"""
+        with self.lock:
+            if key not in self.entries_dict:
+                return None
+            self.entries_dict.move_to_end(key)
+            return self.entries_dict[key]
+
+    def put(self, key, value):
+        """Cache a value, dropping the least recently used entry if full"""
+        with self.lock:
+            self.entries_dict[key] = value
+            self.entries_dict.move_to_end(key)
+            while len(self.entries_dict) > self.max_entries:
+                self.entries_dict.popitem(last=False)
+
+    def clear(self):
+        """Drop every entry"""
+        with self.lock:
+            self.entries_dict.clear()
+
+
+class InFlightLoad:
+    """A PostgreSQL load other threads can wait for"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class PriceCacheClient:
+    """Read-through cache of the published price aggregates
+
+    Parameters:
+    1. redis_connection: optional connection. Defaults to
+        connection_manager.get_redis_connection()
+    2. postgres_engine: optional sqlalchemy engine. Defaults to
+        connection_manager.get_postgresql_engine()
+    3. namespace: namespace the aggregates were published under
+    4. lru_max_entries: size of the in-process cache
+    """
+
+    def __init__(
+        self,
+        redis_connection=None,
+        postgres_engine=None,
+        namespace: str = REDIS_NAMESPACE,
+        lru_max_entries: int = LRU_MAX_ENTRIES,
+    ):
+        self.redis_connection = redis_connection or connection_manager.get_redis_connection()
+        self.postgres_engine = postgres_engine or connection_manager.get_postgresql_engine()
+        self.namespace = namespace
+        self.lru_cache = LRUCache(lru_max_entries)
+        self.stats_counter = Counter()
+        self.in_flight_dict = {}
+        self.lock = threading.Lock()
+        self.version = None
+        self.version_checked_at = None
+
+    def get_stats(self) -> dict:
+        """Hit and miss counts for each layer, such as lru_hits and postgres_loads"""
+        with self.lock:
+            return dict(self.stats_counter)
+
+    def get_product_price_histories(self, product_names_list: List[str]) -> Dict[str, dict]:
+        """Get the price history of several products
+
+        Returns:
+        1. {product name: {pricing date: price}}. Unknown products have an empty history
+        """
+        return self._get_many(PRODUCT_PRICES, product_names_list)
+
+    def get_product_price_history(self, product_name: str) -> dict:
+        """Get the price history of a product as {pricing date: price}"""
+        return self.get_product_price_histories([product_name])[product_name]
+
+    def get_product_price(self, product_name: str, pricing_date: str) -> Optional[float]:
+        """Get the price of a product on a pricing date, or None if there is no price"""
+        return self.get_product_price_history(product_name).get(str(pricing_date))
+
+    def get_category_weekly_totals_many(self, categories_list: List[str]) -> Dict[str, dict]:
+        """Get the weekly total price of several categories
+
+        Returns:
+        1. {category: {pricing date: total price}}. Unknown categories have no totals
+        """
+        return self._get_many(CATEGORY_TOTALS, categories_list)
+
+    def get_category_weekly_totals(self, product_category: str) -> dict:
+        """Get the weekly totals of a category as {pricing date: total price}"""
+        return self.get_category_weekly_totals_many([product_category])[product_category]
+
+    def get_category_total(self, product_category: str, pricing_date: str) -> Optional[float]:
+        """Get the total price of a category for a week, or None if there is no total"""
+        return self.get_category_weekly_totals(product_category).get(str(pricing_date))
+
+    def get_current_specials(self) -> Dict[str, dict]:
+        """Get the specials on the latest extraction date
+
+        Returns:
+        1. {product name: special details dictionary}
+        """
+        version = self.get_current_version()
+        lru_key = ("current_specials", version, None)
+        specials_dict = self.lru_cache.get(lru_key)
+        if specials_dict is not None:
+            self._count("lru_hits")
+            return specials_dict
+        self._count("lru_misses")
+
+        if version is not None:
+            specials_hash_dict = self.redis_connection.hgetall(
+                build_versioned_key(self.namespace, version, *CURRENT_SPECIALS_KEY_PARTS)
+            )
+            if specials_hash_dict:
+                self._count("redis_hits")
+                specials_dict = {
+                    product_name: json.loads(special_json)
+                    for product_name, special_json in specials_hash_dict.items()
+                }
+                self.lru_cache.put(lru_key, specials_dict)
+                return specials_dict
+            self._count("redis_misses")
+
+        specials_json_dict = self._load_current_specials_from_postgres()
+        self._count("postgres_loads")
+        if version is not None and specials_json_dict:
+            redis_key = build_versioned_key(self.namespace, version, *CURRENT_SPECIALS_KEY_PARTS)
+            redis_pipeline = self.redis_connection.pipeline(transaction=False)
+            redis_pipeline.hset(redis_key, mapping=specials_json_dict)
+            redis_pipeline.expire(redis_key, FILLED_KEY_TTL_SECONDS)
+            redis_pipeline.execute()
+        specials_dict = {
+            product_name: json.loads(special_json)
+            for product_name, special_json in specials_json_dict.items()
+        }
+        self.lru_cache.put(lru_key, specials_dict)
+        return specials_dict
+
+    def get_current_version(self) -> Optional[str]:
+        """Get the published version, checking Redis at most
+        every VERSION_REFRESH_SECONDS"""
+        now = time.monotonic()
+        with self.lock:
+            if (
+                self.version_checked_at is not None
+                and now - self.version_checked_at < VERSION_REFRESH_SECONDS
+            ):
+                return self.version
+        version = get_current_version(self.redis_connection, self.namespace)
+        with self.lock:
+            self.version = version
+            self.version_checked_at = now
+        return version
+
+    def _count(self, stat_name: str, count_int: int = 1):
+        """Add to a hit or miss counter"""
+        if count_int:
+            with self.lock:
+                self.stats_counter[stat_name] += count_int
+
+    def _redis_key(self, aggregate: CachedAggregate, version: str, name: str) -> str:
+        """Versioned Redis key of a name's hash"""
+        return build_versioned_key(self.namespace, version, *aggregate.redis_key_parts(name))
+
+    def _get_many(self, aggregate: CachedAggregate, names_list: List[str]) -> Dict[str, dict]:
+        """Look up names in the LRU, then Redis, then PostgreSQL"""
+        unique_names_list = list(dict.fromkeys(names_list))
+        version = self.get_current_version()
+        values_dict = {}
+
+        missing_names_list = []
+        for name in unique_names_list:
+            value = self.lru_cache.get((aggregate.kind, version, name))
+            if value is None:
+                missing_names_list.append(name)
+            else:
+                values_dict[name] = value
+        self._count("lru_hits", len(values_dict))
+        self._count("lru_misses", len(missing_names_list))
+
+        if missing_names_list and version is not None:
+            redis_values_dict = self._read_from_redis(aggregate, version, missing_names_list)
+            for name, value in redis_values_dict.items():
+                self.lru_cache.put((aggregate.kind, version, name), value)
+            values_dict.update(redis_values_dict)
+            missing_names_list = [name for name in missing_names_list if name not in redis_values_dict]
+            self._count("redis_hits", len(redis_values_dict))
+            self._count("redis_misses", len(missing_names_list))
+
+        if missing_names_list:
+            values_dict.update(self._load_single_flight(aggregate, version, missing_names_list))
+        return {name: values_dict[name] for name in unique_names_list}
+
+    def _read_from_redis(
+        self, aggregate: CachedAggregate, version: str, names_list: List[str]
+    ) -> Dict[str, dict]:
+        """Read the hashes of several names in one pipeline.
+        Names without a hash in Redis are left out."""
+        redis_pipeline = self.redis_connection.pipeline(transaction=False)
+        for name in names_list:
+            redis_pipeline.hgetall(self._redis_key(aggregate, version, name))
+        redis_values_dict = {}
+        for name, hash_dict in zip(names_list, redis_pipeline.execute()):
+            if hash_dict:
+                redis_values_dict[name] = {
+                    pricing_date: float(hash_dict[pricing_date]) for pricing_date in sorted(hash_dict)
+                }
+        return redis_values_dict
+
+    def _load_single_flight(
+        self, aggregate: CachedAggregate, version: Optional[str], names_list: List[str]
+    ) -> Dict[str, dict]:
+        """Load names from PostgreSQL. Names another thread is already loading
+        are waited for rather than queried again."""
+        owned_loads_dict = {}
+        waiting_loads_dict = {}
+        with self.lock:
+            for name in names_list:
+                in_flight_key = (aggregate.kind, version, name)
+                if in_flight_key in self.in_flight_dict:
+                    waiting_loads_dict[name] = self.in_flight_dict[in_flight_key]
+                else:
+                    owned_loads_dict[name] = self.in_flight_dict[in_flight_key] = InFlightLoad()
+        self._count("single_flight_waits", len(waiting_loads_dict))
+
+        values_dict = {}
+        if owned_loads_dict:
+            try:
+                loaded_values_dict = self._load_from_postgres(aggregate, list(owned_loads_dict))
+                self._count("postgres_loads")
+                if version is not None:
+                    self._fill_redis(aggregate, version, loaded_values_dict)
+                for name, in_flight_load in owned_loads_dict.items():
+                    value = loaded_values_dict.get(name, {})
+                    self.lru_cache.put((aggregate.kind, version, name), value)
+                    in_flight_load.value = value
+                    values_dict[name] = value
+            except Exception as error:
+                for in_flight_load in owned_loads_dict.values():
+                    in_flight_load.error = error
+                raise
+            finally:
+                with self.lock:
+                    for name, in_flight_load in owned_loads_dict.items():
+                        del self.in_flight_dict[(aggregate.kind, version, name)]
+                        in_flight_load.done.set()
+
+        for name, in_flight_load in waiting_loads_dict.items():
+            in_flight_load.done.wait()
+            if in_flight_load.error is not None:
+                raise in_flight_load.error
+            values_dict[name] = in_flight_load.value
+        return values_dict
+
+    def _load_from_postgres(
+        self, aggregate: CachedAggregate, names_list: List[str]
+    ) -> Dict[str, dict]:
+        """Query the marts for several names at once.
+        Names without any rows are left out."""
+        loaded_values_dict = {}
+        with self.postgres_engine.connect() as postgres_connection:
+            query_result = postgres_connection.execute(
+                aggregate.build_sql_query(), {"names_list": names_list}
+            )
+            for name, pricing_date, value in query_result:
+                if value is not None:
+                    loaded_values_dict.setdefault(name, {})[str(pricing_date)] = float(value)
+        return {
+            name: {pricing_date: values_dict[pricing_date] for pricing_date in sorted(values_dict)}
+            for name, values_dict in loaded_values_dict.items()
+        }
+
+    def _load_current_specials_from_postgres(self) -> Dict[str, str]:
+        """Query the current specials, encoded as they are published to Redis
+
+        Returns:
+        1. {product name: JSON special details}
+        """
+        with self.postgres_engine.connect() as postgres_connection:
+            current_specials_df = pd.read_sql(CURRENT_SPECIALS_SQL_QUERY, postgres_connection)
+        return {
+            product_name: encode_special_details(special_details_dict)
+            for product_name, special_details_dict in build_current_specials(
+                current_specials_df
+            ).items()
+        }
+
+    def _fill_redis(self, aggregate: CachedAggregate, version: str, loaded_values_dict: dict):
+        """Write values loaded from PostgreSQL into the published version.
+        The keys are given a TTL as they were not written by the publisher."""
+        if not loaded_values_dict:
+            return
+        redis_pipeline = self.redis_connection.pipeline(transaction=False)
+        for name, values_dict in loaded_values_dict.items():
+            redis_key = self._redis_key(aggregate, version, name)
+            redis_pipeline.hset(redis_key, mapping=values_dict)
+            redis_pipeline.expire(redis_key, FILLED_KEY_TTL_SECONDS)
+        redis_pipeline.execute()
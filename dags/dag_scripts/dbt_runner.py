@@ -0,0 +1,225 @@
+"""Runs the dbt project as selective, state aware builds
+
+Rather than running and testing the whole project every week, the main DAG
+builds each model in its own task and only rebuilds what changed:
+
+1. check_sources_task() runs dbt source freshness on the raw staging table
+    (loaded_at_field is date_extracted, see models/sources.yml) and the
+    source tests. Freshness results are written to target/freshness/sources.json
+2. build_model_task() runs dbt build (the model and its tests) for one model.
+    When the model, or a model upstream of it, changed since the last
+    successful run (state:modified+) it is rebuilt from scratch with
+    --full-refresh, so a changed key or column is filled in for every row
+    rather than only the new ones. Otherwise it is built incrementally if
+    its source has newer data than last time (source_status:fresher+).
+    Independent models such as fct_product_prices and fct_product_specials
+    run as parallel tasks
+3. save_state_task() keeps the manifest and freshness results of the run
+    in DBT_STATE_DIR once every model is built. They are the state the
+    next run is compared against
+
+Until a run has saved its state there is nothing to compare against, so
+the first run rebuilds every model from scratch.
+
+Each task writes into its own target folder (target/<task name>) so tasks
+running at the same time on different workers do not overwrite each
+other's manifest, run results or partial parse files.
+
+dbt packages are installed into the image when it is built (see the
+Dockerfile and packages-install-path in dbt_project.yml), so no task
+downloads packages at runtime.
+"""
+# Standard Library Imports
+import logging
+import os
+import shutil
+import subprocess
+from typing import List
+
+# Custom modules
+from dag_scripts import pipeline_metrics
+
+# Globals
+DBT_PROJECT_DIR = os.environ.get("DBT_PROJECT_DIR", "/dbt_project")
+DBT_PROFILES_DIR = os.environ.get("DBT_PROFILES_DIR", "/.dbt")
+DBT_STATE_DIR = os.environ.get("DBT_STATE_DIR", os.path.join(DBT_PROJECT_DIR, "state"))
+SOURCE_SELECTOR = "source:supermarket"
+FRESHNESS_TARGET_NAME = "freshness"
+STATE_FILE_NAMES = ("manifest.json", "sources.json")
+
+
+def get_target_path(target_name: str, project_dir: str = DBT_PROJECT_DIR) -> str:
+    """Target folder of a task, such as /dbt_project/target/fct_product_prices"""
+    return os.path.join(project_dir, "target", target_name)
+
+
+def run_dbt(
+    dbt_args_list: List[str],
+    target_name: str,
+    project_dir: str = DBT_PROJECT_DIR,
+    profiles_dir: str = DBT_PROFILES_DIR,
+):
+    """Run a dbt command, raising CalledProcessError if it fails
+
+    Parameters:
+    1. dbt_args_list: dbt command and its arguments, such as ["build", "--select", "dim"]
+    2. target_name: name of the task's target folder (see get_target_path())
+    3. project_dir: folder of the dbt project
+    4. profiles_dir: folder of profiles.yml
+    """
+    target_path = get_target_path(target_name, project_dir)
+    command_list = [
+        "dbt",
+        *dbt_args_list,
+        "--profiles-dir",
+        profiles_dir,
+        "--project-dir",
+        project_dir,
+        "--target-path",
+        target_path,
+        "--log-path",
+        os.path.join(project_dir, "logs", target_name),
+    ]
+    logging.info("Running %s", " ".join(command_list))
+    subprocess.run(command_list, check=True)
+
+
+def has_saved_state(state_dir: str = DBT_STATE_DIR) -> bool:
+    """True if a previous run saved its manifest and freshness results"""
+    return all(
+        os.path.isfile(os.path.join(state_dir, state_file_name))
+        for state_file_name in STATE_FILE_NAMES
+    )
+
+
+def build_changed_selector(model_selector: str) -> str:
+    """Selects the model if it, or a model upstream of it, changed since the saved state"""
+    return f"{model_selector},state:modified+"
+
+
+def build_fresher_selector(model_selector: str) -> str:
+    """Selects the model if its source has newer data than in the saved state"""
+    return f"{model_selector},source_status:fresher+"
+
+
+def check_model_changed(
+    model_name: str,
+    state_dir: str = DBT_STATE_DIR,
+    project_dir: str = DBT_PROJECT_DIR,
+    profiles_dir: str = DBT_PROFILES_DIR,
+) -> bool:
+    """Check if a model, or a model upstream of it, changed since the saved state
+
+    Returns:
+    1. True if the model needs rebuilding from scratch. Always True
+        when there is no saved state to compare against
+    """
+    if not has_saved_state(state_dir):
+        return True
+    ls_result = subprocess.run(
+        [
+            "dbt",
+            "--quiet",
+            "ls",
+            "--select",
+            build_changed_selector(model_name),
+            "--resource-type",
+            "model",
+            "--output",
+            "name",
+            "--state",
+            state_dir,
+            "--profiles-dir",
+            profiles_dir,
+            "--project-dir",
+            project_dir,
+            "--target-path",
+            get_target_path(model_name, project_dir),
+        ],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    return model_name in (line.strip() for line in ls_result.stdout.splitlines())
+
+
+@pipeline_metrics.instrumented_task("dbt_check_sources")
+def check_sources_task(project_dir: str = DBT_PROJECT_DIR, profiles_dir: str = DBT_PROFILES_DIR):
+    """Check the raw staging table is fresh and passes its source tests"""
+    with pipeline_metrics.step("source_freshness"):
+        run_dbt(
+            ["source", "freshness", "--select", SOURCE_SELECTOR],
+            FRESHNESS_TARGET_NAME,
+            project_dir,
+            profiles_dir,
+        )
+    with pipeline_metrics.step("source_tests"):
+        run_dbt(
+            ["test", "--select", SOURCE_SELECTOR], FRESHNESS_TARGET_NAME, project_dir, profiles_dir
+        )
+
+
+def build_model_task(
+    model_name: str,
+    state_dir: str = DBT_STATE_DIR,
+    project_dir: str = DBT_PROJECT_DIR,
+    profiles_dir: str = DBT_PROFILES_DIR,
+):
+    """Build a model and run its tests if it needs rebuilding, from scratch
+    if it changed (see the module docstring). Metrics are reported as
+    dbt_build_<model name>.
+
+    Parameters:
+    1. model_name: name of the dbt model
+    2. state_dir: folder of the last successful run's state
+    3. project_dir: folder of the dbt project
+    4. profiles_dir: folder of profiles.yml
+    """
+    return pipeline_metrics.instrumented_task(f"dbt_build_{model_name}")(build_model)(
+        model_name, state_dir, project_dir, profiles_dir
+    )
+
+
+def build_model(
+    model_name: str,
+    state_dir: str = DBT_STATE_DIR,
+    project_dir: str = DBT_PROJECT_DIR,
+    profiles_dir: str = DBT_PROFILES_DIR,
+):
+    """Build a model and run its tests if it needs rebuilding (see build_model_task())"""
+    with pipeline_metrics.step("compare_state"):
+        model_changed_bool = check_model_changed(model_name, state_dir, project_dir, profiles_dir)
+    if model_changed_bool:
+        logging.info("%s changed since the last run. Rebuilding it from scratch.", model_name)
+        dbt_args_list = ["build", "--select", model_name, "--full-refresh"]
+    else:
+        # source_status compares the freshness results in the task's
+        # target folder with the saved ones
+        target_path = get_target_path(model_name, project_dir)
+        os.makedirs(target_path, exist_ok=True)
+        shutil.copyfile(
+            os.path.join(get_target_path(FRESHNESS_TARGET_NAME, project_dir), "sources.json"),
+            os.path.join(target_path, "sources.json"),
+        )
+        dbt_args_list = [
+            "build", "--select", build_fresher_selector(model_name), "--state", state_dir
+        ]
+    with pipeline_metrics.step("build"):
+        run_dbt(dbt_args_list, model_name, project_dir, profiles_dir)
+
+
+@pipeline_metrics.instrumented_task("dbt_save_state")
+def save_state_task(state_dir: str = DBT_STATE_DIR, project_dir: str = DBT_PROJECT_DIR):
+    """Save the manifest and freshness results written by check_sources_task()
+    as the state the next run is compared against. Each file is written to a
+    temporary name and renamed so a failed save never leaves a half written file.
+    """
+    freshness_target_path = get_target_path(FRESHNESS_TARGET_NAME, project_dir)
+    os.makedirs(state_dir, exist_ok=True)
+    for state_file_name in STATE_FILE_NAMES:
+        state_file_path = os.path.join(state_dir, state_file_name)
+        shutil.copyfile(
+            os.path.join(freshness_target_path, state_file_name), f"{state_file_path}.tmp"
+        )
+        os.replace(f"{state_file_path}.tmp", state_file_path)
+    logging.info("Saved dbt state to %s", state_dir)
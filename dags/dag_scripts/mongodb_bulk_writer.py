@@ -0,0 +1,213 @@
+"""Batched, idempotent writer for loading products into the MongoDB staging collection
+
+Products from several webpages are gathered in memory and written with a
+single unordered bulk_write of upserts rather than an insert_many per page:
+
+1. Products are deduplicated on (id, date_extracted) before being written.
+    A product shown on more than one page is only written once
+2. Each product is an upsert on (id, date_extracted), backed by a unique
+    compound index. Re-running a crawl (or two threads loading the same
+    product) updates the existing document instead of adding a duplicate
+3. Writes are unordered so MongoDB can apply them in parallel and one bad
+    document does not stop the rest of the batch
+4. Staging data can always be crawled again, so a lighter write concern
+    (STAGING_WRITE_CONCERN_W / STAGING_WRITE_CONCERN_JOURNAL) is used
+
+As products are only in MongoDB once the batch is flushed, callers register
+on_flush callbacks (such as checkpointing a page) with the products. The
+callbacks are run after the batch they belong to was written.
+
+The writer is shared by the crawler threads so every method holds a lock.
+"""
+# Standard Library Imports
+import logging
+import threading
+from typing import Callable, List, Optional
+
+# 3rd Party Imports
+import pymongo
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from pymongo.write_concern import WriteConcern
+
+# Custom modules
+from dag_scripts import pipeline_metrics
+
+# Globals
+STAGING_UNIQUE_INDEX_NAME = "id_date_extracted_unique"
+STAGING_UNIQUE_INDEX_KEYS = [("id", pymongo.ASCENDING), ("date_extracted", pymongo.ASCENDING)]
+STAGING_WRITE_CONCERN_W = 1
+STAGING_WRITE_CONCERN_JOURNAL = False
+MONGODB_WRITE_BATCH_SIZE = 500 # products - roughly 10 webpages
+DUPLICATE_KEY_ERROR_CODE = 11000
+
+
+def ensure_staging_unique_index(mongodb_collection):
+    """Create the unique (id, date_extracted) index the upserts rely on.
+    Does nothing if the index already exists.
+
+    Parameters:
+    1. mongodb_collection: MongoDB staging collection
+    """
+    mongodb_collection.create_index(
+        STAGING_UNIQUE_INDEX_KEYS, name=STAGING_UNIQUE_INDEX_NAME, unique=True
+    )
+
+
+def get_staging_write_concern(
+    w=STAGING_WRITE_CONCERN_W, journal: bool = STAGING_WRITE_CONCERN_JOURNAL
+) -> WriteConcern:
+    """Returns the write concern used for the staging collection
+
+    Parameters:
+    1. w: number of replica set members (or "majority") that must acknowledge a write
+    2. journal: True to wait for writes to be written to the on disk journal
+
+    Returns:
+    1. write_concern: pymongo WriteConcern
+    """
+    return WriteConcern(w=w, j=journal)
+
+
+def build_product_upserts(products_list: list) -> List[UpdateOne]:
+    """Build the upsert operations for a list of products,
+    deduplicated on (id, date_extracted). The last copy of a product wins.
+
+    Parameters:
+    1. products_list: products with date_extracted already added
+
+    Returns:
+    1. upserts_list: pymongo UpdateOne operations
+    """
+    products_by_key_dict = {}
+    for product in products_list:
+        products_by_key_dict[(product.get("id"), product.get("date_extracted"))] = product
+
+    upserts_list = []
+    for (product_id, date_extracted), product in products_by_key_dict.items():
+        product_fields_dict = {
+            field_name: value for field_name, value in product.items() if field_name != "_id"
+        }
+        upserts_list.append(
+            UpdateOne(
+                {"id": product_id, "date_extracted": date_extracted},
+                {"$set": product_fields_dict},
+                upsert=True,
+            )
+        )
+    return upserts_list
+
+
+class BulkProductWriter:
+    """Gathers products from several webpages and writes them
+    to MongoDB in unordered bulk upserts
+
+    Can be used as a context manager, which flushes on exit. If the with
+    block raised, a failed flush is logged rather than raised so it does not
+    hide the original error.
+
+    Parameters:
+    1. mongodb_collection: MongoDB staging collection
+    2. batch_size: number of products gathered before they are written
+    3. write_concern: optional pymongo WriteConcern. Defaults to
+        get_staging_write_concern()
+    """
+
+    def __init__(
+        self,
+        mongodb_collection,
+        batch_size: int = MONGODB_WRITE_BATCH_SIZE,
+        write_concern: Optional[WriteConcern] = None,
+    ):
+        self.collection = mongodb_collection.with_options(
+            write_concern=write_concern or get_staging_write_concern()
+        )
+        self.batch_size = batch_size
+        self.pending_products_list = []
+        self.pending_callbacks_list = []
+        self.upserted_count = 0
+        self.modified_count = 0
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+            return
+        # Products gathered before the error are still written (and their pages
+        # checkpointed) so a resumed crawl has less to redo
+        try:
+            self.flush()
+        except Exception:
+            logging.exception("Could not write the pending products after an earlier error")
+
+    def add(self, products_list: list, on_flush: Optional[Callable[[], None]] = None):
+        """Add products to the next batch. The batch is written once it
+        holds batch_size products.
+
+        Parameters:
+        1. products_list: products with date_extracted already added.
+            May be empty, for example to checkpoint a page that was already loaded
+        2. on_flush: optional function with no arguments called after
+            these products were written to MongoDB
+        """
+        with self.lock:
+            self.pending_products_list.extend(products_list)
+            if on_flush is not None:
+                self.pending_callbacks_list.append(on_flush)
+            if len(self.pending_products_list) >= self.batch_size:
+                self._flush_pending()
+
+    def flush(self):
+        """Write every pending product and run the pending callbacks"""
+        with self.lock:
+            self._flush_pending()
+
+    def _flush_pending(self):
+        """Write the pending products. The lock must already be held."""
+        upserts_list = build_product_upserts(self.pending_products_list)
+        if upserts_list:
+            with pipeline_metrics.timed("mongodb_write"):
+                self._bulk_write(upserts_list)
+        logging.info(
+            "Wrote %s products (%s unique) to MongoDB",
+            len(self.pending_products_list),
+            len(upserts_list),
+        )
+        callbacks_list = self.pending_callbacks_list
+        self.pending_products_list = []
+        self.pending_callbacks_list = []
+        for callback in callbacks_list:
+            callback()
+
+    def _bulk_write(self, upserts_list: List[UpdateOne]):
+        """Run an unordered bulk write of upserts
+
+        Two upserts of a new product can race, in which case one of them
+        fails with a duplicate key error. The losing upserts are retried
+        once, when they match the document the other upsert created.
+        """
+        try:
+            bulk_write_result = self.collection.bulk_write(upserts_list, ordered=False)
+            self._count_result(bulk_write_result.bulk_api_result)
+        except BulkWriteError as error:
+            self._count_result(error.details)
+            write_errors_list = error.details.get("writeErrors", [])
+            if not all(
+                write_error["code"] == DUPLICATE_KEY_ERROR_CODE
+                for write_error in write_errors_list
+            ):
+                raise
+            retry_upserts_list = [
+                upserts_list[write_error["index"]] for write_error in write_errors_list
+            ]
+            logging.info("Retrying %s racing upserts", len(retry_upserts_list))
+            bulk_write_result = self.collection.bulk_write(retry_upserts_list, ordered=False)
+            self._count_result(bulk_write_result.bulk_api_result)
+
+    def _count_result(self, bulk_api_result: dict):
+        """Add the counts from a bulk write to the writer's totals"""
+        self.upserted_count += bulk_api_result.get("nUpserted", 0)
+        self.modified_count += bulk_api_result.get("nModified", 0)
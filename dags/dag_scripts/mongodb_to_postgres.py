@@ -3,65 +3,1077 @@ TO DO: add error logging
 
 Program Flow:
 
-1. Connect to MongoDB
-2. Connect to PostgreSQL
-2. Retrieve all records in the MongoDB collection
-3. Flatten the JSON records into a flat record
-4. Check if the specials columns are present
-    If not present - add the specials columns
-5. Define SQL data types for certain columns
-6. Upload the data frame to PostgreSQL
+1. Connect to MongoDB and check the schema before exporting anything.
+    MongoDB lists every flattened key path in the documents for the
+    latest extraction date (see get_mongodb_key_paths()) and the run stops
+    straight away if columns were added or dropped
+2. Connect to PostgreSQL, make sure the staging table exists and
+    create an empty UNLOGGED load table
+3. Split the documents for the latest extraction date into shards of
+    roughly equal size by _id range (see plan_export_shards())
+4. Export the shards in parallel with a pool of processes. Each process has
+    its own MongoDB and PostgreSQL connections and reads its shard in batches
+    with a cursor. Only the fields in the column contract are sent over the
+    network (see build_mongodb_projection())
+    For each batch:
+
+        4A. Flatten the JSON records into a flat, typed record with the
+            schema aware product_flattener module. Missing columns (such as
+            the specials columns) are left null
+        4B. Stream the batch into the load table as CSV with COPY FROM STDIN
+
+5. Check again that every expected column was seen in at least one shard
+    If not - drop the load table so the staging table is left untouched
+6. Merge the load table into the staging table with INSERT ... ON CONFLICT
+    keyed on (id, date_extracted) in a single transaction and drop the load table
+
+In the main DAG steps 1-3 run in prepare_export_task(), each shard is
+exported by its own mapped export_shard_task() so the shards are spread
+over the Celery workers, and steps 5-6 run in merge_export_task() once
+every shard has been exported.
+
+Flattening is CPU bound, so the processes let it use several cores
+instead of one. Each process only holds one batch in memory at a time so
+memory use stays constant no matter how many documents are in MongoDB.
+
+The staging table keeps every week's data rather than being rebuilt each run.
+It is partitioned by date_extracted (one partition per extraction date) so
+its indexes and statistics survive between runs, and queries that filter on
+date_extracted - such as the incremental dbt models - only read the partitions they need.
 """
 # Standard Library Imports
+from concurrent.futures import ProcessPoolExecutor
+import io
+from itertools import islice
 import logging
+import math
+import os
+from typing import Any, NamedTuple, Optional, Tuple
 
 # 3rd Party Imports
+from bson import json_util
 import pandas as pd
+from psycopg2 import sql
 import sqlalchemy
+from sqlalchemy.dialects import postgresql
 
 # Custom modules
-from dag_scripts.db_connections import db_connection_funcs
+from dag_scripts import pipeline_metrics
+from dag_scripts.db_connections import connection_manager, db_connection_funcs
+from dag_scripts.product_flattener import ProductFlattener
 from dag_scripts.tests import test_mongodb_schema_change
 
+# Globals
+STAGING_SCHEMA_NAME = "public"
+STAGING_TABLE_NAME = "raw_supermarket_staging"
+# Business key of a product row, the same key the MongoDB upserts use.
+# Re-crawling a date gives documents new ObjectIds, so _id can not be the key
+STAGING_PRIMARY_KEY_COLUMNS = ("id", "date_extracted")
+LOAD_SCHEMA_NAME = "public"
+LOAD_TABLE_NAME = "raw_supermarket_staging_load"
+MONGODB_BATCH_SIZE = 5000 # documents
+EXPORT_PROCESSES = min(4, os.cpu_count() or 1)
+# Shards exported as mapped tasks of the main DAG, spread over the Celery workers
+EXPORT_SHARD_TASKS = 4
+MIN_DOCUMENTS_PER_SHARD = 2 * MONGODB_BATCH_SIZE
+# None checks every document. Set to a number of documents to check a random sample
+SCHEMA_CHECK_SAMPLE_SIZE = None
+# Deepest nesting of the keys in the column contract (pricing.multiBuyPromotion.id)
+MAX_KEY_PATH_DEPTH = 3
+
+
+class ExportShard(NamedTuple):
+    """Range of MongoDB _ids exported by one process.
+    A bound of None means the range is open on that side.
+    """
+
+    date_extracted: Optional[str]
+    lower_id: Any
+    upper_id: Any
+
+
+@pipeline_metrics.instrumented_task("mongodb_to_postgres")
+def main(date_extracted: Optional[str] = None, export_processes: int = EXPORT_PROCESSES):
+    """main
+
+    Parameters:
+    1. date_extracted: extraction date (YYYY-MM-DD) to export from MongoDB.
+        Defaults to the latest date in the MongoDB collection.
+    2. export_processes: number of processes exporting shards in parallel.
+        1 exports in this process without a process pool.
+    """
+    export_shards_list = prepare_export(date_extracted, export_processes)
+    try:
+        with pipeline_metrics.step("export") as export_metrics:
+            copied_rows_int, seen_columns_set = export_shards(
+                export_shards_list, export_processes
+            )
+            export_metrics.add_rows(copied_rows_int)
+    except Exception:
+        drop_load_table_after_failure()
+        raise
+    logging.info(
+        "Copied %s rows from %s shards into %s",
+        copied_rows_int,
+        len(export_shards_list),
+        LOAD_TABLE_NAME,
+    )
+    merge_export(seen_columns_set)
+
+
+@pipeline_metrics.instrumented_task("mongodb_to_postgres_prepare")
+def prepare_export_task(
+    date_extracted: Optional[str] = None, shard_count: int = EXPORT_SHARD_TASKS
+) -> list:
+    """Prepare the export for the main DAG, which exports each shard in
+    its own mapped task (see export_shard_task()) and then merges them
+    once every shard is exported (see merge_export_task())
+
+    Parameters:
+    1. date_extracted: extraction date (YYYY-MM-DD) to export from MongoDB.
+        Defaults to the latest date in the MongoDB collection.
+    2. shard_count: maximum number of shards, so of mapped export tasks
+
+    Returns:
+    1. export_kwargs_list: keyword arguments of export_shard_task() for each shard
+    """
+    return [
+        {"export_shard_json": encode_export_shard(export_shard_tuple)}
+        for export_shard_tuple in prepare_export(date_extracted, shard_count)
+    ]
+
+
+@pipeline_metrics.instrumented_task("mongodb_to_postgres_export_shard")
+def export_shard_task(export_shard_json: str) -> dict:
+    """Export one shard into the load table as a mapped task of the main DAG.
+    If a shard fails the merge does not run, so the staging table is left
+    untouched. The shard can be retried as its rows are only committed
+    once all of them are copied.
+
+    Parameters:
+    1. export_shard_json: shard from prepare_export_task()
+
+    Returns:
+    1. shard_result_dict: copied_rows and seen_columns of the shard, for merge_export_task()
+    """
+    copied_rows_int, seen_columns_set, _ = export_shard(decode_export_shard(export_shard_json))
+    return {"copied_rows": copied_rows_int, "seen_columns": sorted(seen_columns_set)}
+
+
+@pipeline_metrics.instrumented_task("mongodb_to_postgres_merge")
+def merge_export_task(shard_results_list: list) -> int:
+    """Merge the load table into the staging table once every
+    mapped export_shard_task() of the main DAG has finished
 
-def main():
-    """main"""
-    mongodb_client = db_connection_funcs.get_mongodb_client()
+    Parameters:
+    1. shard_results_list: results of every export_shard_task()
+
+    Returns:
+    1. merged_rows_int: number of rows inserted or updated in the staging table
+    """
+    seen_columns_set = set()
+    for shard_result_dict in shard_results_list:
+        seen_columns_set.update(shard_result_dict["seen_columns"])
+    logging.info(
+        "Copied %s rows from %s shards into %s",
+        sum(shard_result_dict["copied_rows"] for shard_result_dict in shard_results_list),
+        len(shard_results_list),
+        LOAD_TABLE_NAME,
+    )
+    return merge_export(seen_columns_set)
+
+
+def prepare_export(date_extracted: Optional[str] = None, shard_count: int = EXPORT_PROCESSES) -> list:
+    """Check the MongoDB schema, make sure the staging table exists,
+    create an empty load table and split the documents into export shards
+
+    Parameters:
+    1. date_extracted: extraction date (YYYY-MM-DD) to export from MongoDB.
+        Defaults to the latest date in the MongoDB collection.
+    2. shard_count: maximum number of shards
+
+    Returns:
+    1. export_shards_list: list of ExportShard tuples from plan_export_shards()
+    """
+    mongodb_client = connection_manager.get_mongodb_client()
     mongo_database = db_connection_funcs.get_mongodb_database(mongodb_client)
     mongodb_collection = db_connection_funcs.get_mongodb_collection(mongo_database)
-    json_data_list = mongodb_collection.find({})
-    flattened_json_df = pd.json_normalize(json_data_list)
-    mongodb_client.close()
+    expected_columns_list = test_mongodb_schema_change.get_expected_postgres_columns_list()
+    sql_data_type_definitions_dict = define_column_data_types_for_sql()
+
+    with pipeline_metrics.step("schema_check"):
+        if date_extracted is None:
+            date_extracted = get_latest_date_extracted(mongodb_collection)
+        key_paths_set = get_mongodb_key_paths(
+            mongodb_collection, build_export_filter(date_extracted), SCHEMA_CHECK_SAMPLE_SIZE
+        )
+        if test_mongodb_schema_change.test_if_key_paths_have_changed(
+            key_paths_set | test_mongodb_schema_change.SPECIALS_COLUMNS_SET
+        ):
+            raise ValueError("Schema has changed from expected. Check the errors log.")
+
+    postgres_connection = connection_manager.get_postgresql_engine().raw_connection()
+    try:
+        with pipeline_metrics.step("prepare_tables"):
+            with postgres_connection.cursor() as postgres_cursor:
+                ensure_staging_table(
+                    postgres_cursor, expected_columns_list, sql_data_type_definitions_dict
+                )
+                create_load_table(postgres_cursor)
+            # Committed so the export processes can see the load table
+            postgres_connection.commit()
+    except Exception:
+        postgres_connection.rollback()
+        raise
+    finally:
+        postgres_connection.close()
+
+    logging.info("Exporting documents extracted on %s", date_extracted)
+    return plan_export_shards(mongodb_collection, date_extracted, shard_count)
+
+
+def merge_export(seen_columns_set: set) -> int:
+    """Check every expected column was seen in the exported documents,
+    then merge the load table into the staging table and drop the load table.
+    If anything fails the load table is dropped so the staging table is left untouched.
+
+    Parameters:
+    1. seen_columns_set: expected columns seen in at least one exported document
+
+    Returns:
+    1. merged_rows_int: number of rows inserted or updated in the staging table
+    """
+    expected_columns_list = test_mongodb_schema_change.get_expected_postgres_columns_list()
+    postgres_connection = connection_manager.get_postgresql_engine().raw_connection()
+    try:
+        schema_has_changed_bool = test_mongodb_schema_change.test_if_key_paths_have_changed(
+            seen_columns_set | test_mongodb_schema_change.SPECIALS_COLUMNS_SET
+        )
+        if schema_has_changed_bool:
+            raise ValueError("Schema has changed from expected. Check the errors log.")
+
+        with pipeline_metrics.step("merge") as merge_metrics:
+            with postgres_connection.cursor() as postgres_cursor:
+                merged_rows_int = merge_load_table_into_staging(
+                    postgres_cursor, expected_columns_list
+                )
+                drop_load_table(postgres_cursor)
+            postgres_connection.commit()
+            merge_metrics.add_rows(merged_rows_int)
+        logging.info("Merged %s rows into %s", merged_rows_int, STAGING_TABLE_NAME)
+    except Exception:
+        postgres_connection.rollback()
+        with postgres_connection.cursor() as postgres_cursor:
+            drop_load_table(postgres_cursor)
+        postgres_connection.commit()
+        raise
+    finally:
+        postgres_connection.close()
+    return merged_rows_int
+
+
+def drop_load_table_after_failure():
+    """Drop the load table with a new connection once an export has failed"""
+    postgres_connection = connection_manager.get_postgresql_engine().raw_connection()
+    try:
+        with postgres_connection.cursor() as postgres_cursor:
+            drop_load_table(postgres_cursor)
+        postgres_connection.commit()
+    finally:
+        postgres_connection.close()
 
-    flattened_json_df_w_specials = add_specials_columns_if_not_present(
-        flattened_json_df
+
+def encode_export_shard(export_shard_tuple: ExportShard) -> str:
+    """Encode an export shard as MongoDB Extended JSON so it can be passed
+    between tasks through XCom without losing the type of its _id bounds
+    (such as ObjectId)"""
+    return json_util.dumps(export_shard_tuple._asdict())
+
+
+def decode_export_shard(export_shard_json: str) -> ExportShard:
+    """Decode an export shard encoded by encode_export_shard()"""
+    return ExportShard(**json_util.loads(export_shard_json))
+
+
+def plan_export_shards(
+    mongodb_collection,
+    date_extracted: Optional[str],
+    shard_count: int = EXPORT_PROCESSES,
+    min_documents_per_shard: int = MIN_DOCUMENTS_PER_SHARD,
+) -> list:
+    """Split the documents to export into shards by _id range
+
+    The boundaries are every n-th _id in _id order, found by walking the
+    _id index, so each shard has roughly the same number of documents.
+    Small exports are not split further than min_documents_per_shard as
+    starting a process costs more than flattening a few documents.
+    The first and last shards are open ended so documents added while the
+    export runs are not missed.
+
+    Parameters:
+    1. mongodb_collection: MongoDB collection to export
+    2. date_extracted: extraction date to export. None exports every document
+    3. shard_count: maximum number of shards
+    4. min_documents_per_shard: smallest shard worth exporting in its own process
+
+    Returns:
+    1. export_shards_list: list of ExportShard tuples covering every _id
+    """
+    filter_dict = build_export_filter(date_extracted)
+    document_count = mongodb_collection.count_documents(filter_dict)
+    shard_count = max(1, min(shard_count, document_count // max(1, min_documents_per_shard)))
+    shard_size = math.ceil(document_count / shard_count)
+
+    boundary_ids_list = []
+    for shard_number in range(1, shard_count):
+        boundary_document = next(
+            mongodb_collection.find(filter_dict, projection={"_id": 1})
+            .sort("_id", 1)
+            .skip(shard_number * shard_size)
+            .limit(1),
+            None,
+        )
+        if boundary_document is not None:
+            boundary_ids_list.append(boundary_document["_id"])
+
+    bounds_list = [None] + boundary_ids_list + [None]
+    return [
+        ExportShard(date_extracted, lower_id, upper_id)
+        for lower_id, upper_id in zip(bounds_list[:-1], bounds_list[1:])
+    ]
+
+
+def export_shards(
+    export_shards_list: list, export_processes: int = EXPORT_PROCESSES
+) -> Tuple[int, set]:
+    """Export shards into the load table, in parallel when there is
+    more than one shard and more than one process
+
+    Pipeline metrics recorded in the export processes stay in those
+    processes, so the bytes each shard copied are added to this process's
+    running steps here.
+
+    Returns:
+    1. copied_rows_int: number of rows copied into the load table
+    2. seen_columns_set: expected columns seen in at least one document
+    """
+    if export_processes <= 1 or len(export_shards_list) <= 1:
+        shard_results_list = [
+            export_shard(export_shard_tuple) for export_shard_tuple in export_shards_list
+        ]
+    else:
+        with ProcessPoolExecutor(
+            max_workers=min(export_processes, len(export_shards_list))
+        ) as executor:
+            shard_results_list = list(executor.map(export_shard, export_shards_list))
+        pipeline_metrics.record_bytes(
+            sum(shard_bytes_int for _, _, shard_bytes_int in shard_results_list)
+        )
+
+    copied_rows_int = 0
+    seen_columns_set = set()
+    for shard_rows_int, shard_seen_columns_set, _ in shard_results_list:
+        copied_rows_int += shard_rows_int
+        seen_columns_set.update(shard_seen_columns_set)
+    return copied_rows_int, seen_columns_set
+
+
+def export_shard(export_shard_tuple: ExportShard) -> Tuple[int, set, int]:
+    """Export one shard of documents into the load table
+
+    Runs in a worker process, so it opens (and closes) its own MongoDB and
+    PostgreSQL connections rather than sharing the parent process's ones.
+    The shard's rows are committed to the load table once all of them are copied.
+
+    Parameters:
+    1. export_shard_tuple: ExportShard from plan_export_shards()
+
+    Returns:
+    1. copied_rows_int: number of rows copied into the load table
+    2. seen_columns_set: expected columns seen in at least one document in the shard
+    3. copied_bytes_int: size of the CSV copied into the load table
+    """
+    expected_columns_list = test_mongodb_schema_change.get_expected_postgres_columns_list()
+    product_flattener = ProductFlattener(expected_columns_list, define_column_data_types_for_sql())
+    mongodb_client = connection_manager.get_mongodb_client()
+    mongodb_collection = db_connection_funcs.get_mongodb_collection(
+        db_connection_funcs.get_mongodb_database(mongodb_client)
     )
-    schema_has_changed_bool = test_mongodb_schema_change.test_if_schema_has_changed(
-        flattened_json_df_w_specials
+    postgres_engine = connection_manager.get_postgresql_engine()
+    postgres_connection = postgres_engine.raw_connection()
+    mongodb_cursor = None
+    copied_rows_int = 0
+    seen_columns_set = set()
+
+    with pipeline_metrics.step("export_shard") as shard_metrics:
+        try:
+            mongodb_cursor = find_documents_for_export(
+                mongodb_collection,
+                expected_columns_list,
+                export_shard_tuple.date_extracted,
+                lower_id=export_shard_tuple.lower_id,
+                upper_id=export_shard_tuple.upper_id,
+            )
+            with postgres_connection.cursor() as postgres_cursor:
+                for document_batch_list in iter_document_batches(
+                    mongodb_cursor, MONGODB_BATCH_SIZE
+                ):
+                    with pipeline_metrics.timed("flatten"):
+                        flattened_json_df, batch_seen_columns_set = product_flattener.flatten(
+                            document_batch_list
+                        )
+                    seen_columns_set.update(batch_seen_columns_set)
+                    with pipeline_metrics.timed("copy"):
+                        copied_rows_int += copy_dataframe_to_postgres(
+                            postgres_cursor,
+                            flattened_json_df,
+                            expected_columns_list,
+                            schema_name=LOAD_SCHEMA_NAME,
+                            table_name=LOAD_TABLE_NAME,
+                        )
+            postgres_connection.commit()
+            shard_metrics.add_rows(copied_rows_int)
+        except Exception:
+            postgres_connection.rollback()
+            raise
+        finally:
+            if mongodb_cursor is not None:
+                mongodb_cursor.close()
+            postgres_connection.close()
+    return copied_rows_int, seen_columns_set, shard_metrics.bytes_transferred
+
+
+def build_mongodb_projection(expected_columns_list: list) -> dict:
+    """Build a MongoDB projection from the column contract
+
+    The expected columns are the flattened (dotted) key paths that
+    json_normalize produces, which MongoDB accepts directly as projection
+    paths. Only these fields are sent by the MongoDB server, so any other
+    fields in the documents are never transferred or decoded. This includes
+    the large imageUris, locations and onlineHeirs arrays, which are left out
+    of the contract (see test_mongodb_schema_change.NOT_EXPORTED_COLUMNS_SET).
+
+    Paths that are a parent of another path (for example "pricing" and
+    "pricing.now") can not both be projected, so only the child is kept.
+
+    Parameters:
+    1. expected_columns_list: list from
+        test_mongodb_schema_change.get_expected_postgres_columns_list()
+
+    Returns:
+    1. projection_dict: {"field path": 1}
+    """
+    projection_dict = {}
+    for column_name in expected_columns_list:
+        has_child_path = any(
+            other_column.startswith(f"{column_name}.") for other_column in expected_columns_list
+        )
+        if not has_child_path:
+            projection_dict[column_name] = 1
+    return projection_dict
+
+
+def get_mongodb_key_paths(
+    mongodb_collection,
+    filter_dict: Optional[dict] = None,
+    sample_size: Optional[int] = None,
+    max_depth: int = MAX_KEY_PATH_DEPTH,
+) -> set:
+    """Get every flattened (dotted) key path in the documents, worked out
+    by MongoDB with an aggregation so no documents are sent over the network
+
+    Key paths match the column names pd.json_normalize would create: nested
+    objects are followed with $objectToArray and anything else (values,
+    arrays and nulls) is a leaf. Objects nested deeper than max_depth are
+    reported at max_depth.
+
+    Parameters:
+    1. mongodb_collection: MongoDB collection to check
+    2. filter_dict: optional filter, such as from build_export_filter()
+    3. sample_size: optional number of randomly sampled documents to check
+        instead of every document
+    4. max_depth: number of levels of nested objects to follow
+
+    Returns:
+    1. key_paths_set: set of key paths such as {"_id", "pricing.now"}
+    """
+    aggregation_pipeline_list = [{"$match": filter_dict or {}}]
+    if sample_size is not None:
+        aggregation_pipeline_list.append({"$sample": {"size": sample_size}})
+    aggregation_pipeline_list += [
+        {"$project": {"_id": 0, "key_value": {"$objectToArray": "$$ROOT"}}},
+        {"$unwind": "$key_value"},
+        {"$project": {"key_path": "$key_value.k", "value": "$key_value.v"}},
+    ]
+    for _ in range(max_depth - 1):
+        aggregation_pipeline_list += [
+            {
+                "$project": {
+                    "key_path": 1,
+                    "key_value": {
+                        "$cond": [
+                            {"$eq": [{"$type": "$value"}, "object"]},
+                            {"$objectToArray": "$value"},
+                            # Leaves keep their key path
+                            [{"k": None, "v": None}],
+                        ]
+                    },
+                }
+            },
+            # An empty object keeps its key path as well
+            {"$unwind": {"path": "$key_value", "preserveNullAndEmptyArrays": True}},
+            {
+                "$project": {
+                    "key_path": {
+                        "$cond": [
+                            {"$ifNull": ["$key_value.k", False]},
+                            {"$concat": ["$key_path", ".", "$key_value.k"]},
+                            "$key_path",
+                        ]
+                    },
+                    "value": "$key_value.v",
+                }
+            },
+        ]
+    aggregation_pipeline_list.append({"$group": {"_id": "$key_path"}})
+    return {
+        key_path_document["_id"]
+        for key_path_document in mongodb_collection.aggregate(
+            aggregation_pipeline_list, allowDiskUse=True
+        )
+    }
+
+
+def get_latest_date_extracted(mongodb_collection) -> Optional[str]:
+    """Get the most recent date_extracted in the MongoDB collection.
+    Uses the date_extracted index built when the run collection was
+    promoted (see staging_collections.promote_run_collection()), so only
+    one document is read.
+
+    Returns:
+    1. latest_date_extracted: date string or None if the collection is empty
+    """
+    latest_document = mongodb_collection.find_one(
+        {"date_extracted": {"$exists": True}},
+        projection={"date_extracted": 1, "_id": 0},
+        sort=[("date_extracted", -1)],
     )
-    if schema_has_changed_bool:
-        raise ValueError("Schema has changed from expected. Check the errors log.")
+    if latest_document is None:
+        return None
+    return latest_document["date_extracted"]
+
+
+def build_export_filter(
+    date_extracted: Optional[str], lower_id: Any = None, upper_id: Any = None
+) -> dict:
+    """Build the MongoDB filter for the documents to export
+
+    Parameters:
+    1. date_extracted: extraction date to export. None exports every date
+    2. lower_id: optional smallest _id to export (inclusive)
+    3. upper_id: optional _id to stop at (exclusive)
 
-    cleaned_data_types_df = change_data_types_for_problem_columns(
-        flattened_json_df_w_specials
+    Returns:
+    1. filter_dict: MongoDB query filter
+    """
+    filter_dict = {} if date_extracted is None else {"date_extracted": date_extracted}
+    id_range_dict = {}
+    if lower_id is not None:
+        id_range_dict["$gte"] = lower_id
+    if upper_id is not None:
+        id_range_dict["$lt"] = upper_id
+    if id_range_dict:
+        filter_dict["_id"] = id_range_dict
+    return filter_dict
+
+
+def find_documents_for_export(
+    mongodb_collection,
+    expected_columns_list: list,
+    date_extracted: Optional[str],
+    batch_size: int = MONGODB_BATCH_SIZE,
+    lower_id: Any = None,
+    upper_id: Any = None,
+):
+    """Open a cursor over the documents to export to PostgreSQL
+
+    1. Documents are filtered to a single extraction date (and optionally
+        an _id range) on the server
+    2. Only the fields in the column contract are returned
+    3. Documents are fetched from the server batch_size at a time so the
+        number of network round trips matches the batches used for COPY
+    4. no_cursor_timeout stops the server closing the cursor if loading a
+        batch into PostgreSQL takes longer than the 10 minute idle timeout.
+        The caller must close the cursor.
+
+    Parameters:
+    1. mongodb_collection: MongoDB collection to export
+    2. expected_columns_list: columns of the staging table
+    3. date_extracted: extraction date to export. None exports every document
+    4. batch_size: number of documents per server round trip
+    5. lower_id: optional smallest _id to export (inclusive)
+    6. upper_id: optional _id to stop at (exclusive)
+
+    Returns:
+    1. mongodb_cursor: pymongo cursor
+    """
+    mongodb_cursor = mongodb_collection.find(
+        build_export_filter(date_extracted, lower_id, upper_id),
+        projection=build_mongodb_projection(expected_columns_list),
+        batch_size=batch_size,
+        no_cursor_timeout=True,
     )
-    sql_data_type_definitions_dict = define_column_data_types_for_sql()
-    postgres_engine = db_connection_funcs.create_postgresql_engine()
-    cleaned_data_types_df.to_sql(
-        name="raw_supermarket_staging",
-        con=postgres_engine,
-        schema="public",
-        if_exists="replace",
-        index=False,
-        method="multi",
-        dtype=sql_data_type_definitions_dict,
+    return mongodb_cursor
+
+
+def iter_document_batches(mongodb_cursor, batch_size: int = MONGODB_BATCH_SIZE):
+    """Split a MongoDB cursor into lists of documents
+
+    Parameters:
+    1. mongodb_cursor: pymongo cursor (or any iterable of documents)
+    2. batch_size: maximum number of documents in each batch
+
+    Returns:
+    1. Generator of lists of documents
+    """
+    document_iterator = iter(mongodb_cursor)
+    while True:
+        document_batch_list = list(islice(document_iterator, batch_size))
+        if not document_batch_list:
+            return
+        yield document_batch_list
+
+
+def create_staging_table_sql(
+    expected_columns_list: list,
+    sql_data_type_definitions_dict: dict,
+    schema_name: str = STAGING_SCHEMA_NAME,
+    table_name: str = STAGING_TABLE_NAME,
+) -> sql.Composed:
+    """Build the CREATE TABLE statement for the staging table
+
+    Columns with a data type in define_column_data_types_for_sql()
+    use that type, every other column is text. The table is list
+    partitioned on date_extracted with a primary key on (id, date_extracted).
+
+    Parameters:
+    1. expected_columns_list: columns of the staging table in order
+    2. sql_data_type_definitions_dict: dictionary from define_column_data_types_for_sql()
+    3. schema_name: PostgreSQL schema of the staging table
+    4. table_name: name of the staging table
+
+    Returns:
+    1. create_table_sql: CREATE TABLE statement
+    """
+    postgres_dialect = postgresql.dialect()
+    column_definitions_list = []
+    for column_name in expected_columns_list:
+        sql_data_type = sql_data_type_definitions_dict.get(column_name)
+        data_type_str = (
+            sql_data_type.compile(dialect=postgres_dialect) if sql_data_type is not None else "TEXT"
+        )
+        column_definitions_list.append(
+            sql.SQL("{} {}").format(sql.Identifier(column_name), sql.SQL(data_type_str))
+        )
+    column_definitions_list.append(
+        sql.SQL("PRIMARY KEY ({})").format(
+            sql.SQL(", ").join(sql.Identifier(column) for column in STAGING_PRIMARY_KEY_COLUMNS)
+        )
+    )
+    create_table_sql = sql.SQL("CREATE TABLE {} ({}) PARTITION BY LIST (date_extracted)").format(
+        sql.Identifier(schema_name, table_name), sql.SQL(", ").join(column_definitions_list)
+    )
+    return create_table_sql
+
+
+def get_staging_table_kind(
+    postgres_cursor,
+    schema_name: str = STAGING_SCHEMA_NAME,
+    table_name: str = STAGING_TABLE_NAME,
+) -> str:
+    """Look up what kind of table the staging table is
+
+    Returns:
+    1. "partitioned", "table" for an ordinary (unpartitioned) table,
+        or "missing" if the table does not exist
+    """
+    postgres_cursor.execute(
+        """SELECT c.relkind
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = %s AND c.relname = %s""",
+        (schema_name, table_name),
+    )
+    query_result = postgres_cursor.fetchone()
+    if query_result is None:
+        return "missing"
+    return "partitioned" if query_result[0] == "p" else "table"
+
+
+def ensure_staging_table(
+    postgres_cursor,
+    expected_columns_list: list,
+    sql_data_type_definitions_dict: dict,
+    schema_name: str = STAGING_SCHEMA_NAME,
+    table_name: str = STAGING_TABLE_NAME,
+):
+    """Create the partitioned staging table if it does not exist yet
+
+    Staging tables created by earlier versions of this script (with
+    pandas to_sql and if_exists="replace") are not partitioned. Their
+    rows are moved into the new partitioned table so no history is lost.
+    Partitioned tables keyed on another primary key are re-keyed
+    (see rekey_staging_table()).
+    """
+    staging_table_kind = get_staging_table_kind(postgres_cursor, schema_name, table_name)
+    if staging_table_kind == "partitioned":
+        rekey_staging_table(postgres_cursor, schema_name, table_name)
+        return
+
+    old_table_name = f"{table_name}_unpartitioned"
+    if staging_table_kind == "table":
+        logging.info("Migrating %s to a partitioned table", table_name)
+        postgres_cursor.execute(
+            sql.SQL("ALTER TABLE {} RENAME TO {}").format(
+                sql.Identifier(schema_name, table_name), sql.Identifier(old_table_name)
+            )
+        )
+    postgres_cursor.execute(
+        create_staging_table_sql(
+            expected_columns_list, sql_data_type_definitions_dict, schema_name, table_name
+        )
+    )
+    if staging_table_kind == "table":
+        postgres_cursor.execute(
+            sql.SQL("SELECT DISTINCT date_extracted FROM {}").format(
+                sql.Identifier(schema_name, old_table_name)
+            )
+        )
+        ensure_date_partitions(
+            postgres_cursor, [row[0] for row in postgres_cursor.fetchall()], schema_name, table_name
+        )
+        column_identifiers = sql.SQL(", ").join(
+            sql.Identifier(column) for column in expected_columns_list
+        )
+        primary_key_identifiers = sql.SQL(", ").join(
+            sql.Identifier(column) for column in STAGING_PRIMARY_KEY_COLUMNS
+        )
+        # Keep the latest crawl (highest ObjectId) of a product on a date
+        postgres_cursor.execute(
+            sql.SQL(
+                "INSERT INTO {} ({}) SELECT DISTINCT ON ({}) {} FROM {} "
+                "ORDER BY {}, {} DESC ON CONFLICT DO NOTHING"
+            ).format(
+                sql.Identifier(schema_name, table_name),
+                column_identifiers,
+                primary_key_identifiers,
+                column_identifiers,
+                sql.Identifier(schema_name, old_table_name),
+                primary_key_identifiers,
+                sql.Identifier("_id"),
+            )
+        )
+        postgres_cursor.execute(
+            sql.SQL("DROP TABLE {}").format(sql.Identifier(schema_name, old_table_name))
+        )
+
+
+def get_primary_key(
+    postgres_cursor,
+    schema_name: str = STAGING_SCHEMA_NAME,
+    table_name: str = STAGING_TABLE_NAME,
+) -> tuple:
+    """Look up the primary key constraint of a table
+
+    Returns:
+    1. constraint_name: name of the primary key constraint, None if the table has none
+    2. primary_key_columns: tuple of the key's columns in order
+    """
+    postgres_cursor.execute(
+        """SELECT con.conname, array_agg(a.attname ORDER BY k.ordinality)
+        FROM pg_constraint con
+        JOIN pg_class c ON c.oid = con.conrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        CROSS JOIN LATERAL unnest(con.conkey) WITH ORDINALITY AS k(attnum, ordinality)
+        JOIN pg_attribute a ON a.attrelid = con.conrelid AND a.attnum = k.attnum
+        WHERE con.contype = 'p' AND n.nspname = %s AND c.relname = %s
+        GROUP BY con.conname""",
+        (schema_name, table_name),
+    )
+    query_result = postgres_cursor.fetchone()
+    if query_result is None:
+        return None, ()
+    return query_result[0], tuple(query_result[1])
+
+
+def rekey_staging_table(
+    postgres_cursor,
+    schema_name: str = STAGING_SCHEMA_NAME,
+    table_name: str = STAGING_TABLE_NAME,
+):
+    """Move a partitioned staging table onto STAGING_PRIMARY_KEY_COLUMNS
+
+    Tables created while the key was (_id, date_extracted) can hold a
+    product more than once for a date, one row per re-run of the crawl.
+    Only the latest crawl (highest ObjectId) of each product and date is
+    kept before the primary key is replaced. Does nothing once the table
+    has the expected key.
+    """
+    constraint_name, primary_key_columns = get_primary_key(
+        postgres_cursor, schema_name, table_name
+    )
+    if primary_key_columns == STAGING_PRIMARY_KEY_COLUMNS:
+        return
+
+    logging.info(
+        "Re-keying %s from %s to %s", table_name, primary_key_columns, STAGING_PRIMARY_KEY_COLUMNS
+    )
+    staging_table_identifier = sql.Identifier(schema_name, table_name)
+    postgres_cursor.execute(
+        sql.SQL(
+            "DELETE FROM {} AS older USING {} AS newer WHERE {} AND older._id < newer._id"
+        ).format(
+            staging_table_identifier,
+            staging_table_identifier,
+            sql.SQL(" AND ").join(
+                sql.SQL("older.{} = newer.{}").format(sql.Identifier(column), sql.Identifier(column))
+                for column in STAGING_PRIMARY_KEY_COLUMNS
+            ),
+        )
+    )
+    logging.info("Removed %s duplicate rows from %s", postgres_cursor.rowcount, table_name)
+    if constraint_name is not None:
+        postgres_cursor.execute(
+            sql.SQL("ALTER TABLE {} DROP CONSTRAINT {}").format(
+                staging_table_identifier, sql.Identifier(constraint_name)
+            )
+        )
+    postgres_cursor.execute(
+        sql.SQL("ALTER TABLE {} ADD PRIMARY KEY ({})").format(
+            staging_table_identifier,
+            sql.SQL(", ").join(sql.Identifier(column) for column in STAGING_PRIMARY_KEY_COLUMNS),
+        )
+    )
+
+
+def get_partition_name(date_extracted, table_name: str = STAGING_TABLE_NAME) -> str:
+    """Name of the staging table partition for an extraction date
+    - for example raw_supermarket_staging_p20230912
+    """
+    return f"{table_name}_p{str(date_extracted).replace('-', '')}"
+
+
+def ensure_date_partitions(
+    postgres_cursor,
+    dates_extracted_list: list,
+    schema_name: str = STAGING_SCHEMA_NAME,
+    table_name: str = STAGING_TABLE_NAME,
+) -> list:
+    """Create a staging table partition for each extraction date
+    that does not have one yet
+
+    Parameters:
+    1. postgres_cursor: psycopg2 cursor
+    2. dates_extracted_list: extraction dates (date objects or YYYY-MM-DD strings)
+    3. schema_name: PostgreSQL schema of the staging table
+    4. table_name: name of the staging table
+
+    Returns:
+    1. partition_names_list: partition names for the dates
+    """
+    partition_names_list = []
+    for date_extracted in dates_extracted_list:
+        if date_extracted is None:
+            raise ValueError("Documents without a date_extracted can not be loaded")
+        partition_name = get_partition_name(date_extracted, table_name)
+        postgres_cursor.execute(
+            sql.SQL("CREATE TABLE IF NOT EXISTS {} PARTITION OF {} FOR VALUES IN ({})").format(
+                sql.Identifier(schema_name, partition_name),
+                sql.Identifier(schema_name, table_name),
+                sql.Literal(str(date_extracted)),
+            )
+        )
+        partition_names_list.append(partition_name)
+    return partition_names_list
+
+
+def create_load_table(
+    postgres_cursor,
+    schema_name: str = STAGING_SCHEMA_NAME,
+    table_name: str = STAGING_TABLE_NAME,
+    load_schema_name: str = LOAD_SCHEMA_NAME,
+    load_table_name: str = LOAD_TABLE_NAME,
+):
+    """Create an empty load table with the same columns as the staging table.
+    Shards are copied here first so they can be checked and merged in one
+    statement. Any load table left behind by a failed run is replaced.
+
+    The table is UNLOGGED as it only holds data for the length of a run,
+    so it is not worth writing to the write ahead log. It is an ordinary
+    table rather than a temporary table so every export process can copy into it.
+    """
+    drop_load_table(postgres_cursor, load_schema_name, load_table_name)
+    postgres_cursor.execute(
+        sql.SQL("CREATE UNLOGGED TABLE {} (LIKE {} INCLUDING DEFAULTS)").format(
+            sql.Identifier(load_schema_name, load_table_name),
+            sql.Identifier(schema_name, table_name),
+        )
+    )
+
+
+def drop_load_table(
+    postgres_cursor,
+    load_schema_name: str = LOAD_SCHEMA_NAME,
+    load_table_name: str = LOAD_TABLE_NAME,
+):
+    """Drop the load table if it exists"""
+    postgres_cursor.execute(
+        sql.SQL("DROP TABLE IF EXISTS {}").format(
+            sql.Identifier(load_schema_name, load_table_name)
+        )
+    )
+
+
+def merge_load_table_into_staging(
+    postgres_cursor,
+    expected_columns_list: list,
+    schema_name: str = STAGING_SCHEMA_NAME,
+    table_name: str = STAGING_TABLE_NAME,
+    load_schema_name: str = LOAD_SCHEMA_NAME,
+    load_table_name: str = LOAD_TABLE_NAME,
+) -> int:
+    """Upsert the load table into the staging table
+
+    Partitions are created for any new extraction dates first. Rows
+    already in staging (same product id and date_extracted, see
+    STAGING_PRIMARY_KEY_COLUMNS) are updated rather than duplicated. This
+    includes a re-crawl, whose documents have new MongoDB _ids, so _id
+    must not be part of the key. The partitions that were written to are
+    analyzed so the query planner has up to date statistics for the new data.
+
+    Parameters:
+    1. postgres_cursor: psycopg2 cursor
+    2. expected_columns_list: columns of the staging table
+    3. schema_name: PostgreSQL schema of the staging table
+    4. table_name: name of the staging table
+    5. load_schema_name: schema of the load table
+    6. load_table_name: name of the load table
+
+    Returns:
+    1. merged_rows_int: number of rows inserted or updated
+    """
+    load_table_identifier = sql.Identifier(load_schema_name, load_table_name)
+    postgres_cursor.execute(
+        sql.SQL("SELECT DISTINCT date_extracted FROM {}").format(load_table_identifier)
+    )
+    partition_names_list = ensure_date_partitions(
+        postgres_cursor, [row[0] for row in postgres_cursor.fetchall()], schema_name, table_name
+    )
+
+    update_columns_list = [
+        column for column in expected_columns_list if column not in STAGING_PRIMARY_KEY_COLUMNS
+    ]
+    column_identifiers = sql.SQL(", ").join(
+        sql.Identifier(column) for column in expected_columns_list
     )
-    postgres_engine.dispose()
+    merge_sql = sql.SQL(
+        "INSERT INTO {} ({}) SELECT {} FROM {} ON CONFLICT ({}) DO UPDATE SET {}"
+    ).format(
+        sql.Identifier(schema_name, table_name),
+        column_identifiers,
+        column_identifiers,
+        load_table_identifier,
+        sql.SQL(", ").join(sql.Identifier(column) for column in STAGING_PRIMARY_KEY_COLUMNS),
+        sql.SQL(", ").join(
+            sql.SQL("{} = EXCLUDED.{}").format(sql.Identifier(column), sql.Identifier(column))
+            for column in update_columns_list
+        ),
+    )
+    postgres_cursor.execute(merge_sql)
+    merged_rows_int = postgres_cursor.rowcount
+
+    for partition_name in partition_names_list:
+        postgres_cursor.execute(
+            sql.SQL("ANALYZE {}").format(sql.Identifier(schema_name, partition_name))
+        )
+    return merged_rows_int
+
+
+def format_dataframe_for_copy(
+    cleaned_dataframe: pd.DataFrame,
+    expected_columns_list: list,
+    sql_data_type_definitions_dict: dict,
+) -> pd.DataFrame:
+    """Get a batch flattened with pd.json_normalize ready to be written as CSV
+    for COPY. Not needed for batches from ProductFlattener, which are already
+    in this form.
+
+    1. Columns are put in staging table order. Unexpected columns are dropped.
+    2. Integer columns with missing values are stored by pandas as floats
+        (1.0) which PostgreSQL will not accept for an INTEGER column, so they
+        are converted to nullable integers. Empty strings (from
+        add_specials_columns_if_not_present) become nulls first.
+        Text in an integer column still raises an error.
+
+    Parameters:
+    1. cleaned_dataframe: batch from change_data_types_for_problem_columns()
+    2. expected_columns_list: columns of the staging table in order
+    3. sql_data_type_definitions_dict: dictionary from define_column_data_types_for_sql()
+
+    Returns:
+    1. copy_ready_dataframe: dataframe with the staging table columns in order
+    """
+    copy_ready_dataframe = cleaned_dataframe.reindex(columns=expected_columns_list)
+    for column_name, sql_data_type in sql_data_type_definitions_dict.items():
+        if column_name in copy_ready_dataframe.columns and isinstance(
+            sql_data_type, sqlalchemy.types.INTEGER
+        ):
+            integer_column = copy_ready_dataframe[column_name].replace("", pd.NA)
+            copy_ready_dataframe[column_name] = pd.to_numeric(integer_column).astype("Int64")
+    return copy_ready_dataframe
+
+
+def copy_dataframe_to_postgres(
+    postgres_cursor,
+    copy_ready_dataframe: pd.DataFrame,
+    expected_columns_list: list,
+    schema_name: str = STAGING_SCHEMA_NAME,
+    table_name: str = STAGING_TABLE_NAME,
+) -> int:
+    """Stream a batch into PostgreSQL with COPY FROM STDIN
+
+    COPY is much faster than INSERT statements as PostgreSQL parses the
+    rows directly rather than planning a statement for each group of rows.
+    Missing values are written as empty CSV fields, which COPY loads as null.
+    The size of the CSV is counted as bytes transferred in the pipeline metrics.
+
+    Parameters:
+    1. postgres_cursor: psycopg2 cursor
+    2. copy_ready_dataframe: batch from ProductFlattener.flatten() or
+        format_dataframe_for_copy() with the expected columns in order
+    3. expected_columns_list: columns of the staging table in order
+    4. schema_name: PostgreSQL schema of the table
+    5. table_name: table to copy the rows into
+
+    Returns:
+    1. number of rows copied
+    """
+    csv_buffer = io.StringIO()
+    copy_ready_dataframe.to_csv(csv_buffer, header=False, index=False)
+    csv_buffer.seek(0)
+
+    copy_sql = sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT csv)").format(
+        sql.Identifier(schema_name, table_name),
+        sql.SQL(", ").join(sql.Identifier(column) for column in expected_columns_list),
+    )
+    postgres_cursor.copy_expert(copy_sql, csv_buffer)
+    pipeline_metrics.record_bytes(csv_buffer.tell())
+    return len(copy_ready_dataframe)
 
 
 def define_column_data_types_for_sql() -> dict:
-    """This overall script uses the pd.to_sql function to insert data into PostgreSQL
-    which infers column types unless otherwise defined
+    """Data types for the staging table columns in PostgreSQL.
+    Columns not defined here are created as text.
 
     Numeric columns should be defined as numeric before being inserted into Postgres
     Other columns are OK to be text.
@@ -124,17 +1136,7 @@ def add_specials_columns_if_not_present(
     Returns:
     1. raw_mongodb_table: MongoDB flattened data with specials columns added in the dataframe
     """
-    expected_specials_columns_set = {
-        "pricing.promotionType",
-        "internalDescription",
-        "pricing.specialType",
-        "pricing.offerDescription",
-        "pricing.multiBuyPromotion.type",
-        "pricing.multiBuyPromotion.id",
-        "pricing.multiBuyPromotion.minQuantity",
-        "pricing.multiBuyPromotion.reward",
-        "pricing.promotionDescription",
-    }
+    expected_specials_columns_set = test_mongodb_schema_change.SPECIALS_COLUMNS_SET
 
     raw_mongodb_column_set = set(raw_mongodb_table.columns)
     specials_not_present_set = expected_specials_columns_set.difference(
@@ -148,8 +1150,8 @@ def add_specials_columns_if_not_present(
 
 def change_data_types_for_problem_columns(raw_dataframe: pd.DataFrame):
     """Changes the data types of problem columns
-    so the overall dataframe can be ready correctly
-    by the pandas to_sql function with sqlalchemy.
+    so the overall dataframe can be written correctly
+    as CSV and loaded into PostgreSQL.
 
     For example, it seems that the MongoDB data type of ObjectID
     is retained when converting a dataframe and causes an error
@@ -170,9 +1172,6 @@ def change_data_types_for_problem_columns(raw_dataframe: pd.DataFrame):
             {
                 "_id": str,
                 "_type": str,
-                "imageUris": str,
-                "locations": str,
-                "onlineHeirs": str,
                 "restrictions.delivery": str,
             }
         )
@@ -0,0 +1,154 @@
+"""On disk cache of scraped webpages
+
+Stores what was found on each webpage during the last crawl so unchanged
+pages do not need to be downloaded or parsed again.
+
+For each url the cache keeps:
+1. The ETag and Last-Modified response headers, which are sent back to the
+    website as If-None-Match / If-Modified-Since on the next request so the
+    website can reply with an empty 304 Not Modified response
+2. A sha256 hash of the page content, for when the website ignores the
+    conditional request and sends the full page anyway
+3. The products extracted from the page (gzipped JSON) and their ids
+4. The run date the products were last loaded into MongoDB
+
+Entries are stored as two files named after a hash of the url, so
+concurrent crawler threads working on different urls never write to the
+same file. Files are written to a temporary name and then renamed so a
+crash can not leave a half written entry behind.
+"""
+# Standard Library Imports
+import gzip
+import hashlib
+import json
+import logging
+import os
+from typing import Optional
+
+# Globals
+DEFAULT_PAGE_CACHE_DIR = os.environ.get("PAGE_CACHE_DIR", "/opt/airflow/cache/pages")
+
+
+class PageCache:
+    """Cache of scraped webpages keyed by url
+
+    Parameters:
+    1. cache_dir: folder the cache files are written to. Created if missing.
+    """
+
+    def __init__(self, cache_dir: str = DEFAULT_PAGE_CACHE_DIR):
+        self.cache_dir = cache_dir
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _entry_paths(self, url: str) -> tuple:
+        """Returns the metadata and products file paths for a url"""
+        url_hash = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        metadata_path = os.path.join(self.cache_dir, f"{url_hash}.json")
+        products_path = os.path.join(self.cache_dir, f"{url_hash}.products.json.gz")
+        return metadata_path, products_path
+
+    def get_entry(self, url: str) -> Optional[dict]:
+        """Get the cached metadata for a url
+
+        Returns:
+        1. cache_entry: metadata dictionary or None if the url is not cached
+        """
+        metadata_path, products_path = self._entry_paths(url)
+        if not (os.path.exists(metadata_path) and os.path.exists(products_path)):
+            return None
+        try:
+            with open(metadata_path, encoding="utf-8") as metadata_file:
+                return json.load(metadata_file)
+        except ValueError:
+            logging.warning("Page cache entry for %s is corrupt and will be ignored", url)
+            return None
+
+    @staticmethod
+    def conditional_headers(cache_entry: Optional[dict]) -> dict:
+        """Build conditional request headers from a cache entry
+
+        Parameters:
+        1. cache_entry: metadata from get_entry() or None
+
+        Returns:
+        1. headers_dict: If-None-Match / If-Modified-Since headers.
+            Empty if there is nothing cached.
+        """
+        headers_dict = {}
+        if cache_entry is None:
+            return headers_dict
+        if cache_entry.get("etag"):
+            headers_dict["If-None-Match"] = cache_entry["etag"]
+        if cache_entry.get("last_modified"):
+            headers_dict["If-Modified-Since"] = cache_entry["last_modified"]
+        return headers_dict
+
+    @staticmethod
+    def is_unchanged(cache_entry: Optional[dict], response) -> bool:
+        """Check if a webpage is unchanged since it was cached
+
+        Parameters:
+        1. cache_entry: metadata from get_entry() or None
+        2. response: requests response for the conditional get request
+
+        Returns:
+        1. True if the website replied 304 Not Modified or the
+            content hash matches the cached hash, False otherwise
+        """
+        if cache_entry is None:
+            return False
+        if response.status_code == 304:
+            return True
+        return (
+            response.status_code == 200
+            and hashlib.sha256(response.content).hexdigest() == cache_entry["content_hash"]
+        )
+
+    def load_products(self, url: str) -> list:
+        """Load the products cached for a url"""
+        _, products_path = self._entry_paths(url)
+        with gzip.open(products_path, "rt", encoding="utf-8") as products_file:
+            return json.load(products_file)
+
+    def store(self, url: str, response, products_list: list):
+        """Cache the products extracted from a webpage
+
+        Only successful responses are cached so error pages are never reused.
+        The run date is left empty until mark_loaded() is called.
+
+        Parameters:
+        1. url: url of the webpage
+        2. response: requests response the products were extracted from
+        3. products_list: products extracted from the response
+        """
+        if response.status_code != 200:
+            return
+        metadata_path, products_path = self._entry_paths(url)
+        cache_entry = {
+            "url": url,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "content_hash": hashlib.sha256(response.content).hexdigest(),
+            "product_ids": [product.get("id") for product in products_list],
+            "run_date": None,
+        }
+        with gzip.open(f"{products_path}.tmp", "wt", encoding="utf-8") as products_file:
+            json.dump(products_list, products_file)
+        os.replace(f"{products_path}.tmp", products_path)
+        self._write_metadata(metadata_path, cache_entry)
+
+    def mark_loaded(self, url: str, run_date: str):
+        """Record that a url's products were loaded into MongoDB for a run date"""
+        metadata_path, _ = self._entry_paths(url)
+        cache_entry = self.get_entry(url)
+        if cache_entry is None:
+            return
+        cache_entry["run_date"] = run_date
+        self._write_metadata(metadata_path, cache_entry)
+
+    @staticmethod
+    def _write_metadata(metadata_path: str, cache_entry: dict):
+        """Write a metadata file through a temporary file"""
+        with open(f"{metadata_path}.tmp", "w", encoding="utf-8") as metadata_file:
+            json.dump(cache_entry, metadata_file)
+        os.replace(f"{metadata_path}.tmp", metadata_path)
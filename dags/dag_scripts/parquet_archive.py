@@ -0,0 +1,309 @@
+"""Columnar archive of each week's raw products as a Parquet dataset
+
+The MongoDB staging collection is cleared before every crawl, so without
+an archive the raw data for a week is gone once the next week is scraped.
+This module keeps every week in a Parquet dataset so weeks can be
+reprocessed or backfilled without scraping the website again.
+
+Program Flow:
+
+1. Read the documents for an extraction date from the MongoDB staging
+    collection in batches (only the fields in the column contract)
+2. Flatten each batch with the same ProductFlattener used for PostgreSQL,
+    so the archive has exactly the columns and types of raw_supermarket_staging
+3. Stream the batches into a Parquet dataset partitioned by date_extracted
+    and category (hive style folders such as
+    date_extracted=2023-09-12/merchandiseHeir.category=Fruit/part-0.parquet).
+    Columns are dictionary encoded and compressed, which suits the many
+    repeated values (brands, categories, units) in the product data.
+    Re-archiving a date replaces its partitions rather than adding to them.
+
+Replaying reads a range of weeks back out of the archive. Only the
+partitions inside the range are opened, and the rows are loaded into
+raw_supermarket_staging through the same load table and merge that
+mongodb_to_postgres uses.
+
+Example:
+parquet_archive.main("2023-09-12")
+parquet_archive.replay_into_staging("2023-08-01", "2023-09-12")
+"""
+# Standard Library Imports
+import logging
+import os
+from typing import Iterable, Iterator, List, Optional
+
+# 3rd Party Imports
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+# Custom modules
+from dag_scripts import mongodb_to_postgres
+from dag_scripts import pipeline_metrics
+from dag_scripts.db_connections import connection_manager, db_connection_funcs
+from dag_scripts.product_flattener import ProductFlattener, get_column_kind
+from dag_scripts.tests import test_mongodb_schema_change
+
+# Globals
+DEFAULT_ARCHIVE_DIR = os.environ.get("PARQUET_ARCHIVE_DIR", "/opt/airflow/archive/products")
+CATEGORY_COLUMN = "merchandiseHeir.category"
+PARTITION_COLUMNS = ["date_extracted", CATEGORY_COLUMN]
+PARQUET_COMPRESSION = "zstd"
+MAX_ARCHIVE_PARTITIONS = 4096 # categories in a single write
+REPLAY_BATCH_SIZE = 50000 # rows
+ARROW_TYPES_DICT = {
+    "integer": pa.int64(),
+    "numeric": pa.float64(),
+    "boolean": pa.bool_(),
+    "text": pa.string(),
+}
+
+
+@pipeline_metrics.instrumented_task("parquet_archive")
+def main(date_extracted: Optional[str] = None, archive_dir: str = DEFAULT_ARCHIVE_DIR):
+    """main
+
+    Parameters:
+    1. date_extracted: extraction date (YYYY-MM-DD) to archive.
+        Defaults to the latest date in the MongoDB collection.
+    2. archive_dir: folder of the Parquet dataset
+    """
+    mongodb_client = connection_manager.get_mongodb_client()
+    mongodb_collection = db_connection_funcs.get_mongodb_collection(
+        db_connection_funcs.get_mongodb_database(mongodb_client)
+    )
+    expected_columns_list = test_mongodb_schema_change.get_expected_postgres_columns_list()
+    if date_extracted is None:
+        date_extracted = mongodb_to_postgres.get_latest_date_extracted(mongodb_collection)
+    if date_extracted is None:
+        logging.info("No documents in MongoDB to archive")
+        return
+
+    mongodb_cursor = mongodb_to_postgres.find_documents_for_export(
+        mongodb_collection, expected_columns_list, date_extracted
+    )
+    try:
+        with pipeline_metrics.step("archive") as archive_metrics:
+            archived_rows_int = archive_documents(
+                mongodb_to_postgres.iter_document_batches(mongodb_cursor),
+                archive_dir,
+                expected_columns_list,
+            )
+            archive_metrics.add_rows(archived_rows_int)
+    finally:
+        mongodb_cursor.close()
+    logging.info(
+        "Archived %s products extracted on %s to %s",
+        archived_rows_int,
+        date_extracted,
+        archive_dir,
+    )
+
+
+def build_archive_schema(
+    expected_columns_list: list, sql_data_type_definitions_dict: dict
+) -> pa.Schema:
+    """Build the Arrow schema of the archive from the column contract.
+    Column types match the columns ProductFlattener builds.
+
+    Parameters:
+    1. expected_columns_list: columns of the staging table in order
+    2. sql_data_type_definitions_dict: dictionary from
+        mongodb_to_postgres.define_column_data_types_for_sql()
+
+    Returns:
+    1. archive_schema: pyarrow schema
+    """
+    return pa.schema(
+        [
+            (
+                column_name,
+                ARROW_TYPES_DICT[get_column_kind(sql_data_type_definitions_dict.get(column_name))],
+            )
+            for column_name in expected_columns_list
+        ]
+    )
+
+
+def get_archive_partitioning() -> ds.Partitioning:
+    """Hive partitioning of the archive. Partition values are read back as text."""
+    return ds.partitioning(
+        pa.schema([(column_name, pa.string()) for column_name in PARTITION_COLUMNS]),
+        flavor="hive",
+    )
+
+
+def archive_documents(
+    document_batches: Iterable[list],
+    archive_dir: str = DEFAULT_ARCHIVE_DIR,
+    expected_columns_list: Optional[list] = None,
+) -> int:
+    """Flatten batches of product documents and write them to the archive
+
+    Batches are streamed to the Parquet writer so only one batch is held in
+    memory at a time. Partitions (date and category) written to are
+    replaced, so archiving the same date again does not duplicate it.
+
+    Parameters:
+    1. document_batches: iterable of lists of MongoDB documents
+    2. archive_dir: folder of the Parquet dataset
+    3. expected_columns_list: optional column contract. Defaults to
+        test_mongodb_schema_change.get_expected_postgres_columns_list()
+
+    Returns:
+    1. archived_rows_int: number of products written
+    """
+    if expected_columns_list is None:
+        expected_columns_list = test_mongodb_schema_change.get_expected_postgres_columns_list()
+    sql_data_type_definitions_dict = mongodb_to_postgres.define_column_data_types_for_sql()
+    product_flattener = ProductFlattener(expected_columns_list, sql_data_type_definitions_dict)
+    archive_schema = build_archive_schema(expected_columns_list, sql_data_type_definitions_dict)
+    archived_rows_int = 0
+
+    def iter_record_batches() -> Iterator[pa.RecordBatch]:
+        nonlocal archived_rows_int
+        for document_batch_list in document_batches:
+            flattened_json_df, _ = product_flattener.flatten(document_batch_list)
+            archived_rows_int += len(flattened_json_df)
+            yield pa.RecordBatch.from_pandas(
+                flattened_json_df, schema=archive_schema, preserve_index=False
+            )
+
+    parquet_format = ds.ParquetFileFormat()
+    ds.write_dataset(
+        iter_record_batches(),
+        archive_dir,
+        schema=archive_schema,
+        format=parquet_format,
+        file_options=parquet_format.make_write_options(
+            compression=PARQUET_COMPRESSION, use_dictionary=True
+        ),
+        partitioning=get_archive_partitioning(),
+        basename_template="part-{i}.parquet",
+        existing_data_behavior="delete_matching",
+        max_partitions=MAX_ARCHIVE_PARTITIONS,
+    )
+    return archived_rows_int
+
+
+def open_archive(archive_dir: str = DEFAULT_ARCHIVE_DIR) -> ds.Dataset:
+    """Open the Parquet archive as a pyarrow dataset"""
+    return ds.dataset(archive_dir, format="parquet", partitioning=get_archive_partitioning())
+
+
+def build_archive_filter(
+    start_date: str, end_date: str, categories_list: Optional[List[str]] = None
+) -> ds.Expression:
+    """Filter on the partition columns, so only the matching
+    partitions are read
+
+    Parameters:
+    1. start_date: first extraction date (YYYY-MM-DD) to read, inclusive
+    2. end_date: last extraction date (YYYY-MM-DD) to read, inclusive
+    3. categories_list: optional categories to read. None reads every category
+    """
+    archive_filter = (ds.field("date_extracted") >= start_date) & (
+        ds.field("date_extracted") <= end_date
+    )
+    if categories_list is not None:
+        archive_filter = archive_filter & ds.field(CATEGORY_COLUMN).isin(categories_list)
+    return archive_filter
+
+
+def iter_archive_batches(
+    start_date: str,
+    end_date: str,
+    categories_list: Optional[List[str]] = None,
+    archive_dir: str = DEFAULT_ARCHIVE_DIR,
+    expected_columns_list: Optional[list] = None,
+    batch_size: int = REPLAY_BATCH_SIZE,
+) -> Iterator[pd.DataFrame]:
+    """Read a range of weeks from the archive in batches
+
+    Parameters:
+    1. start_date: first extraction date (YYYY-MM-DD) to read, inclusive
+    2. end_date: last extraction date (YYYY-MM-DD) to read, inclusive
+    3. categories_list: optional categories to read. None reads every category
+    4. archive_dir: folder of the Parquet dataset
+    5. expected_columns_list: optional column contract. Defaults to
+        test_mongodb_schema_change.get_expected_postgres_columns_list()
+    6. batch_size: maximum number of rows in each batch
+
+    Returns:
+    1. Generator of dataframes with the expected columns in order,
+        typed the same as ProductFlattener.flatten()
+    """
+    if expected_columns_list is None:
+        expected_columns_list = test_mongodb_schema_change.get_expected_postgres_columns_list()
+    archive_scanner = open_archive(archive_dir).scanner(
+        columns=expected_columns_list,
+        filter=build_archive_filter(start_date, end_date, categories_list),
+        batch_size=batch_size,
+    )
+    nullable_types_dict = {pa.int64(): pd.Int64Dtype(), pa.bool_(): pd.BooleanDtype()}
+    for record_batch in archive_scanner.to_batches():
+        if record_batch.num_rows:
+            yield record_batch.to_pandas(types_mapper=nullable_types_dict.get)
+
+
+def replay_into_staging(
+    start_date: str,
+    end_date: str,
+    categories_list: Optional[List[str]] = None,
+    archive_dir: str = DEFAULT_ARCHIVE_DIR,
+) -> int:
+    """Load a range of weeks from the archive into raw_supermarket_staging
+
+    Rows are copied into the load table and merged into the staging table in
+    one transaction, the same as mongodb_to_postgres. Rows already in staging
+    are updated, so a range can be replayed more than once.
+
+    Parameters:
+    1. start_date: first extraction date (YYYY-MM-DD) to replay, inclusive
+    2. end_date: last extraction date (YYYY-MM-DD) to replay, inclusive
+    3. categories_list: optional categories to replay. None replays every category
+    4. archive_dir: folder of the Parquet dataset
+
+    Returns:
+    1. merged_rows_int: number of rows inserted or updated in staging
+    """
+    expected_columns_list = test_mongodb_schema_change.get_expected_postgres_columns_list()
+    with connection_manager.postgresql_raw_connection() as postgres_connection:
+        try:
+            with postgres_connection.cursor() as postgres_cursor:
+                mongodb_to_postgres.ensure_staging_table(
+                    postgres_cursor,
+                    expected_columns_list,
+                    mongodb_to_postgres.define_column_data_types_for_sql(),
+                )
+                mongodb_to_postgres.create_load_table(postgres_cursor)
+                for archive_batch_df in iter_archive_batches(
+                    start_date, end_date, categories_list, archive_dir, expected_columns_list
+                ):
+                    mongodb_to_postgres.copy_dataframe_to_postgres(
+                        postgres_cursor,
+                        archive_batch_df,
+                        expected_columns_list,
+                        schema_name=mongodb_to_postgres.LOAD_SCHEMA_NAME,
+                        table_name=mongodb_to_postgres.LOAD_TABLE_NAME,
+                    )
+                merged_rows_int = mongodb_to_postgres.merge_load_table_into_staging(
+                    postgres_cursor, expected_columns_list
+                )
+                mongodb_to_postgres.drop_load_table(postgres_cursor)
+            postgres_connection.commit()
+        except Exception:
+            postgres_connection.rollback()
+            raise
+    logging.info(
+        "Replayed %s rows extracted from %s to %s into %s",
+        merged_rows_int,
+        start_date,
+        end_date,
+        mongodb_to_postgres.STAGING_TABLE_NAME,
+    )
+    return merged_rows_int
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,399 @@
+"""Timing, row count and memory metrics for the pipeline steps of each DAG task
+
+A task's main() is wrapped with the instrumented_task decorator and split
+into steps with the step() context manager:
+
+@pipeline_metrics.instrumented_task("mongodb_to_postgres")
+def main():
+    with pipeline_metrics.step("export") as export_metrics:
+        ...
+        export_metrics.add_rows(copied_rows_int)
+
+For every step the following are recorded:
+
+1. wall_seconds - elapsed time
+2. cpu_seconds - CPU time of the process and of child processes that
+    finished during the step (such as the mongodb_to_postgres export processes)
+3. peak_rss_bytes - peak resident memory of the process (or of its largest
+    child process) at the end of the step, and rss_growth_bytes, how much
+    the step raised the peak of the process
+4. bytes_transferred - bytes sent or received, reported with record_bytes()
+    by the code moving the data (web pages, COPY batches, Redis pipelines)
+5. rows_processed - rows (products) processed by the step
+6. timings - time spent in parts of a step that run many times or in several
+    threads (such as fetching and parsing pages), recorded with timed()
+
+Rows are counted on the step they are added to. Bytes are added to every
+step that is running, so the outermost step, named after the task, has the
+bytes for the whole task.
+
+Once the task finishes, successful or not, its metrics are:
+
+1. pushed to XCom under the key pipeline_metrics
+2. sent to StatsD over UDP, when STATSD_HOST is set, such as
+    supermarket.mongodb_to_postgres.export.wall_seconds:1520|ms
+3. written as a JSON run report to
+    <PIPELINE_REPORT_DIR>/<logical date>/<task name>.json
+    (<task name>_<map index>.json for mapped tasks)
+    so runs can be compared week over week
+
+Reporting never fails the task - errors are logged and the task carries on.
+"""
+# Standard Library Imports
+from contextlib import contextmanager
+from datetime import date, datetime, timezone
+import functools
+import json
+import logging
+import os
+import re
+import resource
+import socket
+import sys
+import threading
+import time
+from typing import Callable, List, Optional
+
+# Globals
+PIPELINE_REPORT_DIR = os.environ.get("PIPELINE_REPORT_DIR", "/opt/airflow/logs/pipeline_metrics")
+STATSD_HOST = os.environ.get("STATSD_HOST")
+STATSD_PORT = int(os.environ.get("STATSD_PORT", "8125"))
+STATSD_PREFIX = os.environ.get("STATSD_PREFIX", "supermarket")
+XCOM_KEY = "pipeline_metrics"
+# ru_maxrss is in kilobytes on Linux and bytes on macOS
+RU_MAXRSS_BYTES = 1 if sys.platform == "darwin" else 1024
+
+
+def get_resource_usage() -> dict:
+    """CPU time and peak memory of this process and its finished child processes"""
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        "cpu_seconds": self_usage.ru_utime
+        + self_usage.ru_stime
+        + children_usage.ru_utime
+        + children_usage.ru_stime,
+        "self_peak_rss_bytes": self_usage.ru_maxrss * RU_MAXRSS_BYTES,
+        "children_peak_rss_bytes": children_usage.ru_maxrss * RU_MAXRSS_BYTES,
+    }
+
+
+class StepMetrics:
+    """Metrics of one step of a task
+
+    Parameters:
+    1. step_name: name of the step, such as export
+    """
+
+    def __init__(self, step_name: str):
+        self.step_name = step_name
+        self.status = "running"
+        self.started_at = datetime.now(timezone.utc).isoformat()
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.peak_rss_bytes = 0
+        self.rss_growth_bytes = 0
+        self.bytes_transferred = 0
+        self.rows_processed = 0
+        self.timings_dict = {}
+        self.lock = threading.Lock()
+
+    def add_rows(self, rows_int: int):
+        """Count rows (products) processed by the step"""
+        with self.lock:
+            self.rows_processed += int(rows_int)
+
+    def add_bytes(self, bytes_int: int):
+        """Count bytes sent or received by the step"""
+        with self.lock:
+            self.bytes_transferred += int(bytes_int)
+
+    def add_timing(self, timing_name: str, seconds: float):
+        """Add the time spent in one part of the step"""
+        with self.lock:
+            timing_dict = self.timings_dict.setdefault(timing_name, {"seconds": 0.0, "calls": 0})
+            timing_dict["seconds"] += seconds
+            timing_dict["calls"] += 1
+
+    def to_dict(self) -> dict:
+        """Metrics as a JSON serialisable dictionary"""
+        return {
+            "step_name": self.step_name,
+            "status": self.status,
+            "started_at": self.started_at,
+            "wall_seconds": round(self.wall_seconds, 6),
+            "cpu_seconds": round(self.cpu_seconds, 6),
+            "peak_rss_bytes": self.peak_rss_bytes,
+            "rss_growth_bytes": self.rss_growth_bytes,
+            "bytes_transferred": self.bytes_transferred,
+            "rows_processed": self.rows_processed,
+            "timings": {
+                timing_name: {
+                    "seconds": round(timing_dict["seconds"], 6),
+                    "calls": timing_dict["calls"],
+                }
+                for timing_name, timing_dict in self.timings_dict.items()
+            },
+        }
+
+
+class TaskMetrics:
+    """Steps recorded while a task runs
+
+    Parameters:
+    1. task_name: name of the task, such as mongodb_to_postgres
+    2. keep_steps: False to forget steps once they finish
+    """
+
+    def __init__(self, task_name: str, keep_steps: bool = True):
+        self.task_name = task_name
+        self.keep_steps = keep_steps
+        self.steps_list = []
+        self.running_steps_list = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def step(self, step_name: str):
+        """Context manager timing a step. Steps can be nested.
+
+        Yields:
+        1. step_metrics: StepMetrics of the step, for add_rows() and add_bytes()
+        """
+        step_metrics = StepMetrics(step_name)
+        with self.lock:
+            if self.keep_steps:
+                self.steps_list.append(step_metrics)
+            self.running_steps_list.append(step_metrics)
+        usage_before_dict = get_resource_usage()
+        start_seconds = time.perf_counter()
+        try:
+            yield step_metrics
+            step_metrics.status = "success"
+        except BaseException:
+            step_metrics.status = "failed"
+            raise
+        finally:
+            usage_after_dict = get_resource_usage()
+            step_metrics.wall_seconds = time.perf_counter() - start_seconds
+            step_metrics.cpu_seconds = (
+                usage_after_dict["cpu_seconds"] - usage_before_dict["cpu_seconds"]
+            )
+            step_metrics.peak_rss_bytes = max(
+                usage_after_dict["self_peak_rss_bytes"],
+                usage_after_dict["children_peak_rss_bytes"],
+            )
+            step_metrics.rss_growth_bytes = (
+                usage_after_dict["self_peak_rss_bytes"] - usage_before_dict["self_peak_rss_bytes"]
+            )
+            with self.lock:
+                self.running_steps_list.remove(step_metrics)
+
+    def get_running_steps(self) -> List[StepMetrics]:
+        """Steps that are running, outermost first"""
+        with self.lock:
+            return list(self.running_steps_list)
+
+    def build_report(self) -> dict:
+        """Run report of the task with every step in the order they started"""
+        return {
+            "task_name": self.task_name,
+            "steps": [step_metrics.to_dict() for step_metrics in self.steps_list],
+        }
+
+
+# Metrics of the instrumented task running in this process. Steps outside
+# an instrumented task (such as in tests) are measured but never reported.
+UNREPORTED_TASK_METRICS = TaskMetrics("unreported", keep_steps=False)
+CURRENT_TASK_METRICS = UNREPORTED_TASK_METRICS
+
+
+def get_task_metrics() -> TaskMetrics:
+    """Metrics of the task running in this process"""
+    return CURRENT_TASK_METRICS
+
+
+def step(step_name: str):
+    """Context manager timing a step of the running task (see TaskMetrics.step)"""
+    return get_task_metrics().step(step_name)
+
+
+def record_bytes(bytes_int: int):
+    """Count bytes sent or received by every running step"""
+    for step_metrics in get_task_metrics().get_running_steps():
+        step_metrics.add_bytes(bytes_int)
+
+
+@contextmanager
+def timed(timing_name: str):
+    """Context manager adding the time spent in a part of a step to the
+    innermost running step. Safe to use from several threads."""
+    start_seconds = time.perf_counter()
+    try:
+        yield
+    finally:
+        running_steps_list = get_task_metrics().get_running_steps()
+        if running_steps_list:
+            running_steps_list[-1].add_timing(timing_name, time.perf_counter() - start_seconds)
+
+
+def instrumented_task(task_name: str) -> Callable:
+    """Decorator recording the metrics of a task's main() and reporting them
+    once it finishes (see report_task_metrics())
+
+    Parameters:
+    1. task_name: name the metrics are reported under
+    """
+
+    def decorator(task_function: Callable) -> Callable:
+        @functools.wraps(task_function)
+        def wrapper(*args, **kwargs):
+            global CURRENT_TASK_METRICS
+            task_metrics = TaskMetrics(task_name)
+            CURRENT_TASK_METRICS = task_metrics
+            try:
+                with task_metrics.step(task_name):
+                    return task_function(*args, **kwargs)
+            finally:
+                CURRENT_TASK_METRICS = UNREPORTED_TASK_METRICS
+                report_task_metrics(task_metrics)
+
+        return wrapper
+
+    return decorator
+
+
+def report_task_metrics(task_metrics: TaskMetrics, report_dir: Optional[str] = None) -> dict:
+    """Push a task's metrics to XCom and StatsD and write its JSON run report.
+    Errors are logged rather than raised so reporting never fails the task.
+
+    Parameters:
+    1. task_metrics: TaskMetrics of the finished task
+    2. report_dir: folder the JSON run reports are written under.
+        Defaults to PIPELINE_REPORT_DIR
+
+    Returns:
+    1. task_report_dict: the run report
+    """
+    airflow_context = get_airflow_context()
+    task_report_dict = task_metrics.build_report()
+    task_report_dict["run_date"] = (
+        airflow_context["ds"] if airflow_context else str(date.today())
+    )
+    task_report_dict["run_id"] = airflow_context["run_id"] if airflow_context else None
+    # Tasks mapped over categories or shards share a task name
+    task_report_dict["map_index"] = (
+        getattr(airflow_context["ti"], "map_index", -1) if airflow_context else -1
+    )
+    for step_dict in task_report_dict["steps"]:
+        logging.info(
+            "%s step %s %s in %.3f seconds (%.3f CPU seconds), %s rows, %s bytes, peak RSS %s bytes",
+            task_metrics.task_name,
+            step_dict["step_name"],
+            step_dict["status"],
+            step_dict["wall_seconds"],
+            step_dict["cpu_seconds"],
+            step_dict["rows_processed"],
+            step_dict["bytes_transferred"],
+            step_dict["peak_rss_bytes"],
+        )
+
+    for report_function, report_args in (
+        (push_report_to_xcom, (airflow_context, task_report_dict)),
+        (send_report_to_statsd, (task_report_dict, STATSD_HOST, STATSD_PORT, STATSD_PREFIX)),
+        (write_report_file, (task_report_dict, report_dir or PIPELINE_REPORT_DIR)),
+    ):
+        try:
+            report_function(*report_args)
+        except Exception as error:
+            logging.warning("Could not report pipeline metrics with %s: %s",
+                            report_function.__name__, error)
+    return task_report_dict
+
+
+def get_airflow_context() -> Optional[dict]:
+    """Airflow context of the running task, or None outside an Airflow task"""
+    try:
+        from airflow.operators.python import get_current_context
+        return get_current_context()
+    except Exception:
+        return None
+
+
+def push_report_to_xcom(airflow_context: Optional[dict], task_report_dict: dict):
+    """Push the run report to XCom. Does nothing outside an Airflow task."""
+    if airflow_context is not None:
+        airflow_context["ti"].xcom_push(key=XCOM_KEY, value=task_report_dict)
+
+
+def build_statsd_lines(task_report_dict: dict, prefix: str = STATSD_PREFIX) -> List[str]:
+    """StatsD lines for every step of a run report
+
+    1. timers (|ms) - wall time, CPU time and timings, in milliseconds
+    2. gauges (|g) - peak memory
+    3. counters (|c) - bytes transferred and rows processed
+    """
+    statsd_lines_list = []
+    for step_dict in task_report_dict["steps"]:
+        metric_prefix = ".".join(
+            get_statsd_name(name_part)
+            for name_part in (prefix, task_report_dict["task_name"], step_dict["step_name"])
+        )
+        statsd_lines_list.extend(
+            [
+                f"{metric_prefix}.wall_seconds:{step_dict['wall_seconds'] * 1000:.3f}|ms",
+                f"{metric_prefix}.cpu_seconds:{step_dict['cpu_seconds'] * 1000:.3f}|ms",
+                f"{metric_prefix}.peak_rss_bytes:{step_dict['peak_rss_bytes']}|g",
+                f"{metric_prefix}.bytes_transferred:{step_dict['bytes_transferred']}|c",
+                f"{metric_prefix}.rows_processed:{step_dict['rows_processed']}|c",
+            ]
+        )
+        for timing_name, timing_dict in step_dict["timings"].items():
+            statsd_lines_list.append(
+                f"{metric_prefix}.{get_statsd_name(timing_name)}:"
+                f"{timing_dict['seconds'] * 1000:.3f}|ms"
+            )
+    return statsd_lines_list
+
+
+def get_statsd_name(name: str) -> str:
+    """Replace characters StatsD uses as separators in a metric name"""
+    return re.sub(r"[^A-Za-z0-9_\-]", "_", name)
+
+
+def send_report_to_statsd(
+    task_report_dict: dict,
+    host: Optional[str] = STATSD_HOST,
+    port: int = STATSD_PORT,
+    prefix: str = STATSD_PREFIX,
+) -> int:
+    """Send the run report to StatsD over UDP, one metric per packet.
+    Does nothing when no StatsD host is set.
+
+    Returns:
+    1. sent_metrics_int: number of metrics sent
+    """
+    if not host:
+        return 0
+    statsd_lines_list = build_statsd_lines(task_report_dict, prefix)
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as statsd_socket:
+        for statsd_line in statsd_lines_list:
+            statsd_socket.sendto(statsd_line.encode("utf-8"), (host, port))
+    return len(statsd_lines_list)
+
+
+def write_report_file(task_report_dict: dict, report_dir: str = PIPELINE_REPORT_DIR) -> str:
+    """Write the run report to <report_dir>/<run date>/<task name>.json,
+    or <task name>_<map index>.json for a mapped task
+
+    Returns:
+    1. report_path: path of the written report
+    """
+    run_report_dir = os.path.join(report_dir, task_report_dict["run_date"])
+    os.makedirs(run_report_dir, exist_ok=True)
+    report_name = task_report_dict["task_name"]
+    if task_report_dict.get("map_index", -1) >= 0:
+        report_name = f"{report_name}_{task_report_dict['map_index']}"
+    report_path = os.path.join(run_report_dir, f"{report_name}.json")
+    with open(report_path, "w", encoding="utf-8") as report_file:
+        json.dump(task_report_dict, report_file, indent=4)
+    return report_path
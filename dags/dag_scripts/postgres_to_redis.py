@@ -1,30 +1,80 @@
 """Retrieves data from PostgreSQL
 and stores it in Redis for caching
 
-Currently uses the total price of all items
-for the current week as an example piece of data
-to store in redis
+Stores the total price of all items for the current week
+(current_weekly_price_all_items) and precomputed aggregates from the
+data marts so dashboards can read them from Redis instead of querying PostgreSQL:
+
+1. Price history for each product (mart_pricing_over_time)
+2. Weekly total price for each category (mart_pricing_over_time)
+3. Current specials (mart_specials_over_time)
+
+Aggregates are published with redis_publisher.RedisPublisher, which writes
+them under a new version of their keys, for example
+supermarket:20230912T010203:product:Apple:prices
+and then switches the supermarket:current_version pointer to it, so readers
+see either the old or the new aggregates and never a mix.
+
+Key layout (under supermarket:<version>:)
+1. product:<product name>:prices - hash of {pricing date: price}
+2. products:latest_price - sorted set of product names scored by latest price
+3. category:<category>:weekly_totals - hash of {pricing date: total price}
+4. categories:latest_total - sorted set of categories scored by latest weekly total
+5. specials:current - hash of {product name: JSON special details}
+6. specials:current_by_savings - sorted set of product names scored by savings
+
+The aggregates are read with db_connections.price_cache_client.PriceCacheClient,
+which also defines the queries used here so the published aggregates and the
+client's PostgreSQL fallback always match.
 """
 # Standard Library
 import logging
+from typing import Optional
 
 # 3rd Party Imports
 import pandas as pd
 import sqlalchemy
 from sqlalchemy import text
 
-from dag_scripts.db_connections import db_connection_funcs
+from dag_scripts import pipeline_metrics
+from dag_scripts.db_connections import connection_manager
+from dag_scripts.db_connections.price_cache_client import (
+    CATEGORY_TOTALS,
+    CURRENT_SPECIALS_KEY_PARTS,
+    CURRENT_SPECIALS_SQL_QUERY,
+    PRODUCT_PRICES,
+    build_current_specials,
+    encode_special_details,
+)
+from dag_scripts.redis_publisher import REDIS_NAMESPACE, RedisPublisher
 
 
+@pipeline_metrics.instrumented_task("postgres_to_redis")
 def main():
     """main"""
-    postgres_engine = db_connection_funcs.create_postgresql_engine()
-    sql_query_str = get_sql_query_current_pricing()
-    sql_query_result = execute_sql_query(postgres_engine, sql_query_str)
-    postgres_engine.dispose()
-    redis_conn = db_connection_funcs.get_redis_connection()
-    set_redis_value(redis_conn, sql_query_result)
-    redis_conn.close()
+    postgres_engine = connection_manager.get_postgresql_engine()
+    with pipeline_metrics.step("query_marts") as query_metrics:
+        sql_query_str = get_sql_query_current_pricing()
+        sql_query_result = execute_sql_query(postgres_engine, sql_query_str)
+        product_prices_df = execute_sql_query(
+            postgres_engine, get_sql_query_product_price_history()
+        )
+        category_totals_df = execute_sql_query(
+            postgres_engine, get_sql_query_category_weekly_totals()
+        )
+        current_specials_df = execute_sql_query(
+            postgres_engine, get_sql_query_current_specials()
+        )
+        query_metrics.add_rows(
+            len(product_prices_df) + len(category_totals_df) + len(current_specials_df)
+        )
+    redis_conn = connection_manager.get_redis_connection()
+    with pipeline_metrics.step("publish"):
+        set_redis_value(redis_conn, sql_query_result)
+        aggregates_version = publish_price_aggregates(
+            redis_conn, product_prices_df, category_totals_df, current_specials_df
+        )
+    logging.info("Published Redis price aggregates version %s", aggregates_version)
 
 
 def get_sql_query_current_pricing() -> str:
@@ -53,6 +103,39 @@ def get_sql_query_current_pricing() -> str:
     return query
 
 
+def get_sql_query_product_price_history():
+    """Defines a SQL query for the price of each product on each pricing date
+    (see price_cache_client.PRODUCT_PRICES)
+
+    Parameters: None
+
+    Returns: PostgreSQL query as a sqlalchemy text clause
+    """
+    return PRODUCT_PRICES.build_sql_query(names_list_bound=False)
+
+
+def get_sql_query_category_weekly_totals():
+    """Defines a SQL query for the total price of all items
+    in each category on each pricing date (see price_cache_client.CATEGORY_TOTALS)
+
+    Parameters: None
+
+    Returns: PostgreSQL query as a sqlalchemy text clause
+    """
+    return CATEGORY_TOTALS.build_sql_query(names_list_bound=False)
+
+
+def get_sql_query_current_specials():
+    """Defines a SQL query for the specials on the latest extraction date
+    (see price_cache_client.CURRENT_SPECIALS_SQL_QUERY)
+
+    Parameters: None
+
+    Returns: PostgreSQL query as a sqlalchemy text clause
+    """
+    return CURRENT_SPECIALS_SQL_QUERY
+
+
 def execute_sql_query(postgres_connection, sql_query_str):
     """Execute the sql query and load it directly into pandas
     Raise an excepton if the query is not read properly
@@ -86,5 +169,99 @@ def set_redis_value(redis_connection, sql_query_result: pd.DataFrame):
     redis_connection.set("current_weekly_price_all_items", redis_sum_value_float)
 
 
+def build_price_aggregates(
+    product_prices_df: pd.DataFrame,
+    category_totals_df: pd.DataFrame,
+    current_specials_df: pd.DataFrame,
+) -> tuple:
+    """Build the Redis hashes and sorted sets from the query results.
+    Keys are built without their namespace and version prefix.
+
+    Parameters:
+    1. product_prices_df: result of get_sql_query_product_price_history()
+    2. category_totals_df: result of get_sql_query_category_weekly_totals()
+    3. current_specials_df: result of get_sql_query_current_specials()
+
+    Returns:
+    1. hashes_dict: {key parts tuple: {field: value}} for HSET
+    2. sorted_sets_dict: {key parts tuple: {member: score}} for ZADD
+    """
+    hashes_dict = {}
+    sorted_sets_dict = {}
+
+    latest_prices_dict = {}
+    for product_name, pricing_date, price_aud in product_prices_df[
+        ["product_name", "pricing_date", "price_aud"]
+    ].itertuples(index=False):
+        hashes_dict.setdefault(PRODUCT_PRICES.redis_key_parts(product_name), {})[
+            str(pricing_date)
+        ] = float(price_aud)
+        if str(pricing_date) >= latest_prices_dict.get(product_name, ("", 0.0))[0]:
+            latest_prices_dict[product_name] = (str(pricing_date), float(price_aud))
+    sorted_sets_dict[("products", "latest_price")] = {
+        product_name: price_aud for product_name, (_, price_aud) in latest_prices_dict.items()
+    }
+
+    latest_totals_dict = {}
+    for product_category, pricing_date, total_price_aud in category_totals_df[
+        ["product_category", "pricing_date", "total_price_aud"]
+    ].itertuples(index=False):
+        hashes_dict.setdefault(CATEGORY_TOTALS.redis_key_parts(product_category), {})[
+            str(pricing_date)
+        ] = float(total_price_aud)
+        if str(pricing_date) >= latest_totals_dict.get(product_category, ("", 0.0))[0]:
+            latest_totals_dict[product_category] = (str(pricing_date), float(total_price_aud))
+    sorted_sets_dict[("categories", "latest_total")] = {
+        product_category: total_price_aud
+        for product_category, (_, total_price_aud) in latest_totals_dict.items()
+    }
+
+    current_specials_dict = build_current_specials(current_specials_df)
+    hashes_dict[CURRENT_SPECIALS_KEY_PARTS] = {
+        product_name: encode_special_details(special_details_dict)
+        for product_name, special_details_dict in current_specials_dict.items()
+    }
+    sorted_sets_dict[("specials", "current_by_savings")] = {
+        product_name: float(special_details_dict["savings"])
+        for product_name, special_details_dict in current_specials_dict.items()
+        if special_details_dict["savings"] is not None
+    }
+    return hashes_dict, sorted_sets_dict
+
+
+def publish_price_aggregates(
+    redis_connection,
+    product_prices_df: pd.DataFrame,
+    category_totals_df: pd.DataFrame,
+    current_specials_df: pd.DataFrame,
+    namespace: str = REDIS_NAMESPACE,
+    version: Optional[str] = None,
+) -> str:
+    """Write the price aggregates under a new version of their keys
+    and then switch the version pointer to it
+
+    Parameters:
+    1. redis_connection: connection from connection_manager.get_redis_connection()
+    2. product_prices_df: result of get_sql_query_product_price_history()
+    3. category_totals_df: result of get_sql_query_category_weekly_totals()
+    4. current_specials_df: result of get_sql_query_current_specials()
+    5. namespace: prefix for every key
+    6. version: optional version name. Defaults to the current UTC time
+
+    Returns:
+    1. version: the version that was published
+    """
+    hashes_dict, sorted_sets_dict = build_price_aggregates(
+        product_prices_df, category_totals_df, current_specials_df
+    )
+    with RedisPublisher(redis_connection, namespace, version) as redis_publisher:
+        for key_parts, mapping_dict in hashes_dict.items():
+            redis_publisher.hset(key_parts, mapping_dict)
+        for key_parts, mapping_dict in sorted_sets_dict.items():
+            redis_publisher.zadd(key_parts, mapping_dict)
+        redis_publisher.publish()
+    return redis_publisher.version
+
+
 if __name__ == "__main__":
     main()
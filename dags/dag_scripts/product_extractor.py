@@ -0,0 +1,148 @@
+"""Single pass extraction of product JSON from the raw Coles website text
+
+The Coles website is built with Next.js, which embeds all the page data
+in one JSON payload inside a <script id="__NEXT_DATA__"> tag. Rather than
+running a regular expression over the whole page and parsing each match
+again, the payload is located once and decoded in place with
+json.JSONDecoder.raw_decode. The decoded tree is then walked and every
+object with "_type": "PRODUCT" is yielded.
+
+Decoding the real JSON (rather than matching closing braces) means products
+with nested objects of any depth are returned whole. The old regex
+approach silently dropped products nested deeper than three braces.
+
+If the payload can not be found or decoded, or holds no products (for
+example if the site moves the products into a lazily loaded blob outside
+it), the extractor falls back to raw decoding each product object in
+place, starting from every '{"_type":"PRODUCT"' found in the text. A page
+where neither finds a product is logged as a warning, as the crawl treats
+it as the end of the category.
+"""
+# Standard Library Imports
+import json
+import logging
+from typing import Iterator, Optional
+
+# Globals
+NEXT_DATA_SCRIPT_STR = 'id="__NEXT_DATA__"'
+PRODUCT_START_STR = '{"_type":"PRODUCT"'
+PRODUCT_TYPE_STR = "PRODUCT"
+
+_JSON_DECODER = json.JSONDecoder()
+
+
+def iter_products_from_webpage_text(raw_webpage_text_str: str) -> Iterator[dict]:
+    """Yield every product JSON object found in the raw website text
+
+    Parameters:
+    1. raw_webpage_text_str: raw text of a single webpage as returned by
+        website_to_mongodb.extract_single_webpage_text()
+
+    Returns:
+    1. Generator of product JSON objects (dictionaries)
+    """
+    products_found_bool = False
+    embedded_payload = extract_embedded_json_payload(raw_webpage_text_str)
+    if embedded_payload is not None:
+        for product_obj in iter_product_objs(embedded_payload):
+            products_found_bool = True
+            yield product_obj
+        if products_found_bool:
+            return
+
+    for product_obj in raw_decode_product_objs(raw_webpage_text_str):
+        products_found_bool = True
+        yield product_obj
+    if not products_found_bool:
+        logging.warning(
+            "No products found on the page (payload %s). Either the category has "
+            "no more pages or the page layout has changed.",
+            "found" if embedded_payload is not None else "not found",
+        )
+
+
+def extract_embedded_json_payload(raw_webpage_text_str: str) -> Optional[object]:
+    """Find and decode the Next.js JSON payload embedded in the page
+
+    The payload is decoded in place, starting from the end of the opening
+    script tag, so no copy of the payload string is made.
+
+    Parameters:
+    1. raw_webpage_text_str: raw text of a single webpage
+
+    Returns:
+    1. embedded_payload: the decoded payload or None if the page has no
+        payload or the payload can not be decoded
+    """
+    script_tag_index = raw_webpage_text_str.find(NEXT_DATA_SCRIPT_STR)
+    if script_tag_index == -1:
+        return None
+    payload_start_index = raw_webpage_text_str.find(">", script_tag_index) + 1
+    if payload_start_index == 0:
+        return None
+
+    try:
+        embedded_payload, _ = _JSON_DECODER.raw_decode(
+            raw_webpage_text_str, payload_start_index
+        )
+    except ValueError:
+        logging.warning("Embedded page JSON could not be decoded. Falling back to product scan.")
+        return None
+    return embedded_payload
+
+
+def iter_product_objs(json_tree) -> Iterator[dict]:
+    """Walk a decoded JSON tree and yield each product object
+
+    Uses an explicit stack rather than recursion so deeply nested
+    payloads can not hit the recursion limit. Products are not searched
+    for further products inside them.
+
+    Parameters:
+    1. json_tree: decoded JSON - any mix of dictionaries and lists
+
+    Returns:
+    1. Generator of product JSON objects in the order they appear on the page
+    """
+    stack_list = [json_tree]
+    while stack_list:
+        node = stack_list.pop()
+        if isinstance(node, dict):
+            if node.get("_type") == PRODUCT_TYPE_STR:
+                yield node
+                continue
+            children = node.values()
+        elif isinstance(node, list):
+            children = node
+        else:
+            continue
+        # Reversed so items are popped off the stack in page order
+        stack_list.extend(
+            child for child in reversed(list(children)) if isinstance(child, (dict, list))
+        )
+
+
+def raw_decode_product_objs(raw_webpage_text_str: str) -> Iterator[dict]:
+    """Fallback extractor that decodes each product object in place
+
+    Parameters:
+    1. raw_webpage_text_str: raw text of a single webpage
+
+    Returns:
+    1. Generator of product JSON objects
+    """
+    search_index = raw_webpage_text_str.find(PRODUCT_START_STR)
+    while search_index != -1:
+        try:
+            product_obj, end_index = _JSON_DECODER.raw_decode(
+                raw_webpage_text_str, search_index
+            )
+        except ValueError:
+            logging.warning(
+                "ERROR ON ITEM AT POSITION %s. Item will not be added to MongoDB.",
+                search_index,
+            )
+            end_index = search_index + len(PRODUCT_START_STR)
+        else:
+            yield product_obj
+        search_index = raw_webpage_text_str.find(PRODUCT_START_STR, end_index)
@@ -0,0 +1,158 @@
+"""Schema aware flattener for the product documents exported from MongoDB
+
+pd.json_normalize walks every key of every document to discover the
+columns, builds an object column for each, and the result then needs a
+second astype copy before it can be loaded into PostgreSQL. The columns of
+the staging table are already known (the column contract in
+test_mongodb_schema_change.get_expected_postgres_columns_list), so this
+module compiles that list once into a tree of keys and then:
+
+1. Walks each document only along the keys in the tree
+2. Fills preallocated lists - one per column - in a single pass
+3. Builds each column straight into its final type (nullable integer,
+    nullable boolean, float or text) so no further astype is needed
+
+Text columns hold strings or None. Values that are not strings (such as the
+MongoDB ObjectId or the list in restrictions.delivery) are converted with str(), the
+same as the astype(str) in mongodb_to_postgres.change_data_types_for_problem_columns.
+"""
+# Standard Library Imports
+from typing import Iterable, Tuple
+
+# 3rd Party Imports
+import pandas as pd
+import sqlalchemy
+
+# Globals
+_MISSING = object()
+
+
+class ProductFlattener:
+    """Flattens product documents into a typed dataframe with
+    exactly the expected columns in the expected order
+
+    Parameters:
+    1. expected_columns_list: flattened (dotted) column names in staging table order
+    2. sql_data_type_definitions_dict: dictionary from
+        mongodb_to_postgres.define_column_data_types_for_sql(). Columns not
+        in the dictionary are text.
+    """
+
+    def __init__(self, expected_columns_list: list, sql_data_type_definitions_dict: dict):
+        self.expected_columns_list = list(expected_columns_list)
+        self.column_kinds_list = [
+            get_column_kind(sql_data_type_definitions_dict.get(column_name))
+            for column_name in self.expected_columns_list
+        ]
+        self.key_tree = compile_key_tree(self.expected_columns_list)
+
+    def flatten(self, documents: Iterable[dict]) -> Tuple[pd.DataFrame, set]:
+        """Flatten a batch of documents
+
+        Parameters:
+        1. documents: list (or other iterable) of MongoDB documents
+
+        Returns:
+        1. flattened_dataframe: typed dataframe with the expected columns
+        2. seen_columns_set: expected columns present in at least one document.
+            Used for the schema change check.
+        """
+        documents_list = documents if isinstance(documents, list) else list(documents)
+        row_count = len(documents_list)
+        column_count = len(self.expected_columns_list)
+        column_values_list = [[None] * row_count for _ in range(column_count)]
+        seen_columns_list = [False] * column_count
+
+        def fill_row(node: dict, key_tree: dict, row_index: int):
+            for key, subtree in key_tree.items():
+                value = node.get(key, _MISSING)
+                if value is _MISSING:
+                    continue
+                if isinstance(subtree, int):
+                    column_values_list[subtree][row_index] = value
+                    seen_columns_list[subtree] = True
+                elif isinstance(value, dict):
+                    fill_row(value, subtree, row_index)
+
+        for row_index, document in enumerate(documents_list):
+            fill_row(document, self.key_tree, row_index)
+
+        typed_columns_dict = {
+            column_name: build_typed_column(column_values, column_kind)
+            for column_name, column_values, column_kind in zip(
+                self.expected_columns_list, column_values_list, self.column_kinds_list
+            )
+        }
+        flattened_dataframe = pd.DataFrame(typed_columns_dict, copy=False)
+        seen_columns_set = {
+            column_name
+            for column_name, seen_bool in zip(self.expected_columns_list, seen_columns_list)
+            if seen_bool
+        }
+        return flattened_dataframe, seen_columns_set
+
+
+def compile_key_tree(expected_columns_list: list) -> dict:
+    """Compile dotted column names into a nested dictionary of keys.
+    Leaves are the column's position in expected_columns_list.
+
+    For example ["_id", "pricing.now", "pricing.unit.price"] becomes
+    {"_id": 0, "pricing": {"now": 1, "unit": {"price": 2}}}
+
+    A column that is also the parent of other columns can not be both a
+    leaf and a branch, so the branch (child columns) wins.
+    """
+    key_tree = {}
+    for column_index, column_name in enumerate(expected_columns_list):
+        *parent_keys, leaf_key = column_name.split(".")
+        node = key_tree
+        for key in parent_keys:
+            if not isinstance(node.get(key), dict):
+                node[key] = {}
+            node = node[key]
+        if not isinstance(node.get(leaf_key), dict):
+            node[leaf_key] = column_index
+    return key_tree
+
+
+def get_column_kind(sql_data_type) -> str:
+    """Map a sqlalchemy data type to the kind of column to build
+
+    Returns:
+    1. one of "integer", "boolean", "numeric" or "text"
+    """
+    if isinstance(sql_data_type, sqlalchemy.types.INTEGER):
+        return "integer"
+    if isinstance(sql_data_type, sqlalchemy.types.BOOLEAN):
+        return "boolean"
+    if isinstance(sql_data_type, sqlalchemy.types.NUMERIC):
+        return "numeric"
+    return "text"
+
+
+def build_typed_column(column_values: list, column_kind: str):
+    """Build a single typed column from a list of raw values
+
+    Numbers stored as text are parsed and text in a numeric column
+    raises an error rather than being silently loaded.
+
+    Parameters:
+    1. column_values: raw values with None for missing values
+    2. column_kind: kind from get_column_kind()
+
+    Returns:
+    1. pandas array or series of the final column type
+    """
+    if column_kind == "integer":
+        return pd.to_numeric(pd.Series(column_values, dtype=object)).astype("Int64")
+    if column_kind == "numeric":
+        return pd.to_numeric(pd.Series(column_values, dtype=object)).astype("float64")
+    if column_kind == "boolean":
+        return pd.array(column_values, dtype="boolean")
+    return pd.Series(
+        [
+            value if value is None or isinstance(value, str) else str(value)
+            for value in column_values
+        ],
+        dtype=object,
+    )
@@ -0,0 +1,217 @@
+"""Batched writer that publishes a new version of a set of Redis keys
+
+Every key is written under a fresh version of a namespace, for example
+supermarket:20230912T010203000000:products:latest_price
+and readers only ever use the version named by the namespace's version
+pointer (supermarket:current_version). Publishing switches the pointer in a
+single SET, so readers see either the old or the new keys and never a
+half written mix of the two.
+
+Writes are queued in non-transactional pipelines which are sent once they
+hold about max_pipeline_bytes of commands. One round trip per pipeline
+rather than per command keeps publishing fast without building a single
+request large enough to stall Redis or the network. Large hashes and sorted
+sets are split over several commands so each stays within the budget.
+
+Keys of the version that was replaced (and of a version abandoned
+because publishing failed) are given a TTL rather than deleted, so readers
+that already looked up the old version can finish.
+
+Example:
+with RedisPublisher(redis_connection, "supermarket") as redis_publisher:
+    redis_publisher.hset(("product", "Apple", "prices"), {"2023-09-12": 1.5})
+    redis_publisher.publish()
+"""
+# Standard Library Imports
+from datetime import datetime, timezone
+import logging
+from typing import Optional
+
+# Custom modules
+from dag_scripts import pipeline_metrics
+from dag_scripts.db_connections import connection_manager
+
+# Globals
+REDIS_NAMESPACE = "supermarket"
+MAX_PIPELINE_BYTES = 512 * 1024
+OLD_VERSION_TTL_SECONDS = 60 * 60
+# Rough size of the RESP framing around each command argument
+ARGUMENT_OVERHEAD_BYTES = 16
+
+
+def get_version_pointer_key(namespace: str = REDIS_NAMESPACE) -> str:
+    """Key holding the version of a namespace readers should use"""
+    return f"{namespace}:current_version"
+
+
+def build_versioned_key(namespace: str, version: str, *key_parts) -> str:
+    """Build a versioned key such as supermarket:<version>:products:latest_price"""
+    return ":".join([namespace, version, *[str(key_part) for key_part in key_parts]])
+
+
+def get_current_version(redis_connection, namespace: str = REDIS_NAMESPACE) -> Optional[str]:
+    """Get the published version of a namespace, or None if nothing was published"""
+    return redis_connection.get(get_version_pointer_key(namespace))
+
+
+def expire_version(
+    redis_connection,
+    namespace: str,
+    version: str,
+    ttl_seconds: int = OLD_VERSION_TTL_SECONDS,
+) -> int:
+    """Set every key of a version to expire
+
+    Returns:
+    1. expired_keys_int: number of keys given a TTL
+    """
+    redis_pipeline = redis_connection.pipeline(transaction=False)
+    expired_keys_int = 0
+    for versioned_key in redis_connection.scan_iter(
+        match=build_versioned_key(namespace, version, "*"), count=1000
+    ):
+        redis_pipeline.expire(versioned_key, ttl_seconds)
+        expired_keys_int += 1
+    redis_pipeline.execute()
+    return expired_keys_int
+
+
+def estimate_argument_bytes(argument) -> int:
+    """Estimate the bytes a command argument takes up in a pipeline"""
+    if isinstance(argument, bytes):
+        return len(argument) + ARGUMENT_OVERHEAD_BYTES
+    return len(str(argument).encode("utf-8")) + ARGUMENT_OVERHEAD_BYTES
+
+
+class RedisPublisher:
+    """Writes a new version of a namespace's keys through byte budgeted
+    pipelines and publishes it by switching the version pointer
+
+    Parameters:
+    1. redis_connection: optional connection. Defaults to
+        connection_manager.get_redis_connection()
+    2. namespace: prefix for every key and for the version pointer
+    3. version: optional version name. Defaults to the current UTC time
+    4. max_pipeline_bytes: approximate size a pipeline is sent at
+    5. old_version_ttl_seconds: TTL given to the keys of replaced versions
+    """
+
+    def __init__(
+        self,
+        redis_connection=None,
+        namespace: str = REDIS_NAMESPACE,
+        version: Optional[str] = None,
+        max_pipeline_bytes: int = MAX_PIPELINE_BYTES,
+        old_version_ttl_seconds: int = OLD_VERSION_TTL_SECONDS,
+    ):
+        self.redis_connection = redis_connection or connection_manager.get_redis_connection()
+        self.namespace = namespace
+        self.version = version or datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+        self.max_pipeline_bytes = max_pipeline_bytes
+        self.old_version_ttl_seconds = old_version_ttl_seconds
+        self.pipeline = self.redis_connection.pipeline(transaction=False)
+        self.pending_bytes = 0
+        self.commands_int = 0
+        self.round_trips_int = 0
+        self.published = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and not self.published:
+            # Nothing reads an unpublished version, so let its keys expire
+            self.pipeline.reset()
+            expire_version(
+                self.redis_connection, self.namespace, self.version, self.old_version_ttl_seconds
+            )
+
+    def key(self, *key_parts) -> str:
+        """Full key for this version, such as supermarket:<version>:specials:current"""
+        return build_versioned_key(self.namespace, self.version, *key_parts)
+
+    def set(self, key_parts: tuple, value):
+        """Queue a SET of a string value"""
+        self._queue("set", key_parts, [value], lambda key, _: self.pipeline.set(key, value))
+
+    def hset(self, key_parts: tuple, mapping_dict: dict):
+        """Queue HSET commands for a hash, split to fit the byte budget"""
+        self._queue_mapping(
+            key_parts, mapping_dict, lambda key, chunk_dict: self.pipeline.hset(key, mapping=chunk_dict)
+        )
+
+    def zadd(self, key_parts: tuple, mapping_dict: dict):
+        """Queue ZADD commands for a sorted set of {member: score},
+        split to fit the byte budget"""
+        self._queue_mapping(
+            key_parts, mapping_dict, lambda key, chunk_dict: self.pipeline.zadd(key, chunk_dict)
+        )
+
+    def _queue_mapping(self, key_parts: tuple, mapping_dict: dict, queue_command):
+        """Queue a command for each chunk of a mapping that fits the byte budget"""
+        chunk_dict = {}
+        chunk_bytes = 0
+        for field, value in mapping_dict.items():
+            field_bytes = estimate_argument_bytes(field) + estimate_argument_bytes(value)
+            if chunk_dict and chunk_bytes + field_bytes > self.max_pipeline_bytes:
+                self._queue_command(self.key(*key_parts), chunk_dict, chunk_bytes, queue_command)
+                chunk_dict = {}
+                chunk_bytes = 0
+            chunk_dict[field] = value
+            chunk_bytes += field_bytes
+        if chunk_dict:
+            self._queue_command(self.key(*key_parts), chunk_dict, chunk_bytes, queue_command)
+
+    def _queue(self, command_name: str, key_parts: tuple, arguments_list: list, queue_command):
+        """Queue a single command"""
+        command_bytes = estimate_argument_bytes(command_name) + sum(
+            estimate_argument_bytes(argument) for argument in arguments_list
+        )
+        self._queue_command(self.key(*key_parts), None, command_bytes, queue_command)
+
+    def _queue_command(self, key: str, chunk, command_bytes: int, queue_command):
+        """Add a command to the pipeline, sending the pipeline first
+        if the command would take it over the byte budget"""
+        command_bytes += estimate_argument_bytes(key)
+        if self.pending_bytes and self.pending_bytes + command_bytes > self.max_pipeline_bytes:
+            self.flush()
+        queue_command(key, chunk)
+        self.pending_bytes += command_bytes
+        self.commands_int += 1
+
+    def flush(self):
+        """Send every queued command"""
+        if self.pending_bytes == 0:
+            return
+        self.pipeline.execute()
+        self.round_trips_int += 1
+        pipeline_metrics.record_bytes(self.pending_bytes)
+        self.pending_bytes = 0
+
+    def publish(self) -> Optional[str]:
+        """Send any queued commands and switch the version pointer to this version.
+        The keys of the version that was replaced are set to expire.
+
+        Returns:
+        1. previous_version: version that was replaced, or None
+        """
+        self.flush()
+        previous_version = self.redis_connection.set(
+            get_version_pointer_key(self.namespace), self.version, get=True
+        )
+        self.published = True
+        if previous_version is not None and previous_version != self.version:
+            expire_version(
+                self.redis_connection,
+                self.namespace,
+                previous_version,
+                self.old_version_ttl_seconds,
+            )
+        logging.info(
+            "Published %s version %s: %s commands in %s round trips",
+            self.namespace,
+            self.version,
+            self.commands_int,
+            self.round_trips_int,
+        )
+        return previous_version
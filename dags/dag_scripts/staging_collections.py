@@ -0,0 +1,123 @@
+"""Per-run MongoDB staging collections
+
+Each crawl writes into its own collection named after the run date, such
+as supermarket_json_2023-09-12. Once the crawl has finished the run
+collection is promoted by renaming it to supermarket_json, which the
+later steps (mongodb_to_postgres, parquet_archive) read from.
+
+1. Renaming with dropTarget replaces the old staging collection in a
+    single step, so readers see either last week's or this week's
+    products and never a half loaded collection. Indexes move with the
+    collection.
+2. Dropping a whole collection takes the same time no matter how many
+    documents it holds, unlike delete_many({}), which removes (and writes
+    to the oplog) one document at a time.
+3. A failed crawl is never promoted, so supermarket_json keeps the
+    last good data while the run is resumed or re-run.
+4. The date_extracted index the exports filter and sort on is built once,
+    on the finished run collection just before it is promoted, rather than
+    kept up to date during the crawl or created by the readers.
+"""
+# Standard Library Imports
+import logging
+import re
+from typing import List, Optional
+
+# Globals
+STAGING_COLLECTION_NAME = "supermarket_json"
+DATE_EXTRACTED_INDEX_NAME = "date_extracted_1"
+
+
+def get_run_collection_name(
+    run_date: str, staging_coll_name: str = STAGING_COLLECTION_NAME
+) -> str:
+    """Name of the collection a run writes into, such as supermarket_json_2023-09-12"""
+    return f"{staging_coll_name}_{run_date}"
+
+
+def get_run_collection(
+    mongodb_database, run_date: str, staging_coll_name: str = STAGING_COLLECTION_NAME
+):
+    """Connect to the collection a run writes into
+
+    Parameters:
+    1. mongodb_database: MongoDB database from db_connection_funcs.get_mongodb_database()
+    2. run_date: date of the run (YYYY-MM-DD)
+    3. staging_coll_name: name of the promoted staging collection
+
+    Returns:
+    1. collection: connection to the run collection
+    """
+    return mongodb_database[get_run_collection_name(run_date, staging_coll_name)]
+
+
+def list_run_collection_names(
+    mongodb_database, staging_coll_name: str = STAGING_COLLECTION_NAME
+) -> List[str]:
+    """List the run collections in the database, oldest run first.
+    Other collections that share the prefix (such as test collections) are left out."""
+    run_collection_regex = re.compile(rf"{re.escape(staging_coll_name)}_\d{{4}}-\d{{2}}-\d{{2}}")
+    return sorted(
+        collection_name
+        for collection_name in mongodb_database.list_collection_names()
+        if run_collection_regex.fullmatch(collection_name)
+    )
+
+
+def drop_stale_run_collections(
+    mongodb_database,
+    keep_run_date: Optional[str] = None,
+    staging_coll_name: str = STAGING_COLLECTION_NAME,
+) -> List[str]:
+    """Drop the run collections left behind by earlier runs that were never promoted
+
+    Parameters:
+    1. mongodb_database: MongoDB database
+    2. keep_run_date: optional run date whose collection is kept,
+        so an interrupted run can resume into it
+    3. staging_coll_name: name of the promoted staging collection
+
+    Returns:
+    1. dropped_collections_list: names of the dropped collections
+    """
+    keep_collection_name = (
+        get_run_collection_name(keep_run_date, staging_coll_name) if keep_run_date else None
+    )
+    dropped_collections_list = []
+    for run_collection_name in list_run_collection_names(mongodb_database, staging_coll_name):
+        if run_collection_name != keep_collection_name:
+            mongodb_database.drop_collection(run_collection_name)
+            dropped_collections_list.append(run_collection_name)
+    if dropped_collections_list:
+        logging.info("Dropped stale run collections: %s", dropped_collections_list)
+    return dropped_collections_list
+
+
+def promote_run_collection(
+    mongodb_database, run_date: str, staging_coll_name: str = STAGING_COLLECTION_NAME
+) -> bool:
+    """Index a run's collection on date_extracted, then replace the
+    staging collection with it in one rename
+
+    Parameters:
+    1. mongodb_database: MongoDB database
+    2. run_date: date of the run to promote (YYYY-MM-DD)
+    3. staging_coll_name: name of the promoted staging collection
+
+    Returns:
+    1. True if the run collection was promoted, False if the run wrote
+        nothing, in which case the staging collection is left as it was
+    """
+    run_collection_name = get_run_collection_name(run_date, staging_coll_name)
+    if run_collection_name not in mongodb_database.list_collection_names():
+        logging.warning(
+            "Run collection %s does not exist. Keeping %s as it is.",
+            run_collection_name,
+            staging_coll_name,
+        )
+        return False
+    run_collection = mongodb_database[run_collection_name]
+    run_collection.create_index("date_extracted", name=DATE_EXTRACTED_INDEX_NAME)
+    run_collection.rename(staging_coll_name, dropTarget=True)
+    logging.info("Promoted %s to %s", run_collection_name, staging_coll_name)
+    return True
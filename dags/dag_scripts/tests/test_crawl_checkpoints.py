@@ -0,0 +1,33 @@
+"""Tests for the crawl checkpoints stored in MongoDB
+
+Tests use a seperate checkpoints collection so real checkpoints are not changed.
+Tests are intended to be run with the PyTest library
+"""
+import sys
+sys.path.append('/opt/airflow/dags')
+
+from dag_scripts import crawl_checkpoints
+from dag_scripts.db_connections import db_connection_funcs
+
+TEST_COLLECTION_NAME = "crawl_checkpoints_test"
+
+def test_checkpoint_resume():
+    """Test a category resumes after its last completed page and finished runs are not in progress"""
+    mongo_client = db_connection_funcs.get_mongodb_client()
+    mongo_database = db_connection_funcs.get_mongodb_database(mongo_client)
+    checkpoint_collection = crawl_checkpoints.get_checkpoint_collection(
+        mongo_database, TEST_COLLECTION_NAME)
+    crawl_checkpoints.clear_checkpoints(checkpoint_collection)
+
+    assert crawl_checkpoints.get_resume_page(
+        crawl_checkpoints.get_checkpoint(checkpoint_collection, "2023-09-12", "fruit-vegetables")) == 1
+    crawl_checkpoints.mark_page_completed(checkpoint_collection, "2023-09-12", "fruit-vegetables", 25)
+    checkpoint = crawl_checkpoints.get_checkpoint(checkpoint_collection, "2023-09-12", "fruit-vegetables")
+    assert crawl_checkpoints.get_resume_page(checkpoint) == 26
+    assert crawl_checkpoints.check_run_in_progress(checkpoint_collection, "2023-09-12")
+
+    crawl_checkpoints.mark_category_finished(checkpoint_collection, "2023-09-12", "fruit-vegetables")
+    assert not crawl_checkpoints.check_run_in_progress(checkpoint_collection, "2023-09-12")
+
+    mongo_database.drop_collection(TEST_COLLECTION_NAME)
+    mongo_client.close()
@@ -0,0 +1,24 @@
+"""Tests for the crawl manifest that defines the categories to crawl
+
+Tests are intended to be run with the PyTest library
+"""
+import sys
+sys.path.append('/opt/airflow/dags')
+
+from dag_scripts import crawl_manifest
+
+def test_manifest_is_valid():
+    """Test that the manifest in the config folder loads and plans at least one category"""
+    manifest_dict = crawl_manifest.load_crawl_manifest()
+    crawl_plan_list = crawl_manifest.plan_crawl(manifest_dict)
+    assert len(crawl_plan_list) > 0
+
+def test_plan_is_ordered_by_priority():
+    """Test that disabled categories are skipped and the rest are ordered by priority"""
+    manifest_dict = {"categories": [
+        {"name": "pantry", "path": "/browse/pantry", "max_page": 5, "priority": 2},
+        {"name": "bakery", "path": "/browse/bakery", "max_page": 5, "priority": 1},
+        {"name": "deli", "path": "/browse/deli", "max_page": 5, "priority": 0, "enabled": False},
+    ]}
+    crawl_plan_list = crawl_manifest.plan_crawl(manifest_dict)
+    assert [category.name for category in crawl_plan_list] == ["bakery", "pantry"]
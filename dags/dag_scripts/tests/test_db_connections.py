@@ -4,8 +4,7 @@ These tests are intend to be run with the PyTest library
 """
 import sys
 sys.path.append('/opt/airflow/dags')
-from dag_scripts.db_connections import db_connection_funcs
-from dag_scripts import clear_mongodb_staging
+from dag_scripts.db_connections import connection_manager, db_connection_funcs
 from sqlalchemy.exc import SQLAlchemyError
 from redis.exceptions import ConnectionError
 
@@ -17,41 +16,37 @@ def test_mongodb_server():
 
 def test_mongodb_database_exists():
     """Test that the mongodb database exists"""
-    mongo_client = db_connection_funcs.get_mongodb_client()
+    mongo_client = connection_manager.get_mongodb_client()
     mongo_database = db_connection_funcs.get_mongodb_database(mongo_client)
     assert mongo_database.name in mongo_client.list_database_names()
-    mongo_client.close()
 
 def test_mongodb_collection_exists():
     """Test that the mongodb collection exists"""
-    mongo_client = db_connection_funcs.get_mongodb_client()
+    mongo_client = connection_manager.get_mongodb_client()
     mongo_database = db_connection_funcs.get_mongodb_database(mongo_client)
     mongo_collection = db_connection_funcs.get_mongodb_collection(mongo_database)
     assert mongo_collection.name in mongo_database.list_collection_names()
-    mongo_client.close()
 
 def test_mongodb_insert():
     """Test that a document can be inserted into the mongodb database"""
-    mongo_client = db_connection_funcs.get_mongodb_client()
+    mongo_client = connection_manager.get_mongodb_client()
     mongo_database = db_connection_funcs.get_mongodb_database(mongo_client)
     mongo_collection = db_connection_funcs.get_mongodb_collection(mongo_database)
     test_document = {"test_key": "test_value"}
     insert_result = mongo_collection.insert_one(test_document)
     assert insert_result.acknowledged
-    clear_mongodb_staging.main()
-    mongo_client.close()
+    mongo_collection.delete_many(test_document)
 
 def test_mongodb_retrieval():
     """Test that a document can be retrieved from the mongodb database"""
-    mongo_client = db_connection_funcs.get_mongodb_client()
+    mongo_client = connection_manager.get_mongodb_client()
     mongo_database = db_connection_funcs.get_mongodb_database(mongo_client)
     mongo_collection = db_connection_funcs.get_mongodb_collection(mongo_database)
     test_document = {"test_key": "test_value"}
     insert_result = mongo_collection.insert_one(test_document)
     retrieved_document = mongo_collection.find_one({"test_key": "test_value"})
     assert retrieved_document is not None
-    clear_mongodb_staging.main()
-    mongo_client.close()
+    mongo_collection.delete_many(test_document)
 
 def test_postgres_connection():
     """Test that the user can connect to the PostgreSQL database"""
@@ -72,4 +67,32 @@ def test_redis_connection():
         assert False
 
 
-    redis_conn.close()
\ No newline at end of file
+    redis_conn.close()
+
+def test_connection_manager_reuses_clients():
+    """Test the connection manager hands out the same pooled clients
+    and replaces them when used from a new process"""
+    mongo_client = connection_manager.get_mongodb_client()
+    postgres_engine = connection_manager.get_postgresql_engine()
+    redis_conn = connection_manager.get_redis_connection()
+    assert connection_manager.get_mongodb_client() is mongo_client
+    assert connection_manager.get_postgresql_engine() is postgres_engine
+    assert connection_manager.get_redis_connection() is redis_conn
+    assert postgres_engine.pool.size() == connection_manager.POSTGRES_POOL_SIZE
+    assert connection_manager.check_health() == {"mongodb": True, "postgresql": True, "redis": True}
+
+    # Pretend the manager is being used from a forked child process
+    connection_manager.CONNECTION_MANAGER.pid = -1
+    assert connection_manager.get_mongodb_client() is not mongo_client
+    mongo_client.close()
+
+def test_connection_manager_context_managers():
+    """Test the context managers give working pooled connections"""
+    from sqlalchemy import text
+    with connection_manager.mongodb_collection() as mongo_collection:
+        assert mongo_collection.name == "supermarket_json"
+    with connection_manager.postgresql_connection() as postgresql_conn:
+        assert postgresql_conn.execute(text("SELECT 1")).scalar() == 1
+    assert connection_manager.get_postgresql_engine().pool.checkedout() == 0
+    with connection_manager.redis_connection() as redis_conn:
+        assert redis_conn.ping()
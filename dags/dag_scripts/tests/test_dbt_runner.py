@@ -0,0 +1,84 @@
+"""Tests for the state aware dbt builds
+
+dbt is not run - the tests only check which models are selected and how
+the state of a run is saved, using a temporary project folder.
+Tests are intended to be run with the PyTest library
+"""
+import sys
+sys.path.append('/opt/airflow/dags')
+
+import os
+from dag_scripts import dbt_runner
+
+def write_freshness_target(project_dir, manifest_text="{}", sources_text="{}"):
+    """Write the files check_sources_task() leaves in target/freshness"""
+    freshness_target_path = dbt_runner.get_target_path(
+        dbt_runner.FRESHNESS_TARGET_NAME, str(project_dir))
+    os.makedirs(freshness_target_path)
+    for file_name, file_text in (("manifest.json", manifest_text), ("sources.json", sources_text)):
+        with open(os.path.join(freshness_target_path, file_name), "w", encoding="utf-8") as file:
+            file.write(file_text)
+
+def test_every_model_rebuilt_without_saved_state(tmp_path, monkeypatch):
+    """Test the first run rebuilds the model from scratch as there is no
+    state to compare against"""
+    dbt_commands_list = []
+    monkeypatch.setattr(dbt_runner, "run_dbt",
+                        lambda dbt_args_list, target_name, *args: dbt_commands_list.append(
+                            (dbt_args_list, target_name)))
+    state_dir = str(tmp_path / "state")
+    assert not dbt_runner.has_saved_state(state_dir)
+    assert dbt_runner.check_model_changed("fct_product_prices", state_dir, str(tmp_path))
+    dbt_runner.build_model("fct_product_prices", state_dir, str(tmp_path))
+    assert dbt_commands_list == [(
+        ["build", "--select", "fct_product_prices", "--full-refresh"], "fct_product_prices")]
+
+def test_saved_state_selects_changed_models(tmp_path):
+    """Test once a run saved its state, models are only selected when they
+    changed or their source has newer data"""
+    state_dir = str(tmp_path / "state")
+    write_freshness_target(tmp_path, manifest_text='{"nodes": {}}')
+    dbt_runner.save_state_task(state_dir=state_dir, project_dir=str(tmp_path))
+    assert dbt_runner.has_saved_state(state_dir)
+    assert sorted(os.listdir(state_dir)) == ["manifest.json", "sources.json"]
+    with open(os.path.join(state_dir, "manifest.json"), encoding="utf-8") as manifest_file:
+        assert manifest_file.read() == '{"nodes": {}}'
+    assert dbt_runner.build_changed_selector("fct_product_prices") == \
+        "fct_product_prices,state:modified+"
+    assert dbt_runner.build_fresher_selector("fct_product_prices") == \
+        "fct_product_prices,source_status:fresher+"
+
+def test_changed_model_rebuilt_from_scratch(tmp_path, monkeypatch):
+    """Test a model that changed since the saved state is fully refreshed so
+    a new or changed key is filled in for the rows built before the change"""
+    dbt_commands_list = []
+    monkeypatch.setattr(dbt_runner, "run_dbt",
+                        lambda dbt_args_list, target_name, *args: dbt_commands_list.append(
+                            (dbt_args_list, target_name)))
+    monkeypatch.setattr(dbt_runner, "check_model_changed", lambda *args: True)
+    state_dir = str(tmp_path / "state")
+    write_freshness_target(tmp_path)
+    dbt_runner.save_state_task(state_dir=state_dir, project_dir=str(tmp_path))
+    dbt_runner.build_model("mart_pricing_over_time", state_dir, str(tmp_path))
+    assert dbt_commands_list == [(
+        ["build", "--select", "mart_pricing_over_time", "--full-refresh"],
+        "mart_pricing_over_time")]
+
+def test_build_compares_freshness_with_saved_state(tmp_path, monkeypatch):
+    """Test an unchanged model is given the saved state and this run's
+    freshness results, so it is only built when its source has newer data"""
+    dbt_commands_list = []
+    monkeypatch.setattr(dbt_runner, "run_dbt",
+                        lambda dbt_args_list, target_name, *args: dbt_commands_list.append(
+                            (dbt_args_list, target_name)))
+    monkeypatch.setattr(dbt_runner, "check_model_changed", lambda *args: False)
+    state_dir = str(tmp_path / "state")
+    write_freshness_target(tmp_path, sources_text='{"results": []}')
+    dbt_runner.save_state_task(state_dir=state_dir, project_dir=str(tmp_path))
+    dbt_runner.build_model("mart_pricing_over_time", state_dir, str(tmp_path))
+    assert dbt_commands_list == [(
+        ["build", "--select", dbt_runner.build_fresher_selector("mart_pricing_over_time"),
+         "--state", state_dir], "mart_pricing_over_time")]
+    with open(os.path.join(dbt_runner.get_target_path("mart_pricing_over_time", str(tmp_path)),
+                           "sources.json"), encoding="utf-8") as sources_file:
+        assert sources_file.read() == '{"results": []}'
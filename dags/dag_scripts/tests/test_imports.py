@@ -26,6 +26,111 @@ def test_web_to_mongo_import():
     except (ImportError, ModuleNotFoundError):
         assert False
 
+def test_token_bucket_import():
+    """Test the token bucket rate limiter import works"""
+    try:
+        from dag_scripts import token_bucket
+    except (ImportError, ModuleNotFoundError):
+        assert False
+
+def test_crawl_manifest_import():
+    """Test the crawl manifest import works"""
+    try:
+        from dag_scripts import crawl_manifest
+    except (ImportError, ModuleNotFoundError):
+        assert False
+
+def test_product_extractor_import():
+    """Test the product extractor import works"""
+    try:
+        from dag_scripts import product_extractor
+    except (ImportError, ModuleNotFoundError):
+        assert False
+
+def test_page_cache_import():
+    """Test the page cache import works"""
+    try:
+        from dag_scripts import page_cache
+    except (ImportError, ModuleNotFoundError):
+        assert False
+
+def test_crawl_checkpoints_import():
+    """Test the crawl checkpoints import works"""
+    try:
+        from dag_scripts import crawl_checkpoints
+    except (ImportError, ModuleNotFoundError):
+        assert False
+
+def test_mongodb_bulk_writer_import():
+    """Test the MongoDB bulk writer import works"""
+    try:
+        from dag_scripts import mongodb_bulk_writer
+    except (ImportError, ModuleNotFoundError):
+        assert False
+
+def test_redis_publisher_import():
+    """Test the Redis publisher import works"""
+    try:
+        from dag_scripts import redis_publisher
+    except (ImportError, ModuleNotFoundError):
+        assert False
+
+def test_price_cache_client_import():
+    """Test the price cache client import works"""
+    try:
+        from dag_scripts.db_connections import price_cache_client
+    except (ImportError, ModuleNotFoundError):
+        assert False
+
+def test_connection_manager_import():
+    """Test the connection manager import works"""
+    try:
+        from dag_scripts.db_connections import connection_manager
+    except (ImportError, ModuleNotFoundError):
+        assert False
+
+def test_parquet_archive_import():
+    """Test the Parquet archive import works"""
+    try:
+        from dag_scripts import parquet_archive
+    except (ImportError, ModuleNotFoundError):
+        assert False
+
+def test_pyarrow_import():
+    """Test the pyarrow import works"""
+    try:
+        import pyarrow
+    except (ImportError, ModuleNotFoundError):
+        assert False
+
+def test_staging_collections_import():
+    """Test the staging collections import works"""
+    try:
+        from dag_scripts import staging_collections
+    except (ImportError, ModuleNotFoundError):
+        assert False
+
+def test_pipeline_metrics_import():
+    """Test the pipeline metrics import works"""
+    try:
+        from dag_scripts import pipeline_metrics
+    except (ImportError, ModuleNotFoundError):
+        assert False
+
+def test_dbt_runner_import():
+    """Test the dbt runner import works"""
+    try:
+        from dag_scripts import dbt_runner
+    except (ImportError, ModuleNotFoundError):
+        assert False
+
+def test_product_flattener_import():
+    """Test the product flattener import works"""
+    try:
+        from dag_scripts import product_flattener
+    except (ImportError, ModuleNotFoundError):
+        assert False
+
 def test_mongo_to_postgres_import():
     """Test the web to mongo import works"""
     try:
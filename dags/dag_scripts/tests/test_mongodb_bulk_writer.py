@@ -0,0 +1,79 @@
+"""Tests for the batched, idempotent MongoDB product writer
+
+The upsert test uses a seperate collection so the staging data is not changed.
+Tests are intended to be run with the PyTest library
+"""
+import sys
+sys.path.append('/opt/airflow/dags')
+
+from dag_scripts import mongodb_bulk_writer
+from dag_scripts.mongodb_bulk_writer import BulkProductWriter
+from dag_scripts.db_connections import db_connection_funcs
+
+TEST_COLLECTION_NAME = "supermarket_json_bulk_writer_test"
+
+def get_test_collection(mongo_client):
+    """Empty test collection with the staging unique index"""
+    mongo_database = db_connection_funcs.get_mongodb_database(mongo_client)
+    test_collection = db_connection_funcs.get_mongodb_collection(
+        mongo_database, TEST_COLLECTION_NAME)
+    test_collection.drop()
+    mongodb_bulk_writer.ensure_staging_unique_index(test_collection)
+    return test_collection
+
+def test_upserts_are_deduplicated():
+    """Test products repeated in a batch become a single upsert and the last copy wins"""
+    products_list = [{"id": 1, "date_extracted": "2023-09-12", "name": "apple"},
+                     {"id": 1, "date_extracted": "2023-09-12", "name": "green apple"},
+                     {"id": 1, "date_extracted": "2023-09-19", "name": "apple"}]
+    upserts_list = mongodb_bulk_writer.build_product_upserts(products_list)
+    assert len(upserts_list) == 2
+
+    mongo_client = db_connection_funcs.get_mongodb_client()
+    test_collection = get_test_collection(mongo_client)
+    bulk_write_result = test_collection.bulk_write(upserts_list, ordered=False)
+    assert bulk_write_result.upserted_count == 2
+    assert list(test_collection.find({}, {"_id": 0}).sort("date_extracted", 1)) == \
+        products_list[1:]
+    test_collection.drop()
+    mongo_client.close()
+
+def test_failed_flush_does_not_hide_the_original_error():
+    """Test an error raised in the with block is the one that propagates,
+    even when flushing the pending products on exit fails too"""
+    import pytest
+    from types import SimpleNamespace
+    def failing_bulk_write(upserts_list, ordered=False):
+        raise ConnectionError("MongoDB connection lost")
+    failing_collection = SimpleNamespace(bulk_write=failing_bulk_write)
+    failing_collection.with_options = lambda write_concern: failing_collection
+    with pytest.raises(ValueError, match="page could not be parsed"):
+        with BulkProductWriter(failing_collection) as product_writer:
+            product_writer.add([{"id": 1, "date_extracted": "2023-09-12"}])
+            raise ValueError("page could not be parsed")
+    with pytest.raises(ConnectionError):
+        with BulkProductWriter(failing_collection) as product_writer:
+            product_writer.add([{"id": 1, "date_extracted": "2023-09-12"}])
+
+def test_bulk_writer_is_idempotent():
+    """Test writing the same products twice does not add duplicates
+    and callbacks only run once the products are written"""
+    mongo_client = db_connection_funcs.get_mongodb_client()
+    test_collection = get_test_collection(mongo_client)
+
+    flushed_pages_list = []
+    products_list = [{"id": product_id, "date_extracted": "2023-09-12"}
+                     for product_id in range(3)]
+    with BulkProductWriter(test_collection, batch_size=100) as product_writer:
+        product_writer.add(products_list, lambda: flushed_pages_list.append(1))
+        assert flushed_pages_list == []
+        assert test_collection.count_documents({}) == 0
+    assert flushed_pages_list == [1]
+
+    with BulkProductWriter(test_collection) as product_writer:
+        product_writer.add([dict(product) for product in products_list])
+    assert test_collection.count_documents({}) == 3
+    assert product_writer.upserted_count == 0
+
+    test_collection.drop()
+    mongo_client.close()
@@ -3,20 +3,26 @@ import sys
 sys.path.append('/opt/airflow/dags')
 
 from dag_scripts import clear_mongodb_staging
-from dag_scripts.db_connections import db_connection_funcs
+from dag_scripts import staging_collections
+from dag_scripts.db_connections import connection_manager, db_connection_funcs
 
 def test_mongo_db_cleared():
-    """Tests that the mongodb staging collection is cleared properly"""
-    mongo_client = db_connection_funcs.get_mongodb_client()
+    """Tests that run collections left behind by earlier runs are dropped
+    and the promoted staging collection is kept"""
+    mongo_client = connection_manager.get_mongodb_client()
     mongo_database = db_connection_funcs.get_mongodb_database(mongo_client)
     mongo_collection = db_connection_funcs.get_mongodb_collection(mongo_database)
+    stale_run_collection_name = staging_collections.get_run_collection_name("2000-01-01")
 
     test_json_document = {
     "first_name": "Bruce",
     "last_name": "Wayne"
     }
 
-    mongo_collection.insert_one(test_json_document)
+    mongo_database[stale_run_collection_name].insert_one(dict(test_json_document))
+    mongo_collection.insert_one(dict(test_json_document))
     clear_mongodb_staging.main()
-    assert mongo_collection.count_documents({}) ==0
-    mongo_client.close()
+    assert stale_run_collection_name not in staging_collections.list_run_collection_names(
+        mongo_database)
+    assert mongo_collection.count_documents(test_json_document) == 1
+    mongo_collection.delete_many(test_json_document)
@@ -5,13 +5,37 @@ Returns 0 if no change
 Returns 1 if there is a change
 
 Stops the data pipeline if the schema has changed
+
+The columns can come from a flattened dataframe (test_if_schema_has_changed())
+or, before anything is exported, from the flattened key paths MongoDB
+reports for the documents (test_if_key_paths_have_changed() with
+mongodb_to_postgres.get_mongodb_key_paths()).
 """
 # Standard Library Imports
 import logging
+from typing import Optional
 
 # 3rd Party Imports
 import pandas as pd
 
+# Globals
+# Only present when at least one product is on special
+SPECIALS_COLUMNS_SET = {
+    "pricing.promotionType",
+    "internalDescription",
+    "pricing.specialType",
+    "pricing.offerDescription",
+    "pricing.multiBuyPromotion.type",
+    "pricing.multiBuyPromotion.id",
+    "pricing.multiBuyPromotion.minQuantity",
+    "pricing.multiBuyPromotion.reward",
+    "pricing.promotionDescription",
+}
+# Large array fields of the MongoDB documents that nothing downstream uses.
+# They are not in the column contract, so the export projection never sends
+# them, and the schema check does not report them as new columns
+NOT_EXPORTED_COLUMNS_SET = {"imageUris", "locations", "onlineHeirs"}
+
 
 def test_if_schema_has_changed(flattened_json_df: pd.DataFrame):
     """Test if the schema has changed in the MongoDB data
@@ -24,7 +48,25 @@ def test_if_schema_has_changed(flattened_json_df: pd.DataFrame):
     Returns:
     1. test_result. Returns True if schema change detected, and False if not.
     """
-    actual_columns_set = set(flattened_json_df.columns)
+    return test_if_key_paths_have_changed(set(flattened_json_df.columns))
+
+
+def test_if_key_paths_have_changed(key_paths_set: set) -> bool:
+    """Test if the flattened (dotted) key paths in the MongoDB data
+    have changed relative to the expected PostgreSQL columns.
+    Which columns were added or dropped is written to the errors log.
+
+    Parameters:
+    1. key_paths_set: set of flattened keys in the MongoDB JSON data
+
+    Returns:
+    1. test_result. Returns True if schema change detected, and False if not.
+    """
+    actual_columns_set = {
+        key_path
+        for key_path in key_paths_set
+        if key_path.split(".")[0] not in NOT_EXPORTED_COLUMNS_SET
+    }
     expected_columns_set = set(get_expected_postgres_columns_list())
     new_columns_flag = test_schema_change_if_new_columns(
         expected_columns_set, actual_columns_set
@@ -44,6 +86,10 @@ def test_schema_change_if_new_columns(
     """Test to determine if new columns have been added to the raw
     JSON data in MongoDB. Return true if new columns are present.
 
+    A key path that is the parent of expected columns (for example
+    "pricing.multiBuyPromotion" when a product has no multi buy promotion and
+    the value is null) is not a new column - its child columns are just null.
+
     Parameters:
     1. Expected columns set: Set of expected columns in the target PostgreSQL table
     2. raw_mongo_columns_set: Set of flattened keys in the MongoDB JSON data
@@ -52,11 +98,18 @@ def test_schema_change_if_new_columns(
     1. Boolean True / False if new columns are present.
         True if new columns are present, False if not.
     """
+    new_columns_set = {
+        column
+        for column in raw_mongo_columns_set.difference(expected_columns_set)
+        if not any(
+            expected_column.startswith(f"{column}.") for expected_column in expected_columns_set
+        )
+    }
     try:
-        assert len(expected_columns_set.difference(raw_mongo_columns_set)) == 0
+        assert len(new_columns_set) == 0
     except AssertionError:
         new_columns_flag = "new_columns"
-        write_errors_file(new_columns_flag)
+        write_errors_file(new_columns_flag, new_columns_set)
         return True
 
     return False
@@ -79,11 +132,12 @@ def test_schema_change_if_deprecated_columns(
     1. True / False. Boolean True / False if deprecated columns are present.
         True if deprecated columns are present, False if not.
     """
+    deprecated_columns_set = expected_columns_set.difference(raw_mongo_columns_set)
     try:
-        assert len(expected_columns_set.difference(raw_mongo_columns_set)) == 0
+        assert len(deprecated_columns_set) == 0
     except AssertionError:
         deprecated_columns_flag = "deprecated_columns"
-        write_errors_file(deprecated_columns_flag)
+        write_errors_file(deprecated_columns_flag, deprecated_columns_set)
         return True
     return False
 
@@ -117,9 +171,6 @@ def get_expected_postgres_columns_list() -> list:
         "size",
         "availability",
         "availabilityType",
-        "imageUris",
-        "locations",
-        "onlineHeirs",
         "date_extracted",
         "restrictions.retailLimit",
         "restrictions.promotionalLimit",
@@ -156,15 +207,17 @@ def get_expected_postgres_columns_list() -> list:
     return expected_columns_list
 
 
-def write_errors_file(flag: str):
+def write_errors_file(flag: str, columns_set: Optional[set] = None):
     """Write errors to a log file if one or multiple of the following occurs:
 
     1. Schema change: new unexpected columns were added to the schema
     2. Schema change: old expected columns are no longer used in the schema
 
-    Parameters: To be defined
+    Parameters:
+    1. flag: "new_columns" or "deprecated_columns"
+    2. columns_set: optional set of the columns that were added or dropped
 
-    Returns: To be defined
+    Returns: None
     """
     message_dict = {
         "deprecated_columns": "Schema change: old expected columns are no longer used in the schema",
@@ -172,4 +225,6 @@ def write_errors_file(flag: str):
     }
 
     message = message_dict[flag]
+    if columns_set:
+        message = f"{message}: {sorted(columns_set)}"
     logging.error(message)
@@ -22,3 +22,115 @@ def test_columns_exist():
     assert len(expected_columns_set.difference(actual_columns_set))==0
     postgres_engine.dispose()
 
+def test_document_batches():
+    """Test the MongoDB cursor is split into batches with nothing dropped"""
+    batches_list = list(mongodb_to_postgres.iter_document_batches(range(7), batch_size=3))
+    assert batches_list == [[0, 1, 2], [3, 4, 5], [6]]
+
+def test_integer_columns_formatted_for_copy():
+    """Test integer columns with missing values are written as integers for COPY"""
+    expected_columns_list = ["id", "pricing.multiBuyPromotion.id", "name"]
+    data_types_dict = mongodb_to_postgres.define_column_data_types_for_sql()
+    raw_dataframe = pd.DataFrame({"id": [1.0, 2.0],
+                                  "pricing.multiBuyPromotion.id": ["", 7.0],
+                                  "name": ["apple", "pear"],
+                                  "unexpected": [1, 2]})
+    copy_ready_dataframe = mongodb_to_postgres.format_dataframe_for_copy(
+        raw_dataframe, expected_columns_list, data_types_dict)
+    assert list(copy_ready_dataframe.columns) == expected_columns_list
+    assert copy_ready_dataframe.to_csv(header=False, index=False) == "1,,apple\n2,7,pear\n"
+
+def test_staging_table_is_partitioned():
+    """Test the staging table is partitioned by date so weekly loads are incremental"""
+    postgres_engine = db_connection_funcs.create_postgresql_engine()
+    postgres_connection = postgres_engine.raw_connection()
+    with postgres_connection.cursor() as postgres_cursor:
+        assert mongodb_to_postgres.get_staging_table_kind(postgres_cursor) == "partitioned"
+    postgres_connection.close()
+    postgres_engine.dispose()
+
+def test_staging_table_keyed_on_product_and_date():
+    """Test re-running a crawl updates staging rows - the key does not use
+    the MongoDB _id, which changes every time a product is crawled"""
+    postgres_engine = db_connection_funcs.create_postgresql_engine()
+    postgres_connection = postgres_engine.raw_connection()
+    with postgres_connection.cursor() as postgres_cursor:
+        assert mongodb_to_postgres.get_primary_key(postgres_cursor)[1] == ("id", "date_extracted")
+    postgres_connection.close()
+    postgres_engine.dispose()
+
+def test_partition_name():
+    """Test each extraction date gets its own partition name"""
+    assert mongodb_to_postgres.get_partition_name("2023-09-12") == \
+        "raw_supermarket_staging_p20230912"
+
+def test_mongodb_projection():
+    """Test the MongoDB projection covers the column contract and never
+    projects a parent and child path together
+    """
+    expected_columns_list = ["_id", "pricing.now", "pricing.unit.price", "pricing", "name"]
+    projection_dict = mongodb_to_postgres.build_mongodb_projection(expected_columns_list)
+    assert projection_dict == {"_id": 1, "pricing.now": 1, "pricing.unit.price": 1, "name": 1}
+
+def test_export_shards_cover_every_document():
+    """Test the export shards split the MongoDB documents without gaps or overlaps"""
+    mongodb_client = db_connection_funcs.get_mongodb_client()
+    mongo_database = db_connection_funcs.get_mongodb_database(mongodb_client)
+    mongodb_collection = db_connection_funcs.get_mongodb_collection(mongo_database)
+    date_extracted = mongodb_to_postgres.get_latest_date_extracted(mongodb_collection)
+    export_shards_list = mongodb_to_postgres.plan_export_shards(
+        mongodb_collection, date_extracted, shard_count=4, min_documents_per_shard=1)
+    assert export_shards_list[0].lower_id is None
+    assert export_shards_list[-1].upper_id is None
+    shard_document_counts_list = [
+        mongodb_collection.count_documents(mongodb_to_postgres.build_export_filter(*export_shard))
+        for export_shard in export_shards_list]
+    assert sum(shard_document_counts_list) == mongodb_collection.count_documents(
+        mongodb_to_postgres.build_export_filter(date_extracted))
+    mongodb_client.close()
+
+def test_export_shards_pass_through_xcom():
+    """Test export shards keep the type of their _id bounds when encoded
+    for XCom, so the mapped export tasks read the same documents"""
+    from bson import ObjectId
+    export_shard = mongodb_to_postgres.ExportShard(
+        "2023-09-12", ObjectId("650000000000000000000001"), None)
+    export_shard_json = mongodb_to_postgres.encode_export_shard(export_shard)
+    assert isinstance(export_shard_json, str)
+    assert mongodb_to_postgres.decode_export_shard(export_shard_json) == export_shard
+
+def test_schema_changes_detected_from_key_paths():
+    """Test added and dropped columns are both detected, and a null parent
+    of expected columns (a product without a multi buy promotion) is not a new column"""
+    from dag_scripts.tests import test_mongodb_schema_change
+    expected_columns_set = set(test_mongodb_schema_change.get_expected_postgres_columns_list())
+    assert not test_mongodb_schema_change.test_if_key_paths_have_changed(
+        expected_columns_set | {"pricing.multiBuyPromotion"})
+    assert test_mongodb_schema_change.test_if_key_paths_have_changed(
+        expected_columns_set | {"pricing.newField"})
+    assert test_mongodb_schema_change.test_if_key_paths_have_changed(
+        expected_columns_set - {"brand"})
+
+def test_large_unused_fields_not_exported():
+    """Test the large imageUris, locations and onlineHeirs arrays are left out
+    of the export projection without being reported as a schema change"""
+    from dag_scripts.tests import test_mongodb_schema_change
+    expected_columns_list = test_mongodb_schema_change.get_expected_postgres_columns_list()
+    projection_dict = mongodb_to_postgres.build_mongodb_projection(expected_columns_list)
+    assert not test_mongodb_schema_change.NOT_EXPORTED_COLUMNS_SET & set(projection_dict)
+    assert not test_mongodb_schema_change.test_if_key_paths_have_changed(
+        set(expected_columns_list) | test_mongodb_schema_change.NOT_EXPORTED_COLUMNS_SET)
+
+def test_mongodb_key_paths_match_column_contract():
+    """Test the key paths MongoDB reports for the latest extraction
+    match the expected columns before anything is exported"""
+    from dag_scripts.tests import test_mongodb_schema_change
+    mongodb_client = db_connection_funcs.get_mongodb_client()
+    mongo_database = db_connection_funcs.get_mongodb_database(mongodb_client)
+    mongodb_collection = db_connection_funcs.get_mongodb_collection(mongo_database)
+    date_extracted = mongodb_to_postgres.get_latest_date_extracted(mongodb_collection)
+    key_paths_set = mongodb_to_postgres.get_mongodb_key_paths(
+        mongodb_collection, mongodb_to_postgres.build_export_filter(date_extracted))
+    assert not test_mongodb_schema_change.test_if_key_paths_have_changed(
+        key_paths_set | test_mongodb_schema_change.SPECIALS_COLUMNS_SET)
+    mongodb_client.close()
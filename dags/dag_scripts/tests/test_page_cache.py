@@ -0,0 +1,45 @@
+"""Tests for the on disk page cache used by the website crawler
+
+Tests use a temporary folder and fake responses so no requests are sent
+to the Coles website. Tests are intended to be run with the PyTest library
+"""
+import sys
+sys.path.append('/opt/airflow/dags')
+
+from types import SimpleNamespace
+from dag_scripts.page_cache import PageCache
+
+URL = "https://www.coles.com.au/browse/fruit-vegetables?page=1"
+PRODUCTS_LIST = [{"_type": "PRODUCT", "id": 1}, {"_type": "PRODUCT", "id": 2}]
+
+def make_response(status_code, content, etag=None):
+    """Make a fake requests response"""
+    return SimpleNamespace(status_code=status_code,
+                           content=content,
+                           headers={"ETag": etag} if etag else {})
+
+def test_page_cache_round_trip(tmp_path):
+    """Test cached products and conditional headers are returned for a cached url"""
+    page_cache = PageCache(str(tmp_path))
+    assert page_cache.get_entry(URL) is None
+    page_cache.store(URL, make_response(200, b"page", etag='"v1"'), PRODUCTS_LIST)
+    cache_entry = page_cache.get_entry(URL)
+    assert cache_entry["product_ids"] == [1, 2]
+    assert PageCache.conditional_headers(cache_entry) == {"If-None-Match": '"v1"'}
+    assert page_cache.load_products(URL) == PRODUCTS_LIST
+
+def test_unchanged_page_detection(tmp_path):
+    """Test pages are unchanged on a 304 or a matching content hash only"""
+    page_cache = PageCache(str(tmp_path))
+    page_cache.store(URL, make_response(200, b"page"), PRODUCTS_LIST)
+    cache_entry = page_cache.get_entry(URL)
+    assert PageCache.is_unchanged(cache_entry, make_response(304, b""))
+    assert PageCache.is_unchanged(cache_entry, make_response(200, b"page"))
+    assert not PageCache.is_unchanged(cache_entry, make_response(200, b"new page"))
+    assert not PageCache.is_unchanged(None, make_response(200, b"page"))
+
+def test_error_pages_not_cached(tmp_path):
+    """Test error responses are never cached"""
+    page_cache = PageCache(str(tmp_path))
+    page_cache.store(URL, make_response(500, b"error"), [])
+    assert page_cache.get_entry(URL) is None
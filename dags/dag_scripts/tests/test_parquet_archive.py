@@ -0,0 +1,52 @@
+"""Tests for the Parquet archive of raw weekly products
+
+Tests write a small archive to a temporary folder so no database is needed.
+Tests are intended to be run with the PyTest library
+"""
+import sys
+sys.path.append('/opt/airflow/dags')
+
+import os
+from bson import ObjectId
+from dag_scripts import parquet_archive
+
+EXPECTED_COLUMNS_LIST = ["_id", "id", "name", "featured", "pricing.now",
+                         "merchandiseHeir.category", "date_extracted"]
+
+def make_documents(date_extracted, categories_list):
+    """Make one product document per category"""
+    return [{"_id": ObjectId(), "id": product_id, "name": f"product {product_id}",
+             "featured": product_id % 2 == 0, "pricing": {"now": product_id + 0.5},
+             "merchandiseHeir": {"category": category}, "date_extracted": date_extracted}
+            for product_id, category in enumerate(categories_list)]
+
+def test_archive_is_partitioned_by_date_and_category(tmp_path):
+    """Test each date and category is written to its own partition and
+    re-archiving a date replaces it rather than duplicating it"""
+    archive_dir = str(tmp_path)
+    for _ in range(2):
+        archived_rows_int = parquet_archive.archive_documents(
+            [make_documents("2023-09-12", ["Fruit", "Bakery"]),
+             make_documents("2023-09-12", ["Fruit"])],
+            archive_dir, EXPECTED_COLUMNS_LIST)
+    assert archived_rows_int == 3
+    assert sorted(os.listdir(os.path.join(archive_dir, "date_extracted=2023-09-12"))) == \
+        ["merchandiseHeir.category=Bakery", "merchandiseHeir.category=Fruit"]
+    assert parquet_archive.open_archive(archive_dir).count_rows() == 3
+
+def test_read_archive_range(tmp_path):
+    """Test reading a range of weeks only returns those weeks,
+    typed the same as the flattened products"""
+    archive_dir = str(tmp_path)
+    for date_extracted in ["2023-09-05", "2023-09-12", "2023-09-19"]:
+        parquet_archive.archive_documents(
+            [make_documents(date_extracted, ["Fruit", "Bakery"])], archive_dir, EXPECTED_COLUMNS_LIST)
+    archive_batches_list = list(parquet_archive.iter_archive_batches(
+        "2023-09-10", "2023-09-19", ["Fruit"], archive_dir, EXPECTED_COLUMNS_LIST))
+    archive_rows_list = [row for archive_batch_df in archive_batches_list
+                         for row in archive_batch_df.to_dict("records")]
+    assert sorted(row["date_extracted"] for row in archive_rows_list) == ["2023-09-12", "2023-09-19"]
+    assert list(archive_batches_list[0].columns) == EXPECTED_COLUMNS_LIST
+    assert str(archive_batches_list[0]["id"].dtype) == "Int64"
+    assert str(archive_batches_list[0]["featured"].dtype) == "boolean"
+    assert archive_rows_list[0]["pricing.now"] == 0.5
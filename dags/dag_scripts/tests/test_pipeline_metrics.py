@@ -0,0 +1,116 @@
+"""Tests for the pipeline step metrics
+
+Reports are written to a temporary folder and StatsD metrics are sent to
+a UDP socket opened by the test, so no database or StatsD server is needed.
+Tests are intended to be run with the PyTest library
+"""
+import sys
+sys.path.append('/opt/airflow/dags')
+
+import json
+import os
+import socket
+import pytest
+from dag_scripts import pipeline_metrics
+
+def test_steps_record_rows_bytes_and_timings():
+    """Test bytes are counted on every running step, rows only on their
+    own step and failed steps are marked as failed"""
+    task_metrics = pipeline_metrics.TaskMetrics("test_task")
+    with task_metrics.step("outer") as outer_metrics:
+        with task_metrics.step("inner") as inner_metrics:
+            for step_metrics in task_metrics.get_running_steps():
+                step_metrics.add_bytes(100)
+            inner_metrics.add_rows(5)
+            inner_metrics.add_timing("parse", 0.25)
+            inner_metrics.add_timing("parse", 0.25)
+        with pytest.raises(ValueError):
+            with task_metrics.step("failing"):
+                raise ValueError("step failed")
+    steps_dict = {step_dict["step_name"]: step_dict
+                  for step_dict in task_metrics.build_report()["steps"]}
+    assert [step_dict["step_name"] for step_dict in task_metrics.build_report()["steps"]] == \
+        ["outer", "inner", "failing"]
+    assert steps_dict["outer"]["bytes_transferred"] == 100
+    assert steps_dict["outer"]["rows_processed"] == 0
+    assert steps_dict["inner"]["rows_processed"] == 5
+    assert steps_dict["inner"]["timings"] == {"parse": {"seconds": 0.5, "calls": 2}}
+    assert steps_dict["failing"]["status"] == "failed"
+    assert steps_dict["outer"]["status"] == "success"
+    assert outer_metrics.wall_seconds >= inner_metrics.wall_seconds
+    assert outer_metrics.peak_rss_bytes > 0
+
+def test_instrumented_task_writes_report_and_sends_statsd(tmp_path, monkeypatch):
+    """Test an instrumented task writes its JSON run report and
+    sends its metrics to StatsD, even when the task fails"""
+    statsd_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    statsd_socket.bind(("127.0.0.1", 0))
+    statsd_socket.settimeout(5)
+    monkeypatch.setattr(pipeline_metrics, "PIPELINE_REPORT_DIR", str(tmp_path))
+    monkeypatch.setattr(pipeline_metrics, "STATSD_HOST", "127.0.0.1")
+    monkeypatch.setattr(pipeline_metrics, "STATSD_PORT", statsd_socket.getsockname()[1])
+
+    @pipeline_metrics.instrumented_task("test_task")
+    def task_main(fail=False):
+        with pipeline_metrics.step("load") as load_metrics:
+            with pipeline_metrics.timed("copy"):
+                pipeline_metrics.record_bytes(2048)
+            load_metrics.add_rows(10)
+        if fail:
+            raise RuntimeError("task failed")
+        return "done"
+
+    try:
+        assert task_main() == "done"
+        # Outside an instrumented task nothing is recorded
+        pipeline_metrics.record_bytes(1)
+        assert pipeline_metrics.get_task_metrics() is pipeline_metrics.UNREPORTED_TASK_METRICS
+
+        report_paths_list = [os.path.join(dir_path, file_name)
+                             for dir_path, _, file_names in os.walk(tmp_path)
+                             for file_name in file_names]
+        assert [os.path.basename(report_path) for report_path in report_paths_list] == \
+            ["test_task.json"]
+        with open(report_paths_list[0], encoding="utf-8") as report_file:
+            task_report_dict = json.load(report_file)
+        steps_dict = {step_dict["step_name"]: step_dict for step_dict in task_report_dict["steps"]}
+        assert steps_dict["test_task"]["bytes_transferred"] == 2048
+        assert steps_dict["load"]["rows_processed"] == 10
+        assert steps_dict["load"]["timings"]["copy"]["calls"] == 1
+
+        statsd_lines_list = [statsd_socket.recv(1024).decode("utf-8")
+                             for _ in pipeline_metrics.build_statsd_lines(task_report_dict)]
+        assert "supermarket.test_task.load.rows_processed:10|c" in statsd_lines_list
+        assert "supermarket.test_task.test_task.bytes_transferred:2048|c" in statsd_lines_list
+
+        with pytest.raises(RuntimeError):
+            task_main(fail=True)
+        with open(report_paths_list[0], encoding="utf-8") as report_file:
+            assert json.load(report_file)["steps"][0]["status"] == "failed"
+    finally:
+        statsd_socket.close()
+
+def test_statsd_names_are_sanitised():
+    """Test characters StatsD treats as separators are replaced"""
+    task_report_dict = {"task_name": "test task", "steps": [
+        {"step_name": "load:copy", "wall_seconds": 1.5, "cpu_seconds": 0.5,
+         "peak_rss_bytes": 1024, "bytes_transferred": 0, "rows_processed": 3,
+         "timings": {"fetch|pages": {"seconds": 0.25, "calls": 2}}}]}
+    assert pipeline_metrics.build_statsd_lines(task_report_dict, prefix="supermarket") == [
+        "supermarket.test_task.load_copy.wall_seconds:1500.000|ms",
+        "supermarket.test_task.load_copy.cpu_seconds:500.000|ms",
+        "supermarket.test_task.load_copy.peak_rss_bytes:1024|g",
+        "supermarket.test_task.load_copy.bytes_transferred:0|c",
+        "supermarket.test_task.load_copy.rows_processed:3|c",
+        "supermarket.test_task.load_copy.fetch_pages:250.000|ms",
+    ]
+
+def test_mapped_task_reports_do_not_overwrite_each_other(tmp_path):
+    """Test mapped tasks, which share a task name, write a report each"""
+    report_paths_list = [
+        pipeline_metrics.write_report_file(
+            {"task_name": "website_to_mongodb", "run_date": "2023-09-12",
+             "map_index": map_index, "steps": []}, str(tmp_path))
+        for map_index in (-1, 0, 1)]
+    assert [os.path.basename(report_path) for report_path in report_paths_list] == \
+        ["website_to_mongodb.json", "website_to_mongodb_0.json", "website_to_mongodb_1.json"]
@@ -20,3 +20,51 @@ def test_sql_query_for_redis():
         postgres_engine.dispose()
     except psycopg2.Error:
         assert False
+
+def test_aggregate_queries_for_redis():
+    """Test that the SQL queries for the Redis price aggregates are valid SQL"""
+    from dag_scripts import postgres_to_redis
+    try:
+        postgres_engine = db_connection_funcs.create_postgresql_engine()
+        for sql_query_str in [postgres_to_redis.get_sql_query_product_price_history(),
+                              postgres_to_redis.get_sql_query_category_weekly_totals(),
+                              postgres_to_redis.get_sql_query_current_specials()]:
+            execute_sql_query(postgres_engine, sql_query_str)
+        postgres_engine.dispose()
+    except psycopg2.Error:
+        assert False
+
+def test_price_aggregates_version_swap():
+    """Test published aggregates can be read back and a new version
+    replaces the old one. Uses a seperate namespace so the real aggregates are not changed."""
+    import pandas as pd
+    from dag_scripts import postgres_to_redis, redis_publisher
+    from dag_scripts.db_connections.price_cache_client import PriceCacheClient
+    namespace = "supermarket_test"
+    redis_conn = db_connection_funcs.get_redis_connection()
+    product_prices_df = pd.DataFrame({"product_name": ["Apple", "Apple"],
+                                      "pricing_date": ["2023-09-05", "2023-09-12"],
+                                      "price_aud": [1.0, 1.5]})
+    category_totals_df = pd.DataFrame({"product_category": ["Fruit"],
+                                       "pricing_date": ["2023-09-12"],
+                                       "total_price_aud": [1.5]})
+    current_specials_df = pd.DataFrame({"product_name": ["Apple"], "savings": [0.5]})
+
+    postgres_to_redis.publish_price_aggregates(
+        redis_conn, product_prices_df, category_totals_df, current_specials_df,
+        namespace=namespace, version="v1")
+    postgres_to_redis.publish_price_aggregates(
+        redis_conn, product_prices_df.assign(price_aud=[2.0, 3.0]), category_totals_df,
+        current_specials_df, namespace=namespace, version="v2")
+
+    assert redis_publisher.get_current_version(redis_conn, namespace) == "v2"
+    cache_client = PriceCacheClient(redis_conn, namespace=namespace)
+    assert cache_client.get_product_price_history("Apple") == \
+        {"2023-09-05": 2.0, "2023-09-12": 3.0}
+    assert cache_client.get_category_weekly_totals("Fruit") == {"2023-09-12": 1.5}
+    assert cache_client.get_current_specials()["Apple"]["savings"] == 0.5
+    assert cache_client.get_stats()["redis_hits"] == 3
+    assert redis_conn.ttl(f"{namespace}:v1:product:Apple:prices") > 0
+    for test_key in redis_conn.scan_iter(match=f"{namespace}:*"):
+        redis_conn.delete(test_key)
+    redis_conn.close()
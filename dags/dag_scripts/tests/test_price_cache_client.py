@@ -0,0 +1,114 @@
+"""Tests for the read-through price cache client
+
+Intended to be used with the PyTest library.
+Uses a seperate namespace so the real cached values are not changed.
+"""
+import sys
+sys.path.append('/opt/airflow/dags')
+
+import threading
+import time
+from dag_scripts import redis_publisher
+from dag_scripts.db_connections import db_connection_funcs
+from dag_scripts.db_connections import price_cache_client
+
+TEST_NAMESPACE = "supermarket_cache_client_test"
+
+def delete_test_keys(redis_conn):
+    """Delete every key in the test namespace"""
+    for test_key in redis_conn.scan_iter(match=f"{TEST_NAMESPACE}:*"):
+        redis_conn.delete(test_key)
+
+def test_lru_cache_drops_least_recently_used():
+    """Test the LRU keeps the most recently used entries"""
+    lru_cache = price_cache_client.LRUCache(max_entries=2)
+    lru_cache.put("a", 1)
+    lru_cache.put("b", 2)
+    lru_cache.get("a")
+    lru_cache.put("c", 3)
+    assert lru_cache.get("b") is None
+    assert lru_cache.get("a") == 1
+    assert lru_cache.get("c") == 3
+
+def test_lookups_read_through_each_layer(monkeypatch):
+    """Test a lookup is served by Redis, then PostgreSQL, then the LRU"""
+    redis_conn = db_connection_funcs.get_redis_connection()
+    delete_test_keys(redis_conn)
+    with redis_publisher.RedisPublisher(redis_conn, TEST_NAMESPACE, version="v1") as publisher:
+        publisher.hset(("product", "Apple", "prices"), {"2023-09-12": 1.5})
+        publisher.publish()
+    cache_client = price_cache_client.PriceCacheClient(redis_conn, namespace=TEST_NAMESPACE)
+    postgres_names_list = []
+    def fake_load_from_postgres(aggregate, names_list):
+        postgres_names_list.extend(names_list)
+        return {"Banana": {"2023-09-12": 3.0}}
+    monkeypatch.setattr(cache_client, "_load_from_postgres", fake_load_from_postgres)
+
+    assert cache_client.get_product_price_histories(["Apple", "Banana", "Cherry"]) == {
+        "Apple": {"2023-09-12": 1.5}, "Banana": {"2023-09-12": 3.0}, "Cherry": {}}
+    assert postgres_names_list == ["Banana", "Cherry"]
+    assert redis_conn.hget(f"{TEST_NAMESPACE}:v1:product:Banana:prices", "2023-09-12") == "3.0"
+    assert cache_client.get_product_price("Banana", "2023-09-12") == 3.0
+    assert cache_client.get_stats() == {"lru_hits": 1, "lru_misses": 3, "redis_hits": 1,
+                                        "redis_misses": 2, "postgres_loads": 1}
+    delete_test_keys(redis_conn)
+    redis_conn.close()
+
+def test_concurrent_misses_are_single_flighted(monkeypatch):
+    """Test concurrent lookups of an uncached name only query PostgreSQL once"""
+    redis_conn = db_connection_funcs.get_redis_connection()
+    delete_test_keys(redis_conn)
+    cache_client = price_cache_client.PriceCacheClient(redis_conn, namespace=TEST_NAMESPACE)
+    def slow_load_from_postgres(aggregate, names_list):
+        time.sleep(0.2)
+        return {name: {"2023-09-12": 10.0} for name in names_list}
+    monkeypatch.setattr(cache_client, "_load_from_postgres", slow_load_from_postgres)
+
+    results_list = []
+    threads_list = [threading.Thread(target=lambda: results_list.append(
+        cache_client.get_category_total("Fruit", "2023-09-12"))) for _ in range(5)]
+    for thread in threads_list:
+        thread.start()
+    for thread in threads_list:
+        thread.join()
+    assert results_list == [10.0] * 5
+    assert cache_client.get_stats()["postgres_loads"] == 1
+    assert cache_client.get_stats()["single_flight_waits"] == 4
+    redis_conn.close()
+
+def test_current_specials_read_through_each_layer(monkeypatch):
+    """Test the current specials are loaded from PostgreSQL when they are
+    not in Redis, then served by Redis to other clients"""
+    redis_conn = db_connection_funcs.get_redis_connection()
+    delete_test_keys(redis_conn)
+    with redis_publisher.RedisPublisher(redis_conn, TEST_NAMESPACE, version="v1") as publisher:
+        publisher.hset(("product", "Apple", "prices"), {"2023-09-12": 1.5})
+        publisher.publish()
+    cache_client = price_cache_client.PriceCacheClient(redis_conn, namespace=TEST_NAMESPACE)
+    monkeypatch.setattr(cache_client, "_load_current_specials_from_postgres", lambda: {
+        "Apple": price_cache_client.encode_special_details(
+            {"product_name": "Apple", "savings": 0.5})})
+
+    assert cache_client.get_current_specials() == {
+        "Apple": {"product_name": "Apple", "savings": 0.5}}
+    assert cache_client.get_current_specials()["Apple"]["savings"] == 0.5
+    other_cache_client = price_cache_client.PriceCacheClient(redis_conn, namespace=TEST_NAMESPACE)
+    assert other_cache_client.get_current_specials()["Apple"]["savings"] == 0.5
+    assert cache_client.get_stats() == {"lru_hits": 1, "lru_misses": 1, "redis_misses": 1,
+                                        "postgres_loads": 1}
+    assert other_cache_client.get_stats() == {"lru_misses": 1, "redis_hits": 1}
+    delete_test_keys(redis_conn)
+    redis_conn.close()
+
+def test_published_and_looked_up_queries_match():
+    """Test the publisher and the client build their queries from one definition
+    and only differ in which names they return"""
+    from dag_scripts import postgres_to_redis
+    for aggregate, published_query in [
+            (price_cache_client.PRODUCT_PRICES,
+             postgres_to_redis.get_sql_query_product_price_history()),
+            (price_cache_client.CATEGORY_TOTALS,
+             postgres_to_redis.get_sql_query_category_weekly_totals())]:
+        assert str(published_query) == aggregate.sql_template.format(
+            names_filter=f"{aggregate.name_column} IS NOT NULL")
+        assert f"{aggregate.name_column} IN" in str(aggregate.build_sql_query())
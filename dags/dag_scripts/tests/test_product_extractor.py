@@ -0,0 +1,49 @@
+"""Tests for the single pass product extractor
+
+Tests use small example pages so no requests are sent to the Coles website.
+Tests are intended to be run with the PyTest library
+"""
+import sys
+sys.path.append('/opt/airflow/dags')
+
+import json
+from dag_scripts import product_extractor
+
+DEEP_PRODUCT = {
+    "_type": "PRODUCT",
+    "id": 1,
+    "pricing": {"now": 2.5, "multiBuyPromotion": {"reward": {"amount": {"value": 1}}}},
+}
+PLAIN_PRODUCT = {"_type": "PRODUCT", "id": 2, "pricing": {"now": 1.0}}
+
+def test_products_found_in_embedded_payload():
+    """Test products are found in the Next.js payload including deeply nested products"""
+    payload = {"props": {"pageProps": {"searchResults": {"results": [
+        DEEP_PRODUCT, {"_type": "SINGLE_TILE"}, PLAIN_PRODUCT]}}}}
+    page_text = ('<html><script id="__NEXT_DATA__" type="application/json">'
+                 + json.dumps(payload) + '</script></html>')
+    products_list = list(product_extractor.iter_products_from_webpage_text(page_text))
+    assert products_list == [DEEP_PRODUCT, PLAIN_PRODUCT]
+
+def test_products_found_without_payload():
+    """Test the fallback scan decodes products when there is no payload script tag"""
+    page_text = ("junk " + json.dumps(DEEP_PRODUCT, separators=(",", ":"))
+                 + " more junk " + json.dumps(PLAIN_PRODUCT, separators=(",", ":")))
+    products_list = list(product_extractor.iter_products_from_webpage_text(page_text))
+    assert products_list == [DEEP_PRODUCT, PLAIN_PRODUCT]
+
+def test_products_found_outside_payload_without_products():
+    """Test the fallback scan still runs when the payload decodes but holds
+    no products, for example when products are moved into a lazily loaded blob"""
+    payload = {"props": {"pageProps": {"searchResults": {"results": []}}}}
+    page_text = ('<html><script id="__NEXT_DATA__" type="application/json">'
+                 + json.dumps(payload) + '</script><script>'
+                 + json.dumps(PLAIN_PRODUCT, separators=(",", ":")) + '</script></html>')
+    products_list = list(product_extractor.iter_products_from_webpage_text(page_text))
+    assert products_list == [PLAIN_PRODUCT]
+
+def test_no_products_on_empty_page(caplog):
+    """Test an empty page returns no products so pagination stops,
+    with a warning in case the page layout changed"""
+    assert list(product_extractor.iter_products_from_webpage_text("<html></html>")) == []
+    assert "No products found on the page" in caplog.text
@@ -0,0 +1,49 @@
+"""Tests for the schema aware flattener used when moving
+products from MongoDB to PostgreSQL
+
+Tests use small in memory documents so no database is needed.
+Tests are intended to be run with the PyTest library
+"""
+import sys
+sys.path.append('/opt/airflow/dags')
+
+from bson import ObjectId
+from dag_scripts import mongodb_to_postgres
+from dag_scripts.product_flattener import ProductFlattener, compile_key_tree
+
+EXPECTED_COLUMNS_LIST = ["_id", "id", "name", "availability", "imageUris",
+                         "pricing.now", "pricing.multiBuyPromotion.id"]
+
+def make_flattener():
+    """Make a flattener for the small column list used in these tests"""
+    return ProductFlattener(EXPECTED_COLUMNS_LIST,
+                            mongodb_to_postgres.define_column_data_types_for_sql())
+
+def test_compile_key_tree():
+    """Test dotted column names are compiled into nested keys"""
+    assert compile_key_tree(["_id", "pricing.now", "pricing.unit.price"]) == \
+        {"_id": 0, "pricing": {"now": 1, "unit": {"price": 2}}}
+
+def test_flatten_documents():
+    """Test documents are flattened into typed columns in staging table order"""
+    documents_list = [
+        {"_id": ObjectId("650000000000000000000001"), "id": 1, "name": "apple",
+         "availability": True, "imageUris": [{"uri": "/1.jpg"}],
+         "pricing": {"now": 1.5, "multiBuyPromotion": {"id": 7}}, "unexpected": 1},
+        {"_id": ObjectId("650000000000000000000002"), "id": 2, "name": "pear",
+         "availability": False, "imageUris": [], "pricing": {"now": 2}},
+    ]
+    flattened_dataframe, seen_columns_set = make_flattener().flatten(documents_list)
+    assert list(flattened_dataframe.columns) == EXPECTED_COLUMNS_LIST
+    assert flattened_dataframe.to_csv(header=False, index=False) == (
+        "650000000000000000000001,1,apple,True,[{'uri': '/1.jpg'}],1.5,7\n"
+        "650000000000000000000002,2,pear,False,[],2.0,\n")
+    assert seen_columns_set == set(EXPECTED_COLUMNS_LIST)
+
+def test_missing_columns_are_null():
+    """Test columns missing from every document are null and not reported as seen"""
+    flattened_dataframe, seen_columns_set = make_flattener().flatten(
+        [{"id": 3, "pricing": "not a dict"}])
+    assert flattened_dataframe["pricing.multiBuyPromotion.id"].isna().all()
+    assert str(flattened_dataframe["id"].dtype) == "Int64"
+    assert seen_columns_set == {"id"}
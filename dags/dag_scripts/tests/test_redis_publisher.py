@@ -0,0 +1,61 @@
+"""Tests for the Redis publisher
+
+Intended to be used with the PyTest library.
+Uses a seperate namespace so the real cached values are not changed.
+"""
+import sys
+sys.path.append('/opt/airflow/dags')
+
+from dag_scripts import redis_publisher
+from dag_scripts.db_connections import db_connection_funcs
+
+TEST_NAMESPACE = "supermarket_publisher_test"
+
+def delete_test_keys(redis_conn):
+    """Delete every key in the test namespace"""
+    for test_key in redis_conn.scan_iter(match=f"{TEST_NAMESPACE}:*"):
+        redis_conn.delete(test_key)
+
+def test_publish_splits_pipelines_by_bytes():
+    """Test large writes are sent over several pipelines and the
+    values are only readable through the pointer once published"""
+    redis_conn = db_connection_funcs.get_redis_connection()
+    delete_test_keys(redis_conn)
+    prices_dict = {f"2023-09-{day:02d}": float(day) for day in range(1, 31)}
+    with redis_publisher.RedisPublisher(redis_conn, TEST_NAMESPACE, version="v1",
+                                        max_pipeline_bytes=256) as publisher:
+        publisher.hset(("product", "Apple", "prices"), prices_dict)
+        publisher.zadd(("products", "latest_price"), {"Apple": 30.0})
+        publisher.set(("total",), 30.0)
+        assert redis_publisher.get_current_version(redis_conn, TEST_NAMESPACE) is None
+        publisher.publish()
+    assert publisher.round_trips_int > 1
+    assert redis_publisher.get_current_version(redis_conn, TEST_NAMESPACE) == "v1"
+    assert redis_conn.hlen(f"{TEST_NAMESPACE}:v1:product:Apple:prices") == 30
+    assert redis_conn.get(f"{TEST_NAMESPACE}:v1:total") == "30.0"
+    delete_test_keys(redis_conn)
+    redis_conn.close()
+
+def test_publish_expires_replaced_and_abandoned_versions():
+    """Test publishing a new version sets the old version to expire and
+    a version that failed part way through is never published"""
+    redis_conn = db_connection_funcs.get_redis_connection()
+    delete_test_keys(redis_conn)
+    for version in ["v1", "v2"]:
+        with redis_publisher.RedisPublisher(redis_conn, TEST_NAMESPACE, version) as publisher:
+            publisher.set(("total",), version)
+            publisher.publish()
+    try:
+        with redis_publisher.RedisPublisher(redis_conn, TEST_NAMESPACE, "v3",
+                                            max_pipeline_bytes=1) as publisher:
+            publisher.set(("total",), "v3")
+            publisher.set(("total", "next"), "v3")
+            raise RuntimeError("Failed part way through")
+    except RuntimeError:
+        pass
+    assert redis_publisher.get_current_version(redis_conn, TEST_NAMESPACE) == "v2"
+    assert redis_conn.ttl(f"{TEST_NAMESPACE}:v1:total") > 0
+    assert redis_conn.ttl(f"{TEST_NAMESPACE}:v2:total") == -1
+    assert redis_conn.ttl(f"{TEST_NAMESPACE}:v3:total") > 0
+    delete_test_keys(redis_conn)
+    redis_conn.close()
@@ -0,0 +1,55 @@
+"""Tests for the per-run MongoDB staging collections
+
+Uses seperate collections so the real staging data is not changed.
+Tests are intended to be run with the PyTest library
+"""
+import sys
+sys.path.append('/opt/airflow/dags')
+
+from dag_scripts import staging_collections
+from dag_scripts.db_connections import connection_manager, db_connection_funcs
+
+TEST_STAGING_COLL_NAME = "supermarket_json_staging_test"
+
+def get_test_database():
+    """Get the MongoDB database with the test collections dropped"""
+    mongo_database = db_connection_funcs.get_mongodb_database(
+        connection_manager.get_mongodb_client())
+    for collection_name in mongo_database.list_collection_names():
+        if collection_name.startswith(TEST_STAGING_COLL_NAME):
+            mongo_database.drop_collection(collection_name)
+    return mongo_database
+
+def test_promote_run_collection():
+    """Test promoting a run replaces the staging collection and
+    a run that wrote nothing leaves it as it was"""
+    mongo_database = get_test_database()
+    for run_date in ["2023-09-05", "2023-09-12"]:
+        staging_collections.get_run_collection(
+            mongo_database, run_date, TEST_STAGING_COLL_NAME).insert_one({"date_extracted": run_date})
+        assert staging_collections.promote_run_collection(
+            mongo_database, run_date, TEST_STAGING_COLL_NAME)
+    assert not staging_collections.promote_run_collection(
+        mongo_database, "2023-09-19", TEST_STAGING_COLL_NAME)
+    staging_documents_list = list(mongo_database[TEST_STAGING_COLL_NAME].find({}, {"_id": 0}))
+    assert staging_documents_list == [{"date_extracted": "2023-09-12"}]
+    assert staging_collections.DATE_EXTRACTED_INDEX_NAME in \
+        mongo_database[TEST_STAGING_COLL_NAME].index_information()
+    assert staging_collections.list_run_collection_names(
+        mongo_database, TEST_STAGING_COLL_NAME) == []
+    get_test_database()
+
+def test_drop_stale_run_collections():
+    """Test stale run collections are dropped except the one being resumed"""
+    mongo_database = get_test_database()
+    for run_date in ["2023-09-05", "2023-09-12"]:
+        staging_collections.get_run_collection(
+            mongo_database, run_date, TEST_STAGING_COLL_NAME).insert_one({"date_extracted": run_date})
+    mongo_database[f"{TEST_STAGING_COLL_NAME}_other"].insert_one({})
+    assert staging_collections.drop_stale_run_collections(
+        mongo_database, "2023-09-12", TEST_STAGING_COLL_NAME) == \
+        [f"{TEST_STAGING_COLL_NAME}_2023-09-05"]
+    assert staging_collections.list_run_collection_names(
+        mongo_database, TEST_STAGING_COLL_NAME) == [f"{TEST_STAGING_COLL_NAME}_2023-09-12"]
+    assert f"{TEST_STAGING_COLL_NAME}_other" in mongo_database.list_collection_names()
+    get_test_database()
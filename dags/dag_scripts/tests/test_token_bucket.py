@@ -0,0 +1,30 @@
+"""Tests for the token bucket rate limiter used by the website crawler
+
+Tests are intended to be run with the PyTest library
+"""
+import sys
+sys.path.append('/opt/airflow/dags')
+
+import time
+from dag_scripts.token_bucket import TokenBucket, HostRateLimiter
+
+def test_first_request_not_delayed():
+    """Test that the first token is available straight away"""
+    bucket = TokenBucket(rate=0.01)
+    assert bucket.acquire() == 0
+
+def test_requests_are_rate_limited():
+    """Test that a second request waits for the bucket to refill"""
+    bucket = TokenBucket(rate=20)
+    bucket.acquire()
+    start_time = time.monotonic()
+    bucket.acquire()
+    assert time.monotonic() - start_time >= 0.04
+
+def test_hosts_have_seperate_buckets():
+    """Test that different hosts do not share a politeness budget"""
+    rate_limiter = HostRateLimiter(rate=0.01)
+    rate_limiter.wait_for_turn("https://www.coles.com.au/browse/fruit-vegetables?page=1")
+    assert rate_limiter.wait_for_turn("https://www.example.com/?page=1") == 0
+    assert rate_limiter.get_bucket("https://www.coles.com.au/a") is \
+        rate_limiter.get_bucket("https://www.coles.com.au/b")
@@ -5,9 +5,9 @@ Intended to be used with the PyTest library
 import sys
 sys.path.append('/opt/airflow/dags')
 
-import re
 import requests
 from dag_scripts import website_to_mongodb
+from dag_scripts import product_extractor
 
 def test_no_url_changes():
     """Tests that the base URL has not changed from expected"""
@@ -16,12 +16,125 @@ def test_no_url_changes():
     response = session.get(webpage_list[0])
     assert response.status_code==200
 
-def test_regex_validity():
-    """Test that the regex to extract website JSON data is still valid"""
+def test_product_extractor_validity():
+    """Test that the single pass product extractor still finds products on the website"""
     session = requests.session()
     webpage_list = website_to_mongodb.create_paginated_webpages_list(max_page=1)
-    json_regex = website_to_mongodb.compile_regex_for_json_extraction()
     response = session.get(webpage_list[0])
-    raw_text = response.text
-    found_json_text_list = re.findall(json_regex, raw_text)
-    assert found_json_text_list != []
+    products_list = list(product_extractor.iter_products_from_webpage_text(response.text))
+    assert products_list != []
+
+def test_scraping_session_config():
+    """Test the scraping session retries transient errors and asks for compressed pages"""
+    session = website_to_mongodb.create_scraping_session()
+    adapter = session.get_adapter("https://www.coles.com.au")
+    assert adapter.max_retries.total == website_to_mongodb.REQUEST_MAX_RETRIES
+    assert 429 in adapter.max_retries.status_forcelist
+    assert "gzip" in session.headers["Accept-Encoding"]
+    session.close()
+
+def test_pipelined_crawl_stops_at_page_without_products(monkeypatch):
+    """Test the pipelined crawl loads every page of a category and stops
+    paginating once a page has no products. Uses fake webpages and a
+    seperate MongoDB collection so the Coles website is not contacted."""
+    from types import SimpleNamespace
+    from dag_scripts.crawl_manifest import CategoryCrawl
+    from dag_scripts.db_connections import db_connection_funcs
+    from dag_scripts.mongodb_bulk_writer import BulkProductWriter
+    from dag_scripts.token_bucket import HostRateLimiter
+
+    def fake_webpage_response(single_webpage_url, session, headers=None):
+        page_number = int(single_webpage_url.split("=")[-1])
+        products_text = "".join(f'{{"_type":"PRODUCT","id":{page_number * 10 + product_number}}}'
+                                for product_number in range(3)) if page_number <= 4 else ""
+        return SimpleNamespace(status_code=200, text=products_text, headers={},
+                               content=products_text.encode())
+    monkeypatch.setattr(website_to_mongodb, "extract_single_webpage_response", fake_webpage_response)
+
+    mongo_client = db_connection_funcs.get_mongodb_client()
+    test_collection = db_connection_funcs.get_mongodb_collection(
+        db_connection_funcs.get_mongodb_database(mongo_client), "supermarket_json_pipeline_test")
+    test_collection.drop()
+    crawl_plan_list = [CategoryCrawl("fruit-vegetables", "/browse/fruit-vegetables", 30, 1,
+                                     "https://www.coles.com.au", "?page=")]
+    with BulkProductWriter(test_collection) as product_writer:
+        products_loaded_dict = website_to_mongodb.crawl_categories_pipelined(
+            crawl_plan_list, HostRateLimiter(1000, 1000), "2023-09-12", product_writer)
+    assert products_loaded_dict == {"fruit-vegetables": 12}
+    assert test_collection.count_documents({"date_extracted": "2023-09-12"}) == 12
+    test_collection.drop()
+    mongo_client.close()
+
+def test_run_plan_maps_every_enabled_category():
+    """Test the run plan gives every mapped crawl task the same run date,
+    one task per enabled category in crawl order"""
+    from dag_scripts import crawl_manifest
+    run_plan_dict = website_to_mongodb.plan_run("2023-09-12")
+    crawl_plan_list = crawl_manifest.plan_crawl(crawl_manifest.load_crawl_manifest())
+    assert run_plan_dict["run_date"] == "2023-09-12"
+    concurrent_category_tasks = min(len(crawl_plan_list),
+                                    website_to_mongodb.MAX_CONCURRENT_CATEGORIES)
+    assert run_plan_dict["crawl_kwargs_list"] == [
+        {"category_name": category_crawl.name, "run_date": "2023-09-12",
+         "concurrent_category_tasks": concurrent_category_tasks}
+        for category_crawl in crawl_plan_list]
+
+def test_single_category_crawls_at_the_full_host_rate(monkeypatch):
+    """Test the host's request rate is only split between the category
+    tasks that will actually run at the same time"""
+    manifest_dict = {"categories": [
+        {"name": "fruit-vegetables", "path": "/browse/fruit-vegetables", "max_page": 30, "priority": 1},
+        {"name": "bakery", "path": "/browse/bakery", "max_page": 30, "priority": 2, "enabled": False}]}
+    monkeypatch.setattr(website_to_mongodb.crawl_manifest, "load_crawl_manifest", lambda: manifest_dict)
+    request_rates_list = []
+    monkeypatch.setattr(website_to_mongodb, "crawl_categories_into_run_collection",
+                        lambda crawl_plan_list, run_date, concurrent_crawl, rate:
+                        request_rates_list.append(rate) or {crawl_plan_list[0].name: 0})
+    monkeypatch.setattr(website_to_mongodb.pipeline_metrics, "report_task_metrics",
+                        lambda task_metrics: None)
+    for crawl_kwargs in website_to_mongodb.plan_run("2023-09-12")["crawl_kwargs_list"]:
+        website_to_mongodb.crawl_category_task(**crawl_kwargs)
+    assert request_rates_list == [website_to_mongodb.HOST_REQUESTS_PER_SECOND]
+
+def test_error_response_fails_the_crawl():
+    """Test an error response left once retries run out raises rather than
+    being parsed as a page without products, which would end the category"""
+    import pytest
+    from types import SimpleNamespace
+    for status_code in (429, 404, 503):
+        fake_session = SimpleNamespace(
+            get=lambda url, headers=None, status_code=status_code: SimpleNamespace(
+                status_code=status_code, text="", headers={}, content=b""))
+        with pytest.raises(requests.exceptions.HTTPError):
+            website_to_mongodb.extract_single_webpage_response(
+                "https://www.coles.com.au/browse/fruit-vegetables?page=2", fake_session)
+
+def test_pipelined_crawl_fails_on_unexpected_fetch_error(monkeypatch):
+    """Test an error other than a request error in the fetch stage (such as
+    a MongoDB error looking up the checkpoint) fails the crawl rather than
+    leaving the parse and load threads waiting forever"""
+    import threading
+    from types import SimpleNamespace
+    from dag_scripts.crawl_manifest import CategoryCrawl
+    from dag_scripts.token_bucket import HostRateLimiter
+
+    def failing_fetch_stage(*args):
+        raise ValueError("checkpoint lookup failed")
+    monkeypatch.setattr(website_to_mongodb, "run_fetch_stage", failing_fetch_stage)
+    crawl_plan_list = [CategoryCrawl("fruit-vegetables", "/browse/fruit-vegetables", 30, 1,
+                                     "https://www.coles.com.au", "?page=")]
+    crawl_errors_list = []
+    def run_crawl():
+        try:
+            website_to_mongodb.crawl_categories_pipelined(
+                crawl_plan_list, HostRateLimiter(1000, 1000), "2023-09-12",
+                SimpleNamespace(collection=None))
+        except ValueError as error:
+            crawl_errors_list.append(error)
+    crawl_thread = threading.Thread(target=run_crawl, daemon=True)
+    crawl_thread.start()
+    crawl_thread.join(timeout=10)
+    assert not crawl_thread.is_alive()
+    assert [str(error) for error in crawl_errors_list] == ["checkpoint lookup failed"]
+    assert not [thread for thread in threading.enumerate()
+                if thread.name in ("crawl-parse", "crawl-load")]
@@ -0,0 +1,96 @@
+"""Token bucket rate limiting for web requests
+
+Used by the website_to_mongodb crawler so several categories can be
+crawled at the same time while each host still only receives requests
+at a polite, configurable rate.
+
+Each host gets its own bucket. A bucket holds up to `capacity` tokens and
+refills at `rate` tokens per second. A request takes one token and waits
+if the bucket is empty.
+"""
+# Standard Library Imports
+import threading
+import time
+from urllib.parse import urlparse
+
+
+class TokenBucket:
+    """Thread safe token bucket
+
+    Parameters:
+    1. rate: number of tokens added to the bucket per second
+    2. capacity: maximum number of tokens the bucket can hold. Controls
+        how many requests can be sent in a burst
+    """
+
+    def __init__(self, rate: float, capacity: float = 1):
+        if rate <= 0:
+            raise ValueError("Token bucket rate must be greater than zero")
+        if capacity < 1:
+            raise ValueError("Token bucket capacity must be at least one token")
+        self.rate = rate
+        self.capacity = capacity
+        # Start with a single token so the first request is not delayed
+        # but a full burst is not sent straight away either
+        self._tokens = 1.0
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        """Add tokens for the time passed since the last refill"""
+        now = time.monotonic()
+        elapsed = now - self._last_refill
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+        self._last_refill = now
+
+    def acquire(self, tokens: float = 1) -> float:
+        """Take tokens from the bucket, sleeping until enough are available
+
+        Parameters:
+        1. tokens: number of tokens to take
+
+        Returns:
+        1. waited_seconds: total time spent waiting for tokens
+        """
+        waited_seconds = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return waited_seconds
+                wait_seconds = (tokens - self._tokens) / self.rate
+            time.sleep(wait_seconds)
+            waited_seconds += wait_seconds
+
+
+class HostRateLimiter:
+    """Hands out one token bucket per host so that requests
+    to different websites do not share a politeness budget
+
+    Parameters:
+    1. rate: tokens per second for each host bucket
+    2. capacity: burst capacity for each host bucket
+    """
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def get_bucket(self, url: str) -> TokenBucket:
+        """Get (or create) the token bucket for the host of a url"""
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._buckets:
+                self._buckets[host] = TokenBucket(self.rate, self.capacity)
+            return self._buckets[host]
+
+    def wait_for_turn(self, url: str) -> float:
+        """Block until the host of the url can receive another request
+
+        Returns:
+        1. waited_seconds: time spent waiting for the host's bucket
+        """
+        return self.get_bucket(url).acquire()
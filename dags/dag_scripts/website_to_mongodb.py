@@ -1,76 +1,901 @@
 """Retrieves data from the Coles supermarket website
 and uploads it into a MongoDB database.
 
-Current scope is to retrieve and upload data for all fruits and vegetables.
+The categories crawled, and their page limits and crawl order, come from
+config/crawl_manifest.json (see the crawl_manifest module), so categories
+can be added or disabled without code changes. Only fruit-vegetables is
+enabled in the manifest as shipped.
 
 Program Flow:
-1. Create a request session to get text data from the Coles website
+1. Create a request session to get text data from the Coles website.
+    Sessions come from create_scraping_session() which pools connections,
+    asks for compressed responses and retries transient errors with backoff
 
-2. Compile a regular expression to grab json data from raw website text
-
-3. Create a variable to hold today's date. This is later appended to the
+2. Create a variable to hold today's date. This is later appended to the
     JSON as metadata for when the data was extracted
 
-4. Loop through the list of fruits and vegetables webpages
+3. Plan the crawl from the category manifest and loop through
+    the paginated webpages of each category in priority order
     For each web page:
 
-        4A. Grab the raw text with a get request
-        4B. Extract the JSON objects out of the raw text using
-            regular expression. These raw JSON objects are stored as strings
-        4C. Convert the list of json strings to a list of json objects
-        4D. Upload the JSON data to the MongoDB database
+        3A. Grab the raw text with a (conditional) get request
+        3B. Extract the product JSON objects out of the raw text in a
+            single pass with the product_extractor module
+        3C. Add the products to a BulkProductWriter, which gathers the products
+            from several pages and loads them into MongoDB with unordered bulk
+            upserts on (id, date_extracted) (see the mongodb_bulk_writer module)
+
+    Progress is checkpointed in MongoDB once a page's products are written
+    (see the crawl_checkpoints module). If the crawl is interrupted, the next
+    run on the same day resumes each category from its last completed page
+    and skips categories that already finished.
+
+4. Products are written into today's run collection (supermarket_json_<date>).
+    Once every category is crawled the run collection is promoted to
+    supermarket_json with a single rename (see the staging_collections module).
+    A failed crawl is not promoted, so the last good staging data is kept.
+
+    When USE_PAGE_CACHE is set, pages that are unchanged since the last
+    crawl (see the page_cache module) are not parsed again. Their cached
+    products are reused, and if they were already loaded for today's run
+    (for example when a failed DAG is re-ran) the MongoDB write is skipped too.
 
-TO DO: Add better error handling
+    When CONCURRENT_CRAWL is set, the crawl runs as a pipeline instead
+    (see crawl_categories_pipelined()). Each category is fetched in its own
+    thread and pages are passed through bounded queues to a parse thread
+    (3B) and a load thread (3C), so fetching, parsing and loading overlap.
+    The random sleep is replaced with a token bucket per host so the
+    politeness budget for the Coles website is shared across threads
+    no matter how many categories are running.
+
+    In the main DAG the crawl is split into tasks instead of running main():
+    plan_run() picks the run date and categories, crawl_category_task() is
+    mapped over the categories so they are crawled in parallel on the
+    Celery workers, and promote_run_task() promotes the run collection once
+    every category task has succeeded.
+
+Error handling:
+1. A request that still fails after the session's retries, or a page that
+    returns an error status, raises so the category is not checkpointed
+    as finished and the next run resumes it
+2. In the pipelined crawl, an error in any fetch, parse or load thread
+    fails the crawl once every thread has stopped (see run_pipeline_stage()
+    and crawl_categories_pipelined()). Nothing is promoted after a failure
 """
 
 # Standard Library Imports
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
-import json
+from functools import partial
 import logging
-import re
+import queue
 from random import randint
+import threading
 from time import sleep
-from typing import Pattern
+from typing import Callable, NamedTuple, Optional, Union
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import make_headers
+from urllib3.util.retry import Retry
 
 # Custom modules
-from dag_scripts.db_connections import db_connection_funcs
+from dag_scripts import crawl_checkpoints
+from dag_scripts import crawl_manifest
+from dag_scripts import mongodb_bulk_writer
+from dag_scripts import pipeline_metrics
+from dag_scripts import product_extractor
+from dag_scripts import staging_collections
+from dag_scripts.crawl_manifest import CategoryCrawl
+from dag_scripts.db_connections import connection_manager, db_connection_funcs
+from dag_scripts.mongodb_bulk_writer import BulkProductWriter
+from dag_scripts.page_cache import PageCache
+from dag_scripts.token_bucket import HostRateLimiter
 
 # Globals
 MIN_PAGE_REQUEST_DELAY = 30 # seconds
 MAX_PAGE_REQUEST_DELAY = 80 # seconds
+CONCURRENT_CRAWL = True
+MAX_CONCURRENT_CATEGORIES = 4
+# Average request rate of the original 30-80 second random sleep
+HOST_REQUESTS_PER_SECOND = 2 / (MIN_PAGE_REQUEST_DELAY + MAX_PAGE_REQUEST_DELAY)
+HOST_BURST_CAPACITY = 1
+USE_PAGE_CACHE = True
+USER_AGENT = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_2) AppleWebKit/601.3.9 (KHTML, like Gecko) Version/9.0.2 Safari/601.3.9"
+REQUEST_TIMEOUT = (10, 60) # seconds - (connect, read)
+REQUEST_MAX_RETRIES = 5
+REQUEST_BACKOFF_FACTOR = 2 # seconds - doubles after every retry
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+OK_STATUS_CODES = (200, 304) # any other final status fails the crawl
+FETCHED_PAGE_QUEUE_SIZE = 8 # pages
+PARSED_PAGE_QUEUE_SIZE = 8 # pages
+PIPELINE_QUEUE_POLL_SECONDS = 1
+PIPELINE_STOP = None # put on a pipeline queue once every category is fetched
+
+
+class FetchedPage(NamedTuple):
+    """Webpage passed from the fetch stage to the parse stage"""
+
+    url: str
+    response: requests.Response
+    cache_entry: Optional[dict]
+
+
+class ParsedPage(NamedTuple):
+    """Webpage passed from the parse stage to the load stage.
+    already_loaded is True for unchanged pages whose cached products
+    are already in MongoDB for today's run.
+    """
+
+    url: str
+    products_list: list
+    product_count: int
+    already_loaded: bool
+
 
-def main():
+class PipelineItem(NamedTuple):
+    """Item on a crawl pipeline queue. A page of None marks the end of a category."""
+
+    category_name: str
+    page_number: int
+    page: Union[FetchedPage, ParsedPage, None]
+
+
+class CrawlPipelineAborted(Exception):
+    """Raised in a pipeline stage when another stage failed"""
+
+
+@pipeline_metrics.instrumented_task("website_to_mongodb")
+def main(concurrent_crawl: bool = CONCURRENT_CRAWL):
     """main"""
-    session = requests.session()
-    webpages_list = create_paginated_webpages_list()
     today_str = str(date.today())
-    json_regex = compile_regex_for_json_extraction()
-    mongodb_client = db_connection_funcs.get_mongodb_client()
+    crawl_plan_list = crawl_manifest.plan_crawl(crawl_manifest.load_crawl_manifest())
+    logging.info(
+        "Crawl planned for categories: %s",
+        [category_crawl.name for category_crawl in crawl_plan_list],
+    )
+    crawl_categories_into_run_collection(
+        crawl_plan_list, today_str, concurrent_crawl, HOST_REQUESTS_PER_SECOND
+    )
+    with pipeline_metrics.step("promote"):
+        staging_collections.promote_run_collection(
+            db_connection_funcs.get_mongodb_database(connection_manager.get_mongodb_client()),
+            today_str,
+        )
+
+
+def plan_run(run_date: Optional[str] = None) -> dict:
+    """Plan a run of the main DAG, which crawls each category in its own
+    mapped task (see crawl_category_task()) and then promotes the run
+    collection once every category is crawled (see promote_run_task())
+
+    The run date is decided once here and passed to every task through XCom,
+    so categories crawled on different workers (or either side of midnight)
+    all load their products under the same date_extracted.
+
+    Each crawl task also gets the number of category tasks that will run at
+    the same time, so the host's request rate is split between only as many
+    tasks as there are planned categories (up to MAX_CONCURRENT_CATEGORIES).
+
+    Parameters:
+    1. run_date: optional date of the run (YYYY-MM-DD). Defaults to today
+
+    Returns:
+    1. run_plan_dict: the run_date and crawl_kwargs_list, the keyword
+        arguments of crawl_category_task() for each category in crawl order
+    """
+    run_date = run_date or str(date.today())
+    crawl_plan_list = crawl_manifest.plan_crawl(crawl_manifest.load_crawl_manifest())
+    logging.info(
+        "Crawl planned for %s for categories: %s",
+        run_date,
+        [category_crawl.name for category_crawl in crawl_plan_list],
+    )
+    # The DAG runs at most MAX_CONCURRENT_CATEGORIES category tasks at a time,
+    # so fewer categories than that each get a bigger share of the host's rate
+    concurrent_category_tasks = max(1, min(len(crawl_plan_list), MAX_CONCURRENT_CATEGORIES))
+    return {
+        "run_date": run_date,
+        "crawl_kwargs_list": [
+            {
+                "category_name": category_crawl.name,
+                "run_date": run_date,
+                "concurrent_category_tasks": concurrent_category_tasks,
+            }
+            for category_crawl in crawl_plan_list
+        ],
+    }
+
+
+@pipeline_metrics.instrumented_task("website_to_mongodb")
+def crawl_category_task(
+    category_name: str,
+    run_date: str,
+    concurrent_crawl: bool = CONCURRENT_CRAWL,
+    concurrent_category_tasks: int = MAX_CONCURRENT_CATEGORIES,
+) -> int:
+    """Crawl a single category of the manifest into the run collection.
+    Used by the main DAG, which maps this task over every planned category.
+
+    Each task has its own token bucket, so the host's request rate is split
+    between the category tasks that run at the same time. plan_run() sets
+    concurrent_category_tasks to the smaller of the number of categories and
+    MAX_CONCURRENT_CATEGORIES, the DAG's limit on running category tasks, so
+    the website never receives more than HOST_REQUESTS_PER_SECOND in total.
+
+    Parameters:
+    1. category_name: name of the category in the crawl manifest
+    2. run_date: date of the run from plan_run(), added to every product
+    3. concurrent_crawl: overlap fetching, parsing and loading the category's
+        pages (see crawl_categories_pipelined())
+    4. concurrent_category_tasks: most category tasks running at the same time,
+        from plan_run()
+
+    Returns:
+    1. products_loaded_int: number of products loaded for the category
+    """
+    crawl_plan_list = [
+        category_crawl
+        for category_crawl in crawl_manifest.plan_crawl(crawl_manifest.load_crawl_manifest())
+        if category_crawl.name == category_name
+    ]
+    if not crawl_plan_list:
+        raise ValueError(f"Category {category_name} is not enabled in the crawl manifest")
+    products_loaded_dict = crawl_categories_into_run_collection(
+        crawl_plan_list,
+        run_date,
+        concurrent_crawl,
+        HOST_REQUESTS_PER_SECOND / max(1, concurrent_category_tasks),
+    )
+    return products_loaded_dict[category_name]
+
+
+@pipeline_metrics.instrumented_task("promote_mongodb_staging")
+def promote_run_task(run_date: str) -> bool:
+    """Promote the run collection to the staging collection once every
+    category task of the run has finished (see staging_collections)
+
+    Returns:
+    1. True if the run collection was promoted
+    """
+    mongodb_database = db_connection_funcs.get_mongodb_database(
+        connection_manager.get_mongodb_client()
+    )
+    with pipeline_metrics.step("promote"):
+        return staging_collections.promote_run_collection(mongodb_database, run_date)
+
+
+def crawl_categories_into_run_collection(
+    crawl_plan_list: list,
+    run_date: str,
+    concurrent_crawl: bool = CONCURRENT_CRAWL,
+    host_requests_per_second: float = HOST_REQUESTS_PER_SECOND,
+) -> dict:
+    """Crawl categories into the run's collection, checkpointing every page
+
+    Parameters:
+    1. crawl_plan_list: list of CategoryCrawl tuples from crawl_manifest.plan_crawl()
+    2. run_date: date of the run, added to every product
+    3. concurrent_crawl: crawl the categories as a pipeline
+        (see crawl_categories_pipelined()) rather than one after another
+    4. host_requests_per_second: request rate of the host's token bucket
+        for the pipelined crawl
+
+    Returns:
+    1. products_loaded_dict: number of products loaded for each category
+    """
+    page_cache = PageCache() if USE_PAGE_CACHE else None
+    mongodb_client = connection_manager.get_mongodb_client()
     mongodb_database = db_connection_funcs.get_mongodb_database(mongodb_client)
-    mongodb_collection = db_connection_funcs.get_mongodb_collection(mongodb_database)
+    mongodb_collection = staging_collections.get_run_collection(mongodb_database, run_date)
+    checkpoint_collection = crawl_checkpoints.get_checkpoint_collection(mongodb_database)
+    mongodb_bulk_writer.ensure_staging_unique_index(mongodb_collection)
+
+    # Pending products are flushed on exit, even if the crawl fails part way
+    with pipeline_metrics.step("crawl") as crawl_metrics, BulkProductWriter(
+        mongodb_collection
+    ) as product_writer:
+        if concurrent_crawl:
+            rate_limiter = HostRateLimiter(host_requests_per_second, HOST_BURST_CAPACITY)
+            products_loaded_dict = crawl_categories_pipelined(
+                crawl_plan_list,
+                rate_limiter,
+                run_date,
+                product_writer,
+                page_cache,
+                checkpoint_collection,
+            )
+        else:
+            # No rate limiter - crawl_category falls back to the random sleep
+            products_loaded_dict = {
+                category_crawl.name: crawl_category(
+                    category_crawl,
+                    None,
+                    run_date,
+                    product_writer,
+                    page_cache,
+                    checkpoint_collection,
+                )
+                for category_crawl in crawl_plan_list
+            }
+        crawl_metrics.add_rows(sum(products_loaded_dict.values()))
+    logging.info("Products loaded per category: %s", products_loaded_dict)
+    logging.info(
+        "MongoDB upserts: %s new products, %s updated products",
+        product_writer.upserted_count,
+        product_writer.modified_count,
+    )
+    return products_loaded_dict
+
+
+def process_single_webpage(
+    single_webpage_url: str,
+    session,
+    date_today: str,
+    product_writer: BulkProductWriter,
+    page_cache: Optional[PageCache] = None,
+    on_flush: Optional[Callable[[], None]] = None,
+) -> int:
+    """Extract, transform and load the products on a single webpage
+
+    Runs the fetch, parse and load stages one after the other. The pipelined
+    crawl (crawl_categories_pipelined()) runs the same stages in separate threads.
+
+    Products are handed to the product writer, so they are only in MongoDB
+    once the writer flushes its batch. Anything that must wait until then
+    (such as checkpointing the page) is passed in as on_flush.
+
+    Parameters:
+    1. single_webpage_url: url of the page to process
+    2. session: requests session object for get requests
+    3. date_today: today's date as a string, added to every product
+    4. product_writer: BulkProductWriter for the MongoDB staging collection
+    5. page_cache: optional PageCache. If given, a conditional get request is
+        sent and unchanged pages reuse the products from the last crawl
+    6. on_flush: optional function with no arguments called once the
+        page's products are written to MongoDB. Not called for pages without products
+
+    Returns:
+    1. products_loaded_int: number of products on the page. Zero
+        means the page had no JSON and pagination for the category should stop
+    """
+    fetched_page = fetch_webpage(single_webpage_url, session, page_cache)
+    parsed_page = parse_webpage(fetched_page, date_today, product_writer.collection, page_cache)
+    return load_webpage(parsed_page, date_today, product_writer, page_cache, on_flush)
+
+
+def fetch_webpage(
+    single_webpage_url: str, session, page_cache: Optional[PageCache] = None
+) -> FetchedPage:
+    """Fetch stage - send a (conditional) get request for a single webpage
+
+    Parameters:
+    1. single_webpage_url: url of the page to fetch
+    2. session: requests session object for get requests
+    3. page_cache: optional PageCache. If given, the request is conditional
+        on the page having changed since it was cached
+
+    Returns:
+    1. fetched_page: FetchedPage with the response and the cache entry
+    """
+    with pipeline_metrics.timed("fetch"):
+        cache_entry = page_cache.get_entry(single_webpage_url) if page_cache else None
+        response = extract_single_webpage_response(
+            single_webpage_url, session, headers=PageCache.conditional_headers(cache_entry)
+        )
+    return FetchedPage(single_webpage_url, response, cache_entry)
+
+
+def parse_webpage(
+    fetched_page: FetchedPage,
+    date_today: str,
+    mongodb_collection,
+    page_cache: Optional[PageCache] = None,
+) -> ParsedPage:
+    """Parse stage - extract the products out of a fetched webpage
+    and add today's date to them
+
+    Unchanged pages reuse the products from the page cache instead.
+    If they were already loaded for today's run the products are not
+    returned at all so the load stage can skip the page.
+
+    Parameters:
+    1. fetched_page: FetchedPage from fetch_webpage()
+    2. date_today: today's date as a string, added to every product
+    3. mongodb_collection: MongoDB staging collection, used to check
+        if cached products are already loaded
+    4. page_cache: optional PageCache
+
+    Returns:
+    1. parsed_page: ParsedPage with the products ready to be loaded
+    """
+    single_webpage_url, response, cache_entry = fetched_page
+    if page_cache is not None and page_cache.is_unchanged(cache_entry, response):
+        if cache_entry["run_date"] == date_today and check_products_already_loaded(
+            mongodb_collection, cache_entry["product_ids"], date_today
+        ):
+            logging.info("Page unchanged and already loaded: %s", single_webpage_url)
+            return ParsedPage(single_webpage_url, [], len(cache_entry["product_ids"]), True)
+        list_of_json_objs = page_cache.load_products(single_webpage_url)
+    else:
+        with pipeline_metrics.timed("parse"):
+            list_of_json_objs = list(
+                product_extractor.iter_products_from_webpage_text(response.text)
+            )
+        if page_cache is not None:
+            page_cache.store(single_webpage_url, response, list_of_json_objs)
+
+    list_of_json_objs_w_date = append_date_extracted_to_json(
+        list_of_json_objs, date_today
+    )
+    return ParsedPage(
+        single_webpage_url, list_of_json_objs_w_date, len(list_of_json_objs_w_date), False
+    )
+
+
+def load_webpage(
+    parsed_page: ParsedPage,
+    date_today: str,
+    product_writer: BulkProductWriter,
+    page_cache: Optional[PageCache] = None,
+    on_flush: Optional[Callable[[], None]] = None,
+) -> int:
+    """Load stage - hand a parsed webpage's products to the product writer
+
+    Parameters:
+    1. parsed_page: ParsedPage from parse_webpage()
+    2. date_today: today's date as a string
+    3. product_writer: BulkProductWriter for the MongoDB staging collection
+    4. page_cache: optional PageCache. The page is marked as loaded for
+        today once its products are written
+    5. on_flush: optional function with no arguments called once the
+        page's products are written to MongoDB. Not called for pages without products
+
+    Returns:
+    1. products_loaded_int: number of products on the page
+    """
+    if parsed_page.already_loaded:
+        product_writer.add([], on_flush)
+        return parsed_page.product_count
+    if parsed_page.product_count == 0:
+        return 0
+
+    def after_products_written():
+        if page_cache is not None:
+            page_cache.mark_loaded(parsed_page.url, date_today)
+        if on_flush is not None:
+            on_flush()
+
+    product_writer.add(parsed_page.products_list, after_products_written)
+    return parsed_page.product_count
+
+
+def check_products_already_loaded(
+    mongodb_collection, product_ids_list: list, date_today: str
+) -> bool:
+    """Check that every product from a cached page is still in MongoDB
+    for today's run. The staging collection may have been cleared since
+    the page was cached, in which case the products must be loaded again.
+
+    Parameters:
+    1. mongodb_collection: MongoDB collection the products are loaded into
+    2. product_ids_list: product ids stored in the page cache
+    3. date_today: today's date as a string
+
+    Returns:
+    1. True if all the products are already loaded, False if not
+    """
+    loaded_products_int = mongodb_collection.count_documents(
+        {"id": {"$in": product_ids_list}, "date_extracted": date_today}
+    )
+    return loaded_products_int >= len(set(product_ids_list))
+
+
+def crawl_category(
+    category_crawl: CategoryCrawl,
+    rate_limiter: Optional[HostRateLimiter],
+    date_today: str,
+    product_writer: BulkProductWriter,
+    page_cache: Optional[PageCache] = None,
+    checkpoint_collection=None,
+) -> int:
+    """Loop through the paginated webpages of a single category,
+    waiting for the host's token bucket before every request
+
+    Each call uses its own requests session as sessions are
+    not guaranteed to be thread safe. The product writer is
+    shared as it holds a lock around its batch.
+
+    If a checkpoint collection is given, the crawl starts after the last
+    completed page for today's run and every page is checkpointed once
+    its products are written to MongoDB.
 
-    for webpage in webpages_list:
-        sleep(randint(MIN_PAGE_REQUEST_DELAY,MAX_PAGE_REQUEST_DELAY))
-        # Extract
-        raw_webpage_text_str = extract_single_webpage_text(webpage, session)
-        found_json_text_list = re.findall(json_regex, raw_webpage_text_str)
+    Parameters:
+    1. category_crawl: category to crawl as planned by crawl_manifest.plan_crawl()
+    2. rate_limiter: HostRateLimiter shared by every category being crawled.
+        If None, a random sleep of MIN_PAGE_REQUEST_DELAY to
+        MAX_PAGE_REQUEST_DELAY seconds is used before each request instead
+    3. date_today: today's date as a string, added to every product
+    4. product_writer: BulkProductWriter shared by every category
+    5. page_cache: optional PageCache shared by every category
+    6. checkpoint_collection: optional collection from
+        crawl_checkpoints.get_checkpoint_collection()
 
-        # Quit looping through pagination if there is no JSON on the page
-        if found_json_text_list == []:
-            break
+    Returns:
+    1. total_products_int: number of products loaded for the category in this call
+    """
+    start_page_int = get_category_start_page(category_crawl, date_today, checkpoint_collection)
+    if start_page_int is None:
+        return 0
 
-        # Transform
-        list_of_json_objs = convert_json_as_strings_to_json_as_objs(
-            found_json_text_list
+    session = create_scraping_session()
+    total_products_int = 0
+    webpages_list = create_category_webpages_list(category_crawl)
+    try:
+        for page_number, webpage in enumerate(webpages_list, start=1):
+            if page_number < start_page_int:
+                continue
+            if rate_limiter is None:
+                sleep(randint(MIN_PAGE_REQUEST_DELAY,MAX_PAGE_REQUEST_DELAY))
+            else:
+                rate_limiter.wait_for_turn(webpage)
+            mark_page_completed = None
+            if checkpoint_collection is not None:
+                mark_page_completed = partial(
+                    crawl_checkpoints.mark_page_completed,
+                    checkpoint_collection,
+                    date_today,
+                    category_crawl.name,
+                    page_number,
+                )
+            products_loaded_int = process_single_webpage(
+                webpage, session, date_today, product_writer, page_cache, mark_page_completed
+            )
+            # Quit looping through pagination if there is no JSON on the page
+            if products_loaded_int == 0:
+                break
+            total_products_int += products_loaded_int
+    finally:
+        session.close()
+
+    if checkpoint_collection is not None:
+        # Queued behind the category's pages so it is only marked
+        # finished once all of its products are written
+        product_writer.add(
+            [],
+            partial(
+                crawl_checkpoints.mark_category_finished,
+                checkpoint_collection,
+                date_today,
+                category_crawl.name,
+            ),
         )
-        list_of_json_objs_w_date = append_date_extracted_to_json(
-            list_of_json_objs, today_str
+    return total_products_int
+
+
+def crawl_categories_pipelined(
+    crawl_plan_list: list,
+    rate_limiter: HostRateLimiter,
+    date_today: str,
+    product_writer: BulkProductWriter,
+    page_cache: Optional[PageCache] = None,
+    checkpoint_collection=None,
+    max_fetch_workers: int = MAX_CONCURRENT_CATEGORIES,
+) -> dict:
+    """Crawl several categories as a pipeline of fetch, parse and load stages
+    joined by bounded queues, so waiting on the website, parsing pages and
+    writing to MongoDB all overlap
+
+    1. Fetch: one thread per category (up to max_fetch_workers) paginates
+        the category, waiting for the host's token bucket before each request
+    2. Parse: a single thread extracts the products from each fetched page.
+        A page without products marks its category as exhausted so the
+        category's fetch thread stops paginating
+    3. Load: a single thread hands the products to the product writer and
+        registers the page checkpoints
+
+    The queues are bounded, so a slow stage makes the stages before it wait
+    (backpressure) and memory use does not grow with the number of pages.
+    Parsing is CPU bound and holds the GIL, so a single parse thread is as fast
+    as several. With single parse and load threads, each category's pages
+    reach the product writer in page order, so checkpoints never skip a page.
+
+    Parameters:
+    1. crawl_plan_list: list of CategoryCrawl tuples from crawl_manifest.plan_crawl()
+    2. rate_limiter: HostRateLimiter shared by every category
+    3. date_today: today's date as a string, added to every product
+    4. product_writer: BulkProductWriter shared by every category
+    5. page_cache: optional PageCache shared by every category
+    6. checkpoint_collection: optional collection from
+        crawl_checkpoints.get_checkpoint_collection()
+    7. max_fetch_workers: maximum number of categories fetched at the same time
+
+    Returns:
+    1. products_loaded_dict: {"category name": number of products loaded}
+    """
+    fetched_page_queue = queue.Queue(maxsize=FETCHED_PAGE_QUEUE_SIZE)
+    parsed_page_queue = queue.Queue(maxsize=PARSED_PAGE_QUEUE_SIZE)
+    exhausted_categories_set = set()
+    stage_failed_event = threading.Event()
+    stage_errors_list = []
+    products_loaded_dict = {category_crawl.name: 0 for category_crawl in crawl_plan_list}
+
+    stage_threads_list = [
+        threading.Thread(
+            target=run_pipeline_stage,
+            name="crawl-parse",
+            args=(
+                run_parse_stage,
+                stage_errors_list,
+                stage_failed_event,
+                fetched_page_queue,
+                parsed_page_queue,
+                date_today,
+                product_writer.collection,
+                page_cache,
+                exhausted_categories_set,
+                stage_failed_event,
+            ),
+        ),
+        threading.Thread(
+            target=run_pipeline_stage,
+            name="crawl-load",
+            args=(
+                run_load_stage,
+                stage_errors_list,
+                stage_failed_event,
+                parsed_page_queue,
+                date_today,
+                product_writer,
+                page_cache,
+                checkpoint_collection,
+                products_loaded_dict,
+                stage_failed_event,
+            ),
+        ),
+    ]
+    for stage_thread in stage_threads_list:
+        stage_thread.start()
+
+    fetch_errors_dict = {}
+    try:
+        with ThreadPoolExecutor(max_workers=max_fetch_workers) as executor:
+            futures_dict = {
+                category_crawl.name: executor.submit(
+                    run_fetch_stage,
+                    category_crawl,
+                    rate_limiter,
+                    date_today,
+                    page_cache,
+                    checkpoint_collection,
+                    fetched_page_queue,
+                    exhausted_categories_set,
+                    stage_failed_event,
+                )
+                for category_crawl in crawl_plan_list
+            }
+            # Any error fails only its category - such as a request error,
+            # or a MongoDB error looking up the category's checkpoint
+            for category_name, future in futures_dict.items():
+                try:
+                    future.result()
+                except Exception as error:
+                    fetch_errors_dict[category_name] = error
+        put_pipeline_item(fetched_page_queue, PIPELINE_STOP, stage_failed_event)
+    except CrawlPipelineAborted:
+        pass
+    except BaseException:
+        # PIPELINE_STOP will not be sent, so tell the parse and load
+        # threads to stop rather than leave them polling their queues
+        stage_failed_event.set()
+        raise
+    finally:
+        for stage_thread in stage_threads_list:
+            stage_thread.join()
+
+    if stage_errors_list:
+        raise stage_errors_list[0]
+    for category_name, error in fetch_errors_dict.items():
+        logging.error("Crawl failed for category %s", category_name)
+        raise error
+    return products_loaded_dict
+
+
+def run_fetch_stage(
+    category_crawl: CategoryCrawl,
+    rate_limiter: HostRateLimiter,
+    date_today: str,
+    page_cache: Optional[PageCache],
+    checkpoint_collection,
+    fetched_page_queue: queue.Queue,
+    exhausted_categories_set: set,
+    stage_failed_event: threading.Event,
+):
+    """Fetch stage worker for a single category
+
+    Puts every fetched page on the fetched page queue followed by an
+    end of category item. Stops early once the parse stage finds a page
+    without products. If a request fails, no end of category item is sent
+    so the category is not checkpointed as finished.
+    """
+    start_page_int = get_category_start_page(category_crawl, date_today, checkpoint_collection)
+    if start_page_int is None:
+        return
+
+    session = create_scraping_session()
+    webpages_list = create_category_webpages_list(category_crawl)
+    try:
+        for page_number, webpage in enumerate(webpages_list, start=1):
+            if page_number < start_page_int:
+                continue
+            if category_crawl.name in exhausted_categories_set:
+                break
+            rate_limiter.wait_for_turn(webpage)
+            # Checked again as the parse stage may have finished the
+            # category while this thread waited for its turn
+            if category_crawl.name in exhausted_categories_set:
+                break
+            fetched_page = fetch_webpage(webpage, session, page_cache)
+            put_pipeline_item(
+                fetched_page_queue,
+                PipelineItem(category_crawl.name, page_number, fetched_page),
+                stage_failed_event,
+            )
+    finally:
+        session.close()
+    put_pipeline_item(
+        fetched_page_queue,
+        PipelineItem(category_crawl.name, 0, None),
+        stage_failed_event,
+    )
+
+
+def run_parse_stage(
+    fetched_page_queue: queue.Queue,
+    parsed_page_queue: queue.Queue,
+    date_today: str,
+    mongodb_collection,
+    page_cache: Optional[PageCache],
+    exhausted_categories_set: set,
+    stage_failed_event: threading.Event,
+):
+    """Parse stage worker. Runs until PIPELINE_STOP is received."""
+    while True:
+        pipeline_item = get_pipeline_item(fetched_page_queue, stage_failed_event)
+        if pipeline_item is PIPELINE_STOP:
+            put_pipeline_item(parsed_page_queue, PIPELINE_STOP, stage_failed_event)
+            return
+        if pipeline_item.page is not None:
+            # Pages fetched after the category's last page are dropped
+            if pipeline_item.category_name in exhausted_categories_set:
+                continue
+            parsed_page = parse_webpage(
+                pipeline_item.page, date_today, mongodb_collection, page_cache
+            )
+            # Quit paginating through the category if there is no JSON on the page
+            if parsed_page.product_count == 0:
+                exhausted_categories_set.add(pipeline_item.category_name)
+                continue
+            pipeline_item = pipeline_item._replace(page=parsed_page)
+        put_pipeline_item(parsed_page_queue, pipeline_item, stage_failed_event)
+
+
+def run_load_stage(
+    parsed_page_queue: queue.Queue,
+    date_today: str,
+    product_writer: BulkProductWriter,
+    page_cache: Optional[PageCache],
+    checkpoint_collection,
+    products_loaded_dict: dict,
+    stage_failed_event: threading.Event,
+):
+    """Load stage worker. Runs until PIPELINE_STOP is received."""
+    while True:
+        pipeline_item = get_pipeline_item(parsed_page_queue, stage_failed_event)
+        if pipeline_item is PIPELINE_STOP:
+            return
+        category_name, page_number, parsed_page = pipeline_item
+        if parsed_page is None:
+            if checkpoint_collection is not None:
+                product_writer.add(
+                    [],
+                    partial(
+                        crawl_checkpoints.mark_category_finished,
+                        checkpoint_collection,
+                        date_today,
+                        category_name,
+                    ),
+                )
+            continue
+        mark_page_completed = None
+        if checkpoint_collection is not None:
+            mark_page_completed = partial(
+                crawl_checkpoints.mark_page_completed,
+                checkpoint_collection,
+                date_today,
+                category_name,
+                page_number,
+            )
+        products_loaded_dict[category_name] += load_webpage(
+            parsed_page, date_today, product_writer, page_cache, mark_page_completed
         )
 
-        # Load
-        mongodb_collection.insert_many(list_of_json_objs_w_date)
-    mongodb_client.close()
+
+def run_pipeline_stage(
+    stage_function: Callable, stage_errors_list: list, stage_failed_event: threading.Event, *args
+):
+    """Run a parse or load stage worker. If it fails the error is recorded
+    and the other stages are told to stop so none of them wait forever
+    on a queue the failed stage no longer reads from or writes to.
+    """
+    try:
+        stage_function(*args)
+    except CrawlPipelineAborted:
+        pass
+    except Exception as error:
+        logging.exception("Crawl pipeline stage %s failed", stage_function.__name__)
+        stage_errors_list.append(error)
+        stage_failed_event.set()
+
+
+def put_pipeline_item(pipeline_queue: queue.Queue, pipeline_item, stage_failed_event: threading.Event):
+    """Put an item on a bounded pipeline queue, waiting while the queue is full
+
+    Raises:
+    1. CrawlPipelineAborted if another stage failed while waiting
+    """
+    while True:
+        if stage_failed_event.is_set():
+            raise CrawlPipelineAborted
+        try:
+            pipeline_queue.put(pipeline_item, timeout=PIPELINE_QUEUE_POLL_SECONDS)
+            return
+        except queue.Full:
+            continue
+
+
+def get_pipeline_item(pipeline_queue: queue.Queue, stage_failed_event: threading.Event):
+    """Get the next item from a pipeline queue, waiting while the queue is empty
+
+    Raises:
+    1. CrawlPipelineAborted if another stage failed while waiting
+    """
+    while True:
+        if stage_failed_event.is_set():
+            raise CrawlPipelineAborted
+        try:
+            return pipeline_queue.get(timeout=PIPELINE_QUEUE_POLL_SECONDS)
+        except queue.Empty:
+            continue
+
+
+def get_category_start_page(
+    category_crawl: CategoryCrawl, date_today: str, checkpoint_collection=None
+) -> Optional[int]:
+    """Get the page a category's crawl should start from
+
+    Parameters:
+    1. category_crawl: category to crawl as planned by crawl_manifest.plan_crawl()
+    2. date_today: today's date as a string
+    3. checkpoint_collection: optional collection from
+        crawl_checkpoints.get_checkpoint_collection()
+
+    Returns:
+    1. start_page_int: page 1 if there are no checkpoints, the page after the
+        last completed page if the category was started, or None if the
+        category already finished today
+    """
+    if checkpoint_collection is None:
+        return 1
+    checkpoint = crawl_checkpoints.get_checkpoint(
+        checkpoint_collection, date_today, category_crawl.name
+    )
+    if checkpoint is not None and checkpoint["finished"]:
+        logging.info("Category %s already finished for %s", category_crawl.name, date_today)
+        return None
+    start_page_int = crawl_checkpoints.get_resume_page(checkpoint)
+    if start_page_int > 1:
+        logging.info("Resuming category %s from page %s", category_crawl.name, start_page_int)
+    return start_page_int
 
 
 def extract_single_webpage_text(single_webpage_url: str, session) -> str:
@@ -102,71 +927,39 @@ def extract_single_webpage_text(single_webpage_url: str, session) -> str:
     Returns:
     1. raw_text_str: Raw text including unwanted text and valuable json data
     """
-    try:
-        data_from_request_str = session.get(single_webpage_url)
-        raw_text_str = data_from_request_str.text
-    except requests.exceptions.RequestException as e:
-        logging.error("Error occured with get request. Please try again")
-        raise requests.exceptions.RequestException from e
+    raw_text_str = extract_single_webpage_response(single_webpage_url, session).text
     return raw_text_str
 
 
-def compile_regex_for_json_extraction() -> Pattern[str]:
-    """Compiles the regular expression for
-    extraction out json items out of the raw website text
-    for a single webpage
-
-    Items on the page are defined in the JSON as follows:
-
-    {'_type':'PRODUCT'...JSON_DATA_HERE...}}
-    where the single quotes are actually double quotes
-    and the '...JSON_DATA_HERE...' piece represents
-    all the data stored such as item names, prices, etc.
-
-    Requires non-greedy matching to retrieve all the items
-
-    NOTES ON SPECIALS: When grocery items are on special
-    (for example 2 for $5.00 sorts of deals)
-    The JSON data returned has a slightly different schema at the end
-    It appears to require a 3rd ending bracket '}' above and beyond the normal 2
-
-    Parameters: None
-
-    Returns:
-    1. json_regex: Compiled regular expression to further extract JSON data out
-    of the raw website text
-    """
-    json_regex = re.compile(
-        r"""
-                            \{\"_type\"\:\"PRODUCT\"
-                            .*?
-                            \}\}\}?
-                            """,
-        re.I | re.X,
-    )
-    return json_regex
-
-
-def convert_json_as_strings_to_json_as_objs(json_found_in_regex_list: list) -> list:
-    """Purpose: Loops through a list of JSON as strings and converts them to actual JSON
+def extract_single_webpage_response(
+    single_webpage_url: str, session, headers: Optional[dict] = None
+) -> requests.Response:
+    """Send a get request for a single web page and return the full response
+    rather than just the text. Used where the status code and response
+    headers are needed, such as for conditional requests to the page cache.
 
     Parameters:
-    1. json_found_in_regex_list:
-        The list of json strings found by the regex function for a single webpage
+    1. single_webpage_url: url for which the response will be retrieved
+    2. session: requests session object for get requests
+    3. headers: optional extra request headers - such as If-None-Match
 
     Returns:
-    1. formatted_json_list: A list of JSON objects
+    1. response: requests response object. Raises HTTPError for any status
+        other than 200 or 304 so the crawl fails and resumes from its checkpoint
     """
-    formatted_json_list = []
-    for json_string in json_found_in_regex_list:
-        try:
-            formatted_json_list.append(json.loads(json_string))
-        except ValueError:
-            logging.warning(
-                "ERROR ON ITEM %s. Item will not be added to MongoDB.",
-                json_string
-            )
-    return formatted_json_list
+    try:
+        response = session.get(single_webpage_url, headers=headers)
+    except requests.exceptions.RequestException as e:
+        logging.error("Error occured with get request. Please try again")
+        raise requests.exceptions.RequestException from e
+    # Once retries run out the session returns the last error response.
+    # Raise rather than let the error page (no products) end the category
+    if response.status_code not in OK_STATUS_CODES:
+        logging.error("GET %s failed with status %s", single_webpage_url, response.status_code)
+        raise requests.exceptions.HTTPError(
+            f"{response.status_code} response for {single_webpage_url}", response=response
+        )
+    return response
 
 
 def append_date_extracted_to_json(list_of_json_objs: list, date_today: str):
@@ -222,15 +1015,136 @@ def create_paginated_webpages_list(
 
     return paginated_webpages
 
-def get_session_with_header()->requests.Session:
-    """Returns a session object with a predefined
-    user agent header.
+
+def create_category_webpages_list(category_crawl: CategoryCrawl) -> list:
+    """Creates the list of paginated webpages for a category
+    planned from the crawl manifest
+
+    Parameters:
+    1. category_crawl: category to crawl as planned by crawl_manifest.plan_crawl()
+
+    Returns:
+    1. paginated_webpages: Full list of urls for the category up to its page ceiling
     """
+    return create_paginated_webpages_list(
+        base_url=category_crawl.base_url,
+        additional_url=category_crawl.path,
+        pagination_str=category_crawl.pagination_str,
+        max_page=category_crawl.max_page,
+    )
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter that applies a default timeout to every request.
+    requests has no session wide timeout so without this a hung
+    connection would block the crawl forever.
+    """
+
+    def __init__(self, *args, timeout=REQUEST_TIMEOUT, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super().send(request, **kwargs)
+
+
+def create_scraping_session(
+    pool_maxsize: int = 2,
+    max_retries: int = REQUEST_MAX_RETRIES,
+    backoff_factor: float = REQUEST_BACKOFF_FACTOR,
+    timeout: tuple = REQUEST_TIMEOUT,
+) -> requests.Session:
+    """Returns a session object tuned for scraping
+
+    1. Keep-alive connections are pooled per host so pages after the
+        first do not pay for a new TCP / TLS handshake
+    2. Compressed responses are requested. Brotli is included when the
+        brotli package is installed, otherwise gzip and deflate
+    3. Transient errors (connection errors, 429 and 5xx responses) are retried
+        with exponential backoff. A Retry-After header from the website is respected
+    4. Every request has a default timeout
+    5. Every response is logged with its timing and size and added
+        to the session.request_timings list. The size is also counted
+        in the pipeline metrics of the running step
+
+    Parameters:
+    1. pool_maxsize: number of connections kept open per host
+    2. max_retries: maximum retries for a single request
+    3. backoff_factor: base delay for the exponential backoff between retries
+    4. timeout: default (connect, read) timeout in seconds
+
+    Returns:
+    1. session: requests session object
+    """
+    retry_strategy = Retry(
+        total=max_retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=RETRY_STATUS_CODES,
+        allowed_methods=frozenset(["GET", "HEAD"]),
+        respect_retry_after_header=True,
+        # Return the last response rather than raising once retries run out
+        # so the status code can be logged by the caller
+        raise_on_status=False,
+    )
+    adapter = TimeoutHTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=pool_maxsize,
+        max_retries=retry_strategy,
+        timeout=timeout,
+    )
     session = requests.Session()
-    headers = {"User-Agent":"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_2) AppleWebKit/601.3.9 (KHTML, like Gecko) Version/9.0.2 Safari/601.3.9"}
-    session.headers.update(headers)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update(make_headers(keep_alive=True, accept_encoding=True))
+    session.headers.update({"User-Agent": USER_AGENT})
+    session.request_timings = []
+    session.hooks["response"].append(
+        partial(record_request_timing, request_timings_list=session.request_timings)
+    )
     return session
 
 
+def record_request_timing(
+    response: requests.Response, *args, request_timings_list: Optional[list] = None, **kwargs
+):
+    """requests response hook that logs the timing and size of each request
+
+    Timing is the time taken until the response headers arrived.
+    Size is the compressed size on the wire when the website sends it.
+
+    Parameters:
+    1. response: requests response object
+    2. request_timings_list: optional list the timing is appended to
+
+    Returns:
+    1. response: the unchanged response
+    """
+    elapsed_seconds = response.elapsed.total_seconds()
+    content_length_str = response.headers.get("Content-Length")
+    response_bytes = int(content_length_str) if content_length_str else len(response.content)
+    logging.info(
+        "GET %s returned %s in %.3f seconds (%s bytes, %s)",
+        response.url,
+        response.status_code,
+        elapsed_seconds,
+        response_bytes,
+        response.headers.get("Content-Encoding", "uncompressed"),
+    )
+    if response.status_code >= 400:
+        logging.warning("GET %s failed with status %s", response.url, response.status_code)
+    pipeline_metrics.record_bytes(response_bytes)
+    if request_timings_list is not None:
+        request_timings_list.append(
+            {
+                "url": response.url,
+                "status_code": response.status_code,
+                "elapsed_seconds": elapsed_seconds,
+                "bytes": response_bytes,
+            }
+        )
+    return response
+
+
 if __name__ == "__main__":
     main()
@@ -18,40 +18,77 @@ with DAG(
     tags=["main_dag"]):
 
     
-    def clear_mongo_staging(task_id="clear_mongodb_staging"):
+    @task(multiple_outputs=True)
+    def plan_crawl():
+        """Pick the run date and the categories to crawl,
+        passed to the tasks below through XCom"""
+        from dag_scripts import website_to_mongodb
+        return website_to_mongodb.plan_run()
+
+    def clear_mongo_staging(run_date, task_id="clear_mongodb_staging"):
         from dag_scripts import clear_mongodb_staging
         return PythonOperator(task_id=task_id,
-                              python_callable=clear_mongodb_staging.main)
+                              python_callable=clear_mongodb_staging.main,
+                              op_kwargs={"run_date": run_date})
 
     
-    def website_to_mongo(task_id="website_to_mongo"):
+    def website_to_mongo(crawl_kwargs_list, task_id="website_to_mongo"):
+        # One mapped task per category, spread over the Celery workers.
+        # The host's request rate is split between the running category tasks
+        from dag_scripts import website_to_mongodb
+        return PythonOperator.partial(task_id=task_id,
+                                      python_callable=website_to_mongodb.crawl_category_task,
+                                      max_active_tis_per_dagrun=website_to_mongodb.MAX_CONCURRENT_CATEGORIES
+                                      ).expand(op_kwargs=crawl_kwargs_list)
+
+    def promote_mongo_staging(run_date, task_id="promote_mongodb_staging"):
         from dag_scripts import website_to_mongodb
         return PythonOperator(task_id=task_id,
-                              python_callable=website_to_mongodb.main)
+                              python_callable=website_to_mongodb.promote_run_task,
+                              op_kwargs={"run_date": run_date})
     
     
-    def mongo_to_postgres(task_id="mongo_to_postgres"):
+    def prepare_mongo_to_postgres(run_date, task_id="prepare_mongo_to_postgres"):
         from dag_scripts import mongodb_to_postgres
         return PythonOperator(task_id=task_id,
-                              python_callable=mongodb_to_postgres.main)
-    
-    def install_dbt_deps(task_id="install_dbt_deps",
-                profiles_dir="/.dbt",
-                project_dir="/dbt_project"):
-        return BashOperator(task_id=task_id,
-                            bash_command=f"dbt deps --profiles-dir {profiles_dir} --project-dir {project_dir}")
+                              python_callable=mongodb_to_postgres.prepare_export_task,
+                              op_kwargs={"date_extracted": run_date})
+
+    def mongo_to_postgres(export_kwargs_list, task_id="mongo_to_postgres"):
+        # One mapped task per export shard, spread over the Celery workers
+        from dag_scripts import mongodb_to_postgres
+        return PythonOperator.partial(task_id=task_id,
+                                      python_callable=mongodb_to_postgres.export_shard_task
+                                      ).expand(op_kwargs=export_kwargs_list)
+
+    def merge_mongo_to_postgres(shard_results_list, task_id="merge_mongo_to_postgres"):
+        from dag_scripts import mongodb_to_postgres
+        return PythonOperator(task_id=task_id,
+                              python_callable=mongodb_to_postgres.merge_export_task,
+                              op_kwargs={"shard_results_list": shard_results_list})
     
-    def run_dbt(task_id="run_dbt",
-                profiles_dir="/.dbt",
-                project_dir="/dbt_project"):
-        return BashOperator(task_id=task_id,
-                            bash_command=f"dbt run --profiles-dir {profiles_dir} --project-dir {project_dir}")
+    def mongo_to_parquet(run_date, task_id="mongo_to_parquet"):
+        from dag_scripts import parquet_archive
+        return PythonOperator(task_id=task_id,
+                              python_callable=parquet_archive.main,
+                              op_kwargs={"date_extracted": run_date})
+
+    def dbt_check_sources(task_id="dbt_check_sources"):
+        from dag_scripts import dbt_runner
+        return PythonOperator(task_id=task_id,
+                              python_callable=dbt_runner.check_sources_task)
+
+    def dbt_build(model_name, task_id=None):
+        # Only builds the model if it changed or its source has new data
+        from dag_scripts import dbt_runner
+        return PythonOperator(task_id=task_id or f"dbt_build_{model_name}",
+                              python_callable=dbt_runner.build_model_task,
+                              op_kwargs={"model_name": model_name})
 
-    def dbt_test(task_id="dbt_run_tests",
-                profiles_dir="/.dbt",
-                project_dir="/dbt_project"):
-        return BashOperator(task_id=task_id,
-                            bash_command=f"dbt test --profiles-dir {profiles_dir} --project-dir {project_dir}")
+    def dbt_save_state(task_id="dbt_save_state"):
+        from dag_scripts import dbt_runner
+        return PythonOperator(task_id=task_id,
+                              python_callable=dbt_runner.save_state_task)
     
     def posgressql_to_redis(task_id="postgres_to_redis"):
         from dag_scripts import postgres_to_redis
@@ -59,13 +96,30 @@ with DAG(
                               python_callable=postgres_to_redis.main)
     
     ############ MAIN DAG EXECUTION ############
-    clear_mongo_staging()>> \
-        website_to_mongo()>> \
-            mongo_to_postgres()>>\
-                install_dbt_deps()>>\
-                    run_dbt()>> \
-                        dbt_test()>>\
-                            posgressql_to_redis()
+    # Categories are crawled and shards exported by mapped tasks that run
+    # in parallel. promote_mongodb_staging and merge_mongo_to_postgres wait
+    # for every mapped task, so dbt only runs on a complete load.
+    # The archive is written alongside the PostgreSQL load
+    # as both only read the MongoDB staging collection
+    run_plan = plan_crawl()
+    promote_mongo_staging_task = promote_mongo_staging(run_plan["run_date"])
+    prepare_mongo_to_postgres_task = prepare_mongo_to_postgres(run_plan["run_date"])
+    mongo_to_postgres_task = mongo_to_postgres(prepare_mongo_to_postgres_task.output)
 
+    clear_mongo_staging(run_plan["run_date"])>>\
+        website_to_mongo(run_plan["crawl_kwargs_list"])>>\
+            promote_mongo_staging_task>>mongo_to_parquet(run_plan["run_date"])
+    promote_mongo_staging_task>>prepare_mongo_to_postgres_task
+    dbt_check_sources_task = dbt_check_sources()
+    merge_mongo_to_postgres(mongo_to_postgres_task.output)>>dbt_check_sources_task
 
-    
+    # The fact models only read the source so they are built alongside
+    # the dimension. Each mart waits for the models it joins
+    dbt_build_dim_task = dbt_build("dim_product_descriptions")
+    dbt_build_marts_list = [dbt_build("mart_pricing_over_time"),
+                            dbt_build("mart_specials_over_time")]
+    dbt_check_sources_task>>dbt_build_dim_task>>dbt_build_marts_list
+    dbt_check_sources_task>>dbt_build("fct_product_prices")>>dbt_build_marts_list[0]
+    dbt_check_sources_task>>dbt_build("fct_product_specials")>>dbt_build_marts_list[1]
+    dbt_build_marts_list>>dbt_save_state()
+    dbt_build_marts_list>>posgressql_to_redis()
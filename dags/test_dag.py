@@ -41,7 +41,46 @@ with DAG(
              test_name="test_mongodb_to_postgres.py"),
              \
              run_test(task_id="test_postgres_to_redis",
-             test_name="test_postgres_to_redis.py")]
+             test_name="test_postgres_to_redis.py"),
+             \
+             run_test(task_id="test_token_bucket",
+             test_name="test_token_bucket.py"),
+             \
+             run_test(task_id="test_crawl_manifest",
+             test_name="test_crawl_manifest.py"),
+             \
+             run_test(task_id="test_product_extractor",
+             test_name="test_product_extractor.py"),
+             \
+             run_test(task_id="test_page_cache",
+             test_name="test_page_cache.py"),
+             \
+             run_test(task_id="test_crawl_checkpoints",
+             test_name="test_crawl_checkpoints.py"),
+             \
+             run_test(task_id="test_product_flattener",
+             test_name="test_product_flattener.py"),
+             \
+             run_test(task_id="test_mongodb_bulk_writer",
+             test_name="test_mongodb_bulk_writer.py"),
+             \
+             run_test(task_id="test_redis_publisher",
+             test_name="test_redis_publisher.py"),
+             \
+             run_test(task_id="test_price_cache_client",
+             test_name="test_price_cache_client.py"),
+             \
+             run_test(task_id="test_parquet_archive",
+             test_name="test_parquet_archive.py"),
+             \
+             run_test(task_id="test_staging_collections",
+             test_name="test_staging_collections.py"),\
+             \
+             run_test(task_id="test_pipeline_metrics",
+             test_name="test_pipeline_metrics.py"),\
+             \
+             run_test(task_id="test_dbt_runner",
+             test_name="test_dbt_runner.py")]
              
 
 
@@ -4,8 +4,15 @@
 }}
 with raw_staging AS (
     SELECT * FROM {{ source("supermarket","raw_staging") }}
+    {% if is_incremental() %}
+    -- Only weeks from the last loaded date onwards. The last date is read
+    -- again so a re-ran load for that date is picked up
+    WHERE date_extracted >= (SELECT coalesce(max(date_last_updated), '1900-01-01') FROM {{ this }})
+    {% endif %}
 )
-SELECT
+-- One row per description, from the latest week it was seen, so the
+-- merge on the unique key never receives the same description twice
+SELECT DISTINCT ON (description)
     id AS product_id,
     name AS product_name,
     description,
@@ -16,4 +23,7 @@ SELECT
     date_extracted AS date_last_updated,
     _id AS mongodb_document_id
 FROM
-    raw_staging
\ No newline at end of file
+    raw_staging
+ORDER BY
+    description,
+    date_extracted DESC
\ No newline at end of file
@@ -1,12 +1,17 @@
 {{ config(
     materialized='incremental',
-    unique_key = 'date_extracted')  
+    unique_key = 'product_on_special_surrogate_key')
 }}
 with raw_staging AS (
     SELECT * FROM {{ source("supermarket","raw_staging") }}
+    {% if is_incremental() %}
+    -- Only weeks from the last loaded date onwards. The last date is read
+    -- again so a re-ran load for that date is picked up
+    WHERE date_extracted >= (SELECT coalesce(max(date_extracted), '1900-01-01') FROM {{ this }})
+    {% endif %}
 )
 SELECT
-    {{ dbt_utils.surrogate_key(['id','_id','date_extracted']) }} AS product_on_special_surrogate_key,
+    {{ dbt_utils.surrogate_key(['id','date_extracted']) }} AS product_on_special_surrogate_key,
     id AS product_id,
     "pricing.multiBuyPromotion.id" AS special_id,
     "pricing.offerDescription" AS special_description,
@@ -1,14 +1,18 @@
 {{ config(
     materialized='incremental',
-    unique_key = 'pricing_date') 
+    unique_key = 'pricing_over_time_surrogate_key')
 }}
 WITH left_descriptions AS (
     SELECT * FROM {{ ref('dim_product_descriptions') }}
 ),
 right_prices AS (
     SELECT * FROM {{ ref('fct_product_prices') }}
+    {% if is_incremental() %}
+    WHERE pricing_date >= (SELECT coalesce(max(pricing_date), '1900-01-01') FROM {{ this }})
+    {% endif %}
 )
 SELECT
+    {{ dbt_utils.surrogate_key(['right_prices.price_surrogate_key','left_descriptions.description']) }} AS pricing_over_time_surrogate_key,
     right_prices.pricing_date,
     left_descriptions.product_name,
     left_descriptions.category AS product_category,
@@ -21,5 +25,5 @@ SELECT
 FROM
     left_descriptions
 
-LEFT JOIN right_prices ON (left_descriptions.product_id = right_prices.product_id)
+RIGHT JOIN right_prices ON (left_descriptions.product_id = right_prices.product_id)
 
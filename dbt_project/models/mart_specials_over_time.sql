@@ -1,14 +1,18 @@
 {{ config(
     materialized='incremental',
-    unique_key = 'date_extracted')
+    unique_key = 'specials_over_time_surrogate_key')
 }}
 WITH left_descriptions AS (
     SELECT * FROM {{ ref('dim_product_descriptions') }}
 ),
 right_specials AS (
     SELECT * FROM {{ ref('fct_product_specials') }}
+    {% if is_incremental() %}
+    WHERE date_extracted >= (SELECT coalesce(max(date_extracted), '1900-01-01') FROM {{ this }})
+    {% endif %}
 )
 SELECT
+    {{ dbt_utils.surrogate_key(['right_specials.product_on_special_surrogate_key','left_descriptions.description']) }} AS specials_over_time_surrogate_key,
     right_specials.date_extracted,
     left_descriptions.product_name,
     left_descriptions.category AS product_category,